@@ -0,0 +1,49 @@
+"""
+    Compare serial and parallel media probe wall time.
+
+    usage: python benchmarks/probe_benchmark.py /path/to/ffmpeg /dir/of/samples [-w 1 4 8]
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+
+sys.path.append('.')
+
+from wandarr.ffmpeg import FFmpeg
+from wandarr.probe import Prober
+
+
+def timed_probe(prober: Prober, paths) -> float:
+    start = time.perf_counter()
+    for _ in prober.fetch_all(paths):
+        pass
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="wandarr probe benchmark")
+    parser.add_argument(dest="ffmpeg", help="path to ffmpeg (ffprobe is expected alongside)")
+    parser.add_argument(dest="sample_dir", help="directory of media files to probe")
+    parser.add_argument("-w", dest="workers", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("-m", dest="mode", choices=["thread", "process"], default="thread")
+    args = parser.parse_args()
+
+    paths = sorted(p for p in glob.glob(os.path.join(args.sample_dir, "*")) if os.path.isfile(p))
+    if not paths:
+        print(f"No files found in {args.sample_dir}")
+        sys.exit(1)
+
+    ffmpeg = FFmpeg(args.ffmpeg)
+    print(f"{len(paths)} files, mode={args.mode}")
+    baseline = None
+    for workers in args.workers:
+        elapsed = timed_probe(Prober(ffmpeg, workers, args.mode), paths)
+        if baseline is None:
+            baseline = elapsed
+        print(f"workers={workers:3}  {elapsed:8.2f}s  {len(paths) / elapsed:8.1f} files/s  x{baseline / elapsed:.2f}")
+
+
+if __name__ == '__main__':
+    main()
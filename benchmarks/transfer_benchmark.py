@@ -0,0 +1,85 @@
+"""
+    Compare the old chunked send/recv file transfer with sendfile/recv_into over loopback.
+
+    usage: python benchmarks/transfer_benchmark.py [-s SIZE_MB] [-r REPEAT]
+"""
+import argparse
+import os
+import socket
+import sys
+import tempfile
+import time
+from threading import Thread
+
+sys.path.append('.')
+
+from wandarr.transfer import send_file, recv_file
+
+
+def old_send(sock: socket.socket, path: str):
+    """Controller upload as it was - 4K read/send pairs"""
+    with open(path, "rb") as f:
+        while True:
+            buf = f.read(4096)
+            sock.send(buf)
+            if len(buf) < 4096:
+                break
+
+
+def old_recv(sock: socket.socket, path: str, filesize: int):
+    """Agent receive as it was - 4K recv into a new bytes object each time"""
+    with open(path, "wb") as f:
+        while filesize > 0:
+            chunk = sock.recv(min(4096, filesize))
+            if len(chunk) == 0:
+                break
+            filesize -= len(chunk)
+            f.write(chunk)
+
+
+def timed_transfer(sender, receiver, src: str, dest: str, filesize: int) -> float:
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+
+    def serve():
+        conn, _ = listener.accept()
+        with conn:
+            receiver(conn, dest, filesize)
+
+    t = Thread(target=serve)
+    t.start()
+    start = time.perf_counter()
+    with socket.create_connection(listener.getsockname()) as s:
+        sender(s, src)
+        t.join()
+    elapsed = time.perf_counter() - start
+    listener.close()
+    if os.path.getsize(dest) != filesize:
+        raise RuntimeError("transfer incomplete")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="wandarr transfer benchmark")
+    parser.add_argument("-s", dest="size_mb", type=int, default=512, help="test file size in MB")
+    parser.add_argument("-r", dest="repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        src = os.path.join(tmpdir, "source.bin")
+        dest = os.path.join(tmpdir, "dest.bin")
+        with open(src, "wb") as f:
+            for _ in range(args.size_mb):
+                f.write(os.urandom(1024 * 1024))
+        filesize = os.path.getsize(src)
+
+        print(f"{args.size_mb}MB over loopback, best of {args.repeat}")
+        for name, sender, receiver in [("4K send/recv", old_send, old_recv),
+                                       ("sendfile/recv_into", send_file, recv_file)]:
+            best = min(timed_transfer(sender, receiver, src, dest, filesize) for _ in range(args.repeat))
+            print(f"{name:20} {args.size_mb / best:8.0f} MB/s")
+
+
+if __name__ == '__main__':
+    main()
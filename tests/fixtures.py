@@ -21,4 +21,8 @@ def media_info():
 @pytest.fixture
 def basic_config():
     config = ConfigFile("tests/basic_config.yml")
+    # keep the probe cache and throughput history out of the source tree
+    config.probe_cache_path = None
+    config.throughput_db_path = None
+    config.journal_path = None
     return config
@@ -1,7 +1,13 @@
+import time
+from threading import Thread
 from unittest.mock import patch
 
+from wandarr.base import EncodeJob
 from wandarr.cluster import Cluster
 from wandarr.config import ConfigFile
+from wandarr.media import MediaInfo
+from wandarr.scheduler import Scheduler
+from wandarr.throughput import ThroughputModel
 
 from .fixtures import basic_config, media_info
 
@@ -19,6 +25,285 @@ def test_cluster_setup(remote_host_ok_mock, agent_host_ok_mock, basic_config, me
         ffmpeg.return_value = media_info
 
         c.enqueue("/tmp/test.mkv", "tv")
-        assert c.queues["medium"].qsize() == 1
+        assert c.scheduler.pending_count("medium") == 1
 
 
+
+def test_cluster_checks_hosts_in_parallel(basic_config):
+    def slow_check(host):
+        time.sleep(0.5)
+        return host.hostname != "server3"
+
+    with patch("wandarr.base.ManagedHost.host_ok", autospec=True, side_effect=slow_check), \
+            patch("wandarr.agenthost.AgentManagedHost.host_ok", autospec=True, side_effect=slow_check):
+        start = time.monotonic()
+        c = Cluster(basic_config)
+        elapsed = time.monotonic() - start
+
+    assert elapsed < 1.0
+    hostnames = {h.hostname for h in c.hosts}
+    assert "server3" not in hostnames
+    assert "workstation" in hostnames and "server4" in hostnames
+
+
+def test_scheduler_blocks_until_closed(media_info, basic_config, tmp_path):
+    s = Scheduler(log_path=str(tmp_path / "scheduler.log"))
+    s.register("host/qsv", ["medium"])
+    received = []
+
+    def consumer():
+        while (job := s.next_job("host/qsv")) is not None:
+            received.append(job)
+            s.job_done("host/qsv", job)
+
+    t = Thread(target=consumer)
+    t.start()
+    s.submit(EncodeJob("/tmp/test1.mkv", media_info, basic_config.templates["tv"]))
+    s.submit(EncodeJob("/tmp/test2.mkv", media_info, basic_config.templates["tv"]))
+    assert t.is_alive()
+    s.close()
+    t.join(timeout=5)
+    assert not t.is_alive()
+    assert [j.in_path for j in received] == ["/tmp/test1.mkv", "/tmp/test2.mkv"]
+    assert s.dispatched["host/qsv"] == 2
+
+
+def test_scheduler_matches_capabilities(media_info, basic_config, tmp_path):
+    s = Scheduler(log_path=str(tmp_path / "scheduler.log"))
+    s.register("host1/cpu", ["copy"])
+    s.register("host2/vt", ["medium", "high"])
+
+    template = basic_config.templates["tv"]
+    s.submit(EncodeJob("/tmp/a.mkv", media_info, template, "medium"))
+    s.submit(EncodeJob("/tmp/b.mkv", media_info, template, "copy"))
+    s.submit(EncodeJob("/tmp/c.mkv", media_info, template, "high"))
+    s.close()
+
+    # host1 skips past the medium job to the first one it can do
+    assert s.next_job("host1/cpu").in_path == "/tmp/b.mkv"
+    assert s.next_job("host1/cpu") is None
+    # host2 picks up work of either of its qualities
+    assert s.next_job("host2/vt").in_path == "/tmp/a.mkv"
+    assert s.next_job("host2/vt").in_path == "/tmp/c.mkv"
+    assert s.next_job("host2/vt") is None
+
+
+def test_scheduler_host_slots(media_info, basic_config, tmp_path):
+    s = Scheduler(log_path=str(tmp_path / "scheduler.log"))
+    s.register("host/qsv", ["medium"], "host")
+    s.register("host/cuda", ["medium"], "host")
+    s.set_slots("host", 1)
+
+    template = basic_config.templates["tv"]
+    s.submit(EncodeJob("/tmp/a.mkv", media_info, template))
+    s.submit(EncodeJob("/tmp/b.mkv", media_info, template))
+    s.close()
+
+    first = s.next_job("host/qsv")
+    second = []
+    t = Thread(target=lambda: second.append(s.next_job("host/cuda")))
+    t.start()
+    t.join(timeout=0.2)
+    # host is full, so the cuda thread must wait for the qsv job to finish
+    assert t.is_alive()
+    s.job_done("host/qsv", first)
+    t.join(timeout=5)
+    assert second[0].in_path == "/tmp/b.mkv"
+
+
+def test_scheduler_prefetch(media_info, basic_config, tmp_path):
+    s = Scheduler(log_path=str(tmp_path / "scheduler.log"))
+    s.register("agent/qsv", ["medium"], "agent")
+    s.set_slots("agent", 1)
+    s.set_prefetch("agent", 1)
+
+    template = basic_config.templates["tv"]
+    for name in ["a", "b", "c"]:
+        s.submit(EncodeJob(f"/tmp/{name}.mkv", media_info, template))
+    s.close()
+
+    first = s.next_job("agent/qsv")
+    staged = s.prefetch("agent/qsv")
+    assert staged.in_path == "/tmp/b.mkv"
+    # only one staged file allowed on the agent
+    assert s.prefetch("agent/qsv") is None
+
+    # result of the first job is still being retrieved, but the slot is free for the staged job
+    s.encode_finished("agent/qsv", first)
+    assert s.start_staged("agent/qsv", staged)
+    assert s.host_running["agent"] == 1 and s.host_staged["agent"] == 0
+    s.job_done("agent/qsv", first)
+    assert s.host_running["agent"] == 1
+
+    # a failed upload puts the job back
+    third = s.prefetch("agent/qsv")
+    s.unstage("agent/qsv", third)
+    assert s.pending_count() == 1
+    s.job_done("agent/qsv", staged)
+    assert s.next_job("agent/qsv") is third
+
+
+def test_scheduler_busy_host(media_info, basic_config, tmp_path):
+    s = Scheduler(log_path=str(tmp_path / "scheduler.log"))
+    s.register("agent/qsv", ["medium"], "agent")
+    s.register("other/qsv", ["medium"], "other")
+
+    template = basic_config.templates["tv"]
+    s.submit(EncodeJob("/tmp/a.mkv", media_info, template))
+    s.close()
+
+    job = s.next_job("agent/qsv")
+    s.job_done("agent/qsv", job, deferred=True)
+    # put back without counting against the job, and the busy agent is left alone for a while
+    assert job.attempts == 0 and not job.failed_hosts
+    assert s._select("agent/qsv") == (None, None)
+    assert s.next_job("other/qsv") is job
+
+
+def test_scheduler_retries_on_other_host(media_info, basic_config, tmp_path):
+    s = Scheduler(log_path=str(tmp_path / "scheduler.log"), retry_backoff=0)
+    s.register("host1/qsv", ["medium"], "host1")
+    s.register("host2/qsv", ["medium"], "host2")
+
+    template = basic_config.templates["tv"]
+    s.submit(EncodeJob("/tmp/a.mkv", media_info, template))
+    s.close()
+
+    job = s.next_job("host1/qsv")
+    job.speeds.append(1.5)
+    s.job_done("host1/qsv", job, "ffmpeg exit code 1")
+    assert job.attempts == 1 and job.speeds == []
+    # host1 won't get the same job back while host2 is available
+    assert s._select("host1/qsv") == (None, None)
+    retry = s.next_job("host2/qsv")
+    assert retry is job
+    s.job_done("host2/qsv", retry)
+    assert s.pending_count() == 0 and not s.failed
+    assert s.next_job("host1/qsv") is None
+
+
+def test_scheduler_gives_up_after_max_attempts(media_info, basic_config, tmp_path):
+    s = Scheduler(log_path=str(tmp_path / "scheduler.log"), retry_backoff=0, max_attempts=2)
+    s.register("host1/qsv", ["medium"], "host1")
+
+    template = basic_config.templates["tv"]
+    s.submit(EncodeJob("/tmp/a.mkv", media_info, template))
+    s.close()
+
+    # only one host, so the failed job is retried there
+    job = s.next_job("host1/qsv")
+    s.job_done("host1/qsv", job, "agent connection lost")
+    assert s.next_job("host1/qsv") is job
+    s.job_done("host1/qsv", job, "agent connection lost")
+
+    assert s.failed == [job]
+    assert s.next_job("host1/qsv") is None
+
+
+def test_scheduler_quarantines_failing_host(media_info, basic_config, tmp_path):
+    s = Scheduler(log_path=str(tmp_path / "scheduler.log"), retry_backoff=0, quarantine_after=2)
+    s.register("host1/qsv", ["medium"], "host1")
+
+    template = basic_config.templates["tv"]
+    s.submit(EncodeJob("/tmp/a.mkv", media_info, template))
+    s.submit(EncodeJob("/tmp/b.mkv", media_info, template))
+    s.close()
+
+    for _ in range(2):
+        job = s.next_job("host1/qsv")
+        s.job_done("host1/qsv", job, "ffmpeg exit code 1")
+
+    assert "host1" in s.quarantined
+    assert s.next_job("host1/qsv") is None
+    # both jobs are left over for a host that isn't broken
+    assert s.pending_count() == 2 and not s.failed
+
+
+@patch("wandarr.agenthost.AgentManagedHost.host_ok", return_value=True)
+@patch("wandarr.base.ManagedHost.host_ok", return_value=True)
+def test_cluster_engine_slots(remote_host_ok_mock, agent_host_ok_mock, basic_config):
+    config = basic_config
+    config.hosts["workstation"]["engines"] = ["qsv", "cuda"]
+    config.hosts["workstation"]["slots"] = 3
+    config.hosts["workstation"]["engine-slots"] = {"cuda": 2}
+    c = Cluster(config)
+
+    workers = [h.worker_name for h in c.hosts if h.hostname == "workstation"]
+    assert workers == ["workstation/qsv", "workstation/qsv#2", "workstation/qsv#3",
+                       "workstation/cuda", "workstation/cuda#2"]
+    assert c.scheduler.host_slots["workstation"] == 3
+
+
+def test_scheduler_lpt_order(basic_config, tmp_path):
+    template = basic_config.templates["tv"]
+
+    def job(name, runtime, width, height):
+        mi = MediaInfo({'path': name, 'vcodec': 'h264', 'frames': 0, 'stream': '0', 'res_height': height,
+                        'res_width': width, 'runtime': runtime, 'filesize_mb': 100, 'fps': 24,
+                        'colorspace': 'yuv420p', 'audio': [], 'subtitle': []})
+        return EncodeJob(name, mi, template)
+
+    for order, expected in [("lpt", ["/tmp/4k.mkv", "/tmp/movie.mkv", "/tmp/ep1.mkv", "/tmp/ep2.mkv"]),
+                            ("smallest", ["/tmp/ep1.mkv", "/tmp/ep2.mkv", "/tmp/movie.mkv", "/tmp/4k.mkv"]),
+                            ("fifo", ["/tmp/ep1.mkv", "/tmp/movie.mkv", "/tmp/ep2.mkv", "/tmp/4k.mkv"])]:
+        s = Scheduler(order, log_path=str(tmp_path / "scheduler.log"))
+        s.register("host/qsv", ["medium"])
+        s.submit(job("/tmp/ep1.mkv", 1800, 1920, 1080))
+        s.submit(job("/tmp/movie.mkv", 7200, 1920, 1080))
+        s.submit(job("/tmp/ep2.mkv", 1800, 1920, 1080))
+        s.submit(job("/tmp/4k.mkv", 7200, 3840, 2160))
+        s.close()
+        assert [s.next_job("host/qsv").in_path for _ in range(4)] == expected
+
+
+def test_scheduler_lpt_holds_until_probed(media_info, basic_config, tmp_path):
+    s = Scheduler("lpt", log_path=str(tmp_path / "scheduler.log"))
+    s.register("host/qsv", ["medium"])
+    s.submit(EncodeJob("/tmp/a.mkv", media_info, basic_config.templates["tv"]))
+
+    # more jobs may still be probed, so nothing is handed out yet
+    assert s._select("host/qsv") == (None, None)
+    s.close()
+    assert s.next_job("host/qsv").in_path == "/tmp/a.mkv"
+
+    # a window of 0 dispatches as jobs arrive
+    s = Scheduler("lpt", log_path=str(tmp_path / "scheduler.log"), order_window=0)
+    s.register("host/qsv", ["medium"])
+    s.submit(EncodeJob("/tmp/a.mkv", media_info, basic_config.templates["tv"]))
+    assert s._select("host/qsv") == (0, None)
+
+
+def test_throughput_model(media_info, tmp_path):
+    model = ThroughputModel(str(tmp_path / "throughput.db"))
+    assert model.estimate("host", "qsv", "medium", media_info) is None
+    model.record("host", "qsv", "medium", media_info, 2.0)
+    model.record("host", "qsv", "medium", media_info, 4.0)
+    model.close()
+
+    # history survives a restart
+    model = ThroughputModel(str(tmp_path / "throughput.db"))
+    speed = model.speed("host", "qsv", "medium", media_info)
+    assert speed == 2.0 * 0.7 + 4.0 * 0.3
+    assert model.estimate("host", "qsv", "medium", media_info) == media_info.runtime / speed
+    model.close()
+
+
+def test_scheduler_prefers_faster_host(media_info, basic_config, tmp_path):
+    model = ThroughputModel(str(tmp_path / "throughput.db"))
+    model.record("fast", "cuda", "medium", media_info, 10.0)
+    model.record("slow", "qsv", "medium", media_info, 1.0)
+
+    s = Scheduler(log_path=str(tmp_path / "scheduler.log"), model=model)
+    s.register("fast/cuda", ["medium"], "fast", "cuda")
+    s.register("slow/qsv", ["medium"], "slow", "qsv")
+    for i in range(20):
+        s.submit(EncodeJob(f"/tmp/test{i}.mkv", media_info, basic_config.templates["tv"]))
+
+    # the fast host can get through 9 jobs before the slow one would finish its first
+    assert s._select("slow/qsv") == (9, None)
+    assert s._select("fast/cuda") == (0, None)
+
+    # with one job the slow host should leave it for the fast one
+    s.pending = s.pending[0:1]
+    assert s._select("slow/qsv") == (None, "fast")
+    model.close()
@@ -1,13 +1,18 @@
-from queue import Queue
+import asyncio
+import os
+import socket
+import time
 from threading import Thread
 from unittest.mock import patch
 
 import pytest
 
+from wandarr.agent import Agent
 from wandarr.agenthost import AgentManagedHost
 from wandarr.base import RemoteHostProperties, EncodeJob
 from wandarr.localhost import LocalHost
 from wandarr.mountedhost import MountedManagedHost
+from wandarr.scheduler import Scheduler
 from wandarr.streaminghost import StreamingManagedHost
 from .fixtures import media_info, basic_config
 
@@ -19,7 +24,7 @@ CONFIG_PATH = "tests/basic_config.yml"
 @patch("wandarr.ffmpeg.FFmpeg.run")
 @patch("os.remove")
 @patch("os.rename")
-def test_localhost_job(rename_mock, remove_mock, ffmpeg_mock, getsize_mock, media_info, basic_config, ffmpeg_return):
+def test_localhost_job(rename_mock, remove_mock, ffmpeg_mock, getsize_mock, media_info, basic_config, ffmpeg_return, tmp_path):
 
     getsize_mock.return_value = 1_500_000_000
     ffmpeg_mock.return_value = ffmpeg_return
@@ -27,24 +32,25 @@ def test_localhost_job(rename_mock, remove_mock, ffmpeg_mock, getsize_mock, medi
     config = basic_config
     props = config.hosts["workstation"]
     host_props = RemoteHostProperties("workstation", props)
-    q = Queue()
+    q = Scheduler(log_path=str(tmp_path / "scheduler.log"), retry_backoff=0, max_attempts=1)
     mi = media_info
 
     # deactivate threshold check
     config.templates["tv"].template["threshold"] = 0
 
     job = EncodeJob("/tmp/test.mkv", mi, config.templates["tv"])
-    q.put(job)
+    q.submit(job)
+    q.close()
 
     host = LocalHost("workstation", host_props, q)
 
-    host.video_cli = "-c:v copy"
+    host.attach("qsv", {"medium": "-c:v copy"})
     host.testrun()
 
     if ffmpeg_return == 0:
         assert remove_mock.call_args.args[0] == "/tmp/test.mkv"
         assert rename_mock.call_args.args == ("/tmp/test.mkv.tmp", "/tmp/test.mkv")
-    assert q.empty() is True
+    assert q.pending_count() == 0
 
 
 @pytest.mark.parametrize("ffmpeg_return", [0, -1])
@@ -52,7 +58,7 @@ def test_localhost_job(rename_mock, remove_mock, ffmpeg_mock, getsize_mock, medi
 @patch("wandarr.ffmpeg.FFmpeg.run_remote")
 @patch("os.remove")
 @patch("os.rename")
-def test_mountedhost_job(rename_mock, remove_mock, ffmpeg_mock, getsize_mock, media_info, basic_config, ffmpeg_return):
+def test_mountedhost_job(rename_mock, remove_mock, ffmpeg_mock, getsize_mock, media_info, basic_config, ffmpeg_return, tmp_path):
 
     getsize_mock.return_value = 1_500_000_000
     ffmpeg_mock.return_value = ffmpeg_return
@@ -60,24 +66,25 @@ def test_mountedhost_job(rename_mock, remove_mock, ffmpeg_mock, getsize_mock, me
     config = basic_config
     props = config.hosts["server"]
     host_props = RemoteHostProperties("server", props)
-    q = Queue()
+    q = Scheduler(log_path=str(tmp_path / "scheduler.log"), retry_backoff=0, max_attempts=1)
     mi = media_info
 
     # "fix" the template to not think threshold was met
     config.templates["tv"].template["threshold"] = 0
 
     job = EncodeJob("/Volumes/media/test.mkv", mi, config.templates["tv"])
-    q.put(job)
+    q.submit(job)
+    q.close()
 
     host = MountedManagedHost("server", host_props, q)
 
-    host.video_cli = "-c:v copy"
+    host.attach("qsv", {"medium": "-c:v copy"})
     host.testrun()
 
     if ffmpeg_return == 0:
         assert remove_mock.call_args.args[0] == "/Volumes/media/test.mkv"
         assert rename_mock.call_args.args == ("/Volumes/media/test.mkv.tmp", "/Volumes/media/test.mkv")
-        assert q.empty() is True
+        assert q.pending_count() == 0
     else:
         assert remove_mock.call_args.args[0] == "/Volumes/media/test.mkv.tmp"
 
@@ -94,7 +101,7 @@ def test_mountedhost_job(rename_mock, remove_mock, ffmpeg_mock, getsize_mock, me
 @patch("shutil.move")
 @patch("wandarr.streaminghost.StreamingManagedHost.run_process")
 def test_streaming_job(run_process_mock, move_mock, run_mock, rename_mock, remove_mock, ffmpeg_mock,
-                       getsize_mock, media_info, basic_config):
+                       getsize_mock, media_info, basic_config, tmp_path):
 
     getsize_mock.return_value = 1_500_000_000
     ffmpeg_mock.return_value = 0
@@ -103,23 +110,24 @@ def test_streaming_job(run_process_mock, move_mock, run_mock, rename_mock, remov
     config = basic_config
     props = config.hosts["server"]
     host_props = RemoteHostProperties("server", props)
-    q = Queue()
+    q = Scheduler(log_path=str(tmp_path / "scheduler.log"), retry_backoff=0, max_attempts=1)
     mi = media_info
 
     # "fix" the template to not think threshold was met
     config.templates["tv"].template["threshold"] = 0
 
     job = EncodeJob("/tmp/test.mkv", mi, config.templates["tv"])
-    q.put(job)
+    q.submit(job)
+    q.close()
 
     host = StreamingManagedHost("server", host_props, q)
 
-    host.video_cli = "-c:v copy"
+    host.attach("qsv", {"medium": "-c:v copy"})
     host.testrun()
 
     assert run_process_mock.call_args.args[0] == ["/usr/bin/ssh", "me@192.168.1.100", '"rm /tmp/test.mkv.tmp"']
     assert len(run_mock.call_args) == 2
-    assert q.empty() is True
+    assert q.pending_count() == 0
 
 
 @patch("os.path.getsize")
@@ -133,7 +141,7 @@ def test_streaming_job(run_process_mock, move_mock, run_mock, rename_mock, remov
 @patch("wandarr.agenthost.AgentManagedHost.recvfile", return_value=True)
 @patch("wandarr.agenthost.AgentManagedHost.ack", return_value=True)
 def test_agent_job(ack_mock, recv_mock, send_mock, handshake_mock, connect_mock,
-                   unlink_mock, rename_mock, remove_mock, ffmpeg_mock, getsize_mock, media_info, basic_config):
+                   unlink_mock, rename_mock, remove_mock, ffmpeg_mock, getsize_mock, media_info, basic_config, tmp_path):
 
     getsize_mock.return_value = 1_500_000_000
     ffmpeg_mock.return_value = (True, "DONE|0|1300000000")
@@ -141,16 +149,46 @@ def test_agent_job(ack_mock, recv_mock, send_mock, handshake_mock, connect_mock,
     config = basic_config
     props = config.hosts["server4"]
     host_props = RemoteHostProperties("server", props)
-    q = Queue()
+    q = Scheduler(log_path=str(tmp_path / "scheduler.log"), retry_backoff=0, max_attempts=1)
     mi = media_info
 
     # "fix" the template to not think threshold was met
     config.templates["tv"].template["threshold"] = 0
 
     job = EncodeJob("/tmp/test.mkv", mi, config.templates["tv"])
-    q.put(job)
+    q.submit(job)
+    q.close()
 
     host = AgentManagedHost("server", host_props, q)
 
-    host.video_cli = "-c:v copy"
+    host.attach("qsv", {"medium": "-c:v copy"})
     host.testrun()
+
+
+def test_agent_download_resumes(basic_config, tmp_path, monkeypatch):
+    result = os.urandom(200_000)
+    kept = tmp_path / "source.mkv.tmp"
+    kept.write_bytes(result)
+    server = Agent(port=0, keep_partial=60)
+    # what the agent keeps when sending a result breaks off
+    server.partials.keep("key", "result", str(kept))
+    t = Thread(target=lambda: asyncio.run(server.serve_async()))
+    t.start()
+    while not server.port:
+        time.sleep(0.01)
+    monkeypatch.setattr(Agent, "PORT", server.port)
+    monkeypatch.setattr(AgentManagedHost, "RESUME_DELAY", 0)
+
+    q = Scheduler(log_path=str(tmp_path / "scheduler.log"))
+    host = AgentManagedHost("server", RemoteHostProperties("server", basic_config.hosts["server4"]), q)
+    controller, agent = socket.socketpair()
+    agent.sendall(result[:80_000])
+    agent.close()
+    dest = tmp_path / "dest.mkv.tmp"
+    host.recvfile(controller, len(result), str(dest), "key")
+
+    server.stop()
+    t.join(timeout=5)
+    server.shutdown()
+    assert dest.read_bytes() == result
+    assert not kept.exists()
@@ -0,0 +1,35 @@
+from wandarr.base import EncodeJob
+from wandarr.journal import Journal
+from wandarr.scheduler import Scheduler
+
+from .fixtures import basic_config, media_info
+
+
+def test_journal_replay(media_info, basic_config, tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    s = Scheduler(log_path=str(tmp_path / "scheduler.log"), journal=Journal(path))
+    s.register("host/qsv", ["medium"])
+
+    template = basic_config.templates["tv"]
+    for name in ["a", "b", "c", "d"]:
+        s.submit(EncodeJob(f"/tmp/{name}.mkv", media_info, template))
+    s.close()
+
+    s.job_done("host/qsv", s.next_job("host/qsv"))
+    s.job_done("host/qsv", s.next_job("host/qsv"), skipped=True)
+    # c is in flight when the controller dies, d never started
+    s.next_job("host/qsv")
+    s.journal.close()
+    with open(path, "a", encoding="utf8") as f:
+        f.write('{"time": 1, "state": "compl')
+
+    entries = Journal.replay(path)
+    assert entries["/tmp/a.mkv"]["state"] == "completed"
+    assert entries["/tmp/b.mkv"]["state"] == "skipped"
+    assert entries["/tmp/c.mkv"]["state"] == "started"
+    assert Journal.unfinished(entries) == ["/tmp/c.mkv", "/tmp/d.mkv"]
+    assert Journal.last_template(entries) == "tv"
+
+    # resuming appends to the same journal
+    Journal(path, resume=True).close()
+    assert len(Journal.replay(path)) == 4
@@ -2,6 +2,7 @@ import json
 from unittest.mock import patch
 
 from wandarr.config import ConfigFile
+from wandarr.ffmpeg import FFmpeg
 from wandarr.media import MediaInfo
 from .fixtures import media_info
 
@@ -54,3 +55,9 @@ def test_stream_map(media_info):
     stream_map = template.stream_map(media_info.stream, media_info.audio, media_info.subtitle)
     assert stream_map == ['-map', '0:0', '-map', '0:1', '-map', '0:2', '-map', '0:3', '-map', '0:4']
 
+
+
+def test_video_encoders():
+    assert FFmpeg.video_encoders("-c:v hevc_nvenc -preset p7 -b:v 3000k") == ["hevc_nvenc"]
+    assert FFmpeg.video_encoders("-vcodec libx264 -crf 20") == ["libx264"]
+    assert FFmpeg.video_encoders("-c:v copy") == []
@@ -0,0 +1,104 @@
+import time
+from unittest.mock import patch
+
+import wandarr
+from wandarr.ffmpeg import FFmpeg
+from wandarr.probe import Prober, PROBE_STATUS_NAME
+from wandarr.probecache import ProbeCache
+from .fixtures import media_info
+
+
+def test_probe_preserves_order(media_info):
+
+    def slow_fetch(path):
+        # later files finish first to shake out ordering
+        time.sleep(0.01 * (10 - int(path[-1])))
+        return media_info
+
+    with patch("wandarr.ffmpeg.FFmpeg.fetch_details", side_effect=slow_fetch):
+        paths = [f"/tmp/file{i}" for i in range(10)]
+        prober = Prober(FFmpeg("/usr/bin/ffmpeg"), workers=4)
+        results = list(prober.fetch_all(paths))
+
+    assert [path for path, _ in results] == paths
+    reports = []
+    while not wandarr.status_queue.empty():
+        reports.append(wandarr.status_queue.get())
+    probes = [r for r in reports if r['file'] == PROBE_STATUS_NAME]
+    assert probes[-1]['completed'] == 100
+
+
+def test_probe_failure_skipped(media_info):
+
+    def fetch(path):
+        if path.endswith("bad"):
+            raise ValueError("Error opening file")
+        return media_info
+
+    with patch("wandarr.ffmpeg.FFmpeg.fetch_details", side_effect=fetch):
+        prober = Prober(FFmpeg("/usr/bin/ffmpeg"), workers=2)
+        results = dict(prober.fetch_all(["/tmp/good", "/tmp/bad"]))
+
+    assert results["/tmp/good"] is media_info
+    assert results["/tmp/bad"] is None
+
+
+def test_probe_cache(media_info, tmp_path):
+    media = tmp_path / "test.mkv"
+    media.write_bytes(b"x" * 100)
+    path = str(media)
+
+    cache = ProbeCache(str(tmp_path / "probe.db"))
+    assert cache.get(path) is None
+    cache.put(path, media_info)
+
+    mi = cache.get(path)
+    assert mi.to_dict() == media_info.to_dict()
+    assert mi.audio[0].lang == "eng"
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # a change in size invalidates the entry
+    media.write_bytes(b"x" * 200)
+    assert cache.get(path) is None
+    cache.close()
+
+
+def test_probe_cache_eviction(media_info, tmp_path):
+    cache = ProbeCache(str(tmp_path / "probe.db"), max_entries=2)
+    for i in range(3):
+        media = tmp_path / f"test{i}.mkv"
+        media.write_bytes(b"x")
+        cache.put(str(media), media_info)
+
+    assert cache.entries == 2
+    assert cache.evictions == 1
+    assert cache.get(str(tmp_path / "test0.mkv")) is None
+    cache.close()
+
+
+def test_prober_uses_cache(media_info, tmp_path):
+    media = tmp_path / "test.mkv"
+    media.write_bytes(b"x")
+    cache = ProbeCache(str(tmp_path / "probe.db"))
+    cache.put(str(media), media_info)
+
+    with patch("wandarr.ffmpeg.FFmpeg.fetch_details") as fetch_mock:
+        prober = Prober(FFmpeg("/usr/bin/ffmpeg"), workers=2, cache=cache)
+        results = list(prober.fetch_all([str(media)]))
+        assert fetch_mock.call_count == 0
+    assert results[0][1].vcodec == media_info.vcodec
+    prober.close()
+
+
+def test_prober_cache_uses_absolute_path(media_info, tmp_path, monkeypatch):
+    media = tmp_path / "test.mkv"
+    media.write_bytes(b"x")
+    cache = ProbeCache(str(tmp_path / "probe.db"))
+    cache.put(str(media), media_info)
+
+    monkeypatch.chdir(tmp_path)
+    with patch("wandarr.ffmpeg.FFmpeg.fetch_details") as fetch_mock:
+        prober = Prober(FFmpeg("/usr/bin/ffmpeg"), cache=cache)
+        assert prober.fetch_details("test.mkv").vcodec == media_info.vcodec
+        assert fetch_mock.call_count == 0
+    prober.close()
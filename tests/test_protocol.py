@@ -0,0 +1,424 @@
+import asyncio
+import json
+import os
+import socket
+import sys
+import time
+from threading import Semaphore, Thread
+
+import pytest
+
+import wandarr
+from wandarr import protocol
+from wandarr.agent import Agent, PartialFiles, Runner, SourceCache
+from wandarr.agenthost import AgentManagedHost, query_agent_status
+from wandarr.base import pipe_format
+from wandarr.ffmpeg import FFmpeg
+from wandarr.transfer import send_checked, recv_checked, fingerprint
+
+# stands in for ffmpeg on the agent - a stats line, copy input to output, then the closing summary
+FAKE_FFMPEG = ("import sys,shutil;"
+               "print('frame=  100 fps= 50 q=20.0 size=    1024kB time=00:00:04.00 bitrate=1000kbits/s speed=2.0x');"
+               "shutil.copy(sys.argv[1],sys.argv[2]);"
+               "print('video:1024kB audio:0kB subtitle:0kB')")
+
+# answers ffmpeg -encoders
+FAKE_ENCODERS = ("print('Encoders:');"
+                 "print(' V..... = Video');"
+                 "print(' ------');"
+                 "print(' V....D libx264              libx264 H.264');"
+                 "print(' V....D hevc_nvenc           NVIDIA NVENC hevc encoder')")
+
+# three stats lines, then success or failure as asked in argv[1]
+FAKE_CHATTY_FFMPEG = ("import sys;"
+                      "[print(f'frame= {n}00 fps= 50 q=20.0 size=    1024kB time=00:00:0{n}.00 bitrate=1000kbits/s speed=2.0x')"
+                      " for n in range(1, 4)];"
+                      "fail = sys.argv[1] == 'fail';"
+                      "print('Conversion failed!' if fail else 'video:1024kB audio:0kB subtitle:0kB');"
+                      "sys.exit(1 if fail else 0)")
+
+# streaming mode stand-in - source on stdin, stats on stderr, "encoded" (reversed) output on stdout
+FAKE_STREAMING_FFMPEG = ("import sys;"
+                         "sys.stderr.write('frame=  100 fps= 50 q=20.0 size=    1024kB time=00:00:04.00 bitrate=1000kbits/s speed=2.0x\\n');"
+                         "sys.stdout.buffer.write(sys.stdin.buffer.read()[::-1]);"
+                         "sys.stderr.write('video:1024kB audio:0kB subtitle:0kB\\n')")
+
+
+def _upload(controller, src, mode=protocol.MSG_UPLOAD, offset=0):
+    """Controller side of a protocol 5 upload"""
+    protocol.send_frame(controller, mode, "key")
+    assert protocol.recv_frame(controller) == (protocol.MSG_OFFSET, str(offset).encode())
+    send_checked(controller, str(src), offset)
+
+
+def _download(controller, dest, size, offset=0):
+    recv_checked(controller, str(dest), size, offset)
+    protocol.send_frame(controller, protocol.MSG_ACK)
+    return dest.read_bytes()
+
+
+def test_negotiation():
+    hello = "HELLO|1.1.2|10|/tmp|a.mkv|ffmpeg"
+    offered = protocol.offer(hello)
+    assert protocol.accept(offered) == (hello, protocol.PROTOCOL_VERSION)
+    # older controller makes no offer
+    assert protocol.accept(hello) == (hello, 1)
+    # older agent just echoes
+    assert protocol.negotiated(offered, offered) == 1
+    assert protocol.negotiated(offered, protocol.accepted_reply(offered, 2)) == 2
+    assert protocol.negotiated(offered, "garbage") == 0
+
+
+def test_frames():
+    a, b = socket.socketpair()
+    protocol.send_frame(a, protocol.MSG_OUTPUT, "line one\n")
+    protocol.send_frame(a, protocol.MSG_ACK)
+    assert protocol.recv_frame(b) == (protocol.MSG_OUTPUT, b"line one\n")
+    assert protocol.recv_frame(b) == (protocol.MSG_ACK, b"")
+    a.close()
+    with pytest.raises(ConnectionError):
+        protocol.recv_frame(b)
+    b.close()
+
+
+@pytest.mark.parametrize("framed", [True, False])
+def test_agent_transcode(tmp_path, framed):
+    src = tmp_path / "source.mkv"
+    src.write_bytes(os.urandom(100_000))
+    agent_dir = tmp_path / "agent"
+    agent_dir.mkdir()
+
+    controller, agent = socket.socketpair()
+    runner = Runner(agent, "test", 1)
+    runner.start()
+
+    cli = "$".join([sys.executable, "-c", FAKE_FFMPEG, "{FILENAME}"])
+    hello = f"HELLO|{wandarr.__version__}|{src.stat().st_size}|{agent_dir}|source.mkv|{cli}"
+    if framed:
+        hello = protocol.offer(hello)
+    controller.send(hello.encode())
+    reply = controller.recv(4096).decode()
+    assert protocol.negotiated(hello, reply) == (protocol.PROTOCOL_VERSION if framed else 1)
+    if framed:
+        protocol.send_frame(controller, protocol.MSG_MONITOR, "0")
+
+    if framed:
+        _upload(controller, src)
+    else:
+        controller.sendall(src.read_bytes())
+
+    ffmpeg = FFmpeg("ffmpeg")
+    ffmpeg.monitor_interval = 0
+    if framed:
+        results = list(ffmpeg.monitor_agent_framed(controller))
+        assert results[0]['speed'] == "2.0x"
+        protocol.send_frame(controller, protocol.MSG_ACK)
+    else:
+        results = []
+        # the original monitor carries on after DONE, waiting on the caller to stop reading
+        for item in ffmpeg.monitor_agent(controller):
+            results.append(item)
+            if isinstance(item, str):
+                break
+        controller.send(b"ACK!")
+    done = results[-1]
+    assert done.startswith("DONE|0|")
+    size = int(done.split("|")[2])
+    if framed:
+        received = _download(controller, tmp_path / "result.mkv", size)
+    else:
+        received = bytearray()
+        while len(received) < size:
+            received.extend(controller.recv(size - len(received)))
+    assert bytes(received) == src.read_bytes()
+
+    runner.join(timeout=10)
+    controller.close()
+    assert os.listdir(agent_dir) == []
+
+
+def test_agent_streaming_transcode(tmp_path):
+    src = tmp_path / "source.mkv"
+    src.write_bytes(os.urandom(3 * protocol.STREAM_CHUNK + 1000))
+    result = tmp_path / "source.mkv.tmp"
+
+    controller, agent = socket.socketpair()
+    runner = Runner(agent, "test", 1)
+    runner.start()
+
+    cli = "$".join([sys.executable, "-c", FAKE_STREAMING_FFMPEG, "-i", "{FILENAME}"])
+    hello = protocol.offer(f"HELLO|{wandarr.__version__}|{src.stat().st_size}|{tmp_path}|source.mkv|{cli}")
+    controller.send(hello.encode())
+    assert protocol.negotiated(hello, controller.recv(4096).decode()) == protocol.PROTOCOL_VERSION
+    protocol.send_frame(controller, protocol.MSG_MONITOR, "0")
+
+    sender = protocol.FrameSender(controller)
+    sender.send(protocol.MSG_STREAM, pipe_format(str(src), ".mkv"))
+    feeder = Thread(target=AgentManagedHost.feed, args=(sender, str(src)))
+    feeder.start()
+
+    ffmpeg = FFmpeg("ffmpeg")
+    ffmpeg.monitor_interval = 0
+    with open(result, "wb") as sink:
+        results = list(ffmpeg.monitor_agent_framed(controller, sink))
+    feeder.join()
+    runner.join(timeout=10)
+    controller.close()
+
+    assert results[0]['speed'] == "2.0x"
+    assert results[-1] == f"DONE|0|{src.stat().st_size}"
+    assert result.read_bytes() == src.read_bytes()[::-1]
+
+
+@pytest.mark.parametrize("start", [True, False])
+def test_agent_prefetch(tmp_path, start):
+    src = tmp_path / "source.mkv"
+    src.write_bytes(os.urandom(100_000))
+    agent_dir = tmp_path / "agent"
+    agent_dir.mkdir()
+
+    controller, agent = socket.socketpair()
+    runner = Runner(agent, "test", 1)
+    runner.start()
+
+    cli = "$".join([sys.executable, "-c", FAKE_FFMPEG, "{FILENAME}"])
+    hello = protocol.offer(f"HELLO|{wandarr.__version__}|{src.stat().st_size}|{agent_dir}|source.mkv|{cli}")
+    controller.send(hello.encode())
+    assert protocol.negotiated(hello, controller.recv(4096).decode()) == protocol.PROTOCOL_VERSION
+    protocol.send_frame(controller, protocol.MSG_MONITOR, "0")
+    _upload(controller, src, protocol.MSG_PREFETCH)
+    assert protocol.recv_frame(controller) == (protocol.MSG_STAGED, b"")
+    # held until told to start
+    assert os.listdir(agent_dir) == ["source.mkv"]
+
+    if start:
+        protocol.send_frame(controller, protocol.MSG_START)
+        ffmpeg = FFmpeg("ffmpeg")
+        ffmpeg.monitor_interval = 0
+        done = list(ffmpeg.monitor_agent_framed(controller))[-1]
+        assert done == f"DONE|0|{src.stat().st_size}"
+        protocol.send_frame(controller, protocol.MSG_ACK)
+        assert _download(controller, tmp_path / "result.mkv", src.stat().st_size) == src.read_bytes()
+    else:
+        # controller gave up on the job, so the staged file goes
+        controller.close()
+
+    runner.join(timeout=10)
+    controller.close()
+    assert os.listdir(agent_dir) == []
+
+
+@pytest.mark.parametrize("fail", [False, True])
+def test_agent_progress(tmp_path, fail):
+    src = tmp_path / "source.mkv"
+    src.write_bytes(os.urandom(1000))
+    controller, agent = socket.socketpair()
+    runner = Runner(agent, "test", 1)
+    runner.start()
+
+    cli = "$".join([sys.executable, "-c", FAKE_CHATTY_FFMPEG, "fail" if fail else "ok", "{FILENAME}"])
+    hello = protocol.offer(f"HELLO|{wandarr.__version__}|{src.stat().st_size}|{tmp_path}|upload.mkv|{cli}")
+    controller.send(hello.encode())
+    controller.recv(4096)
+    protocol.send_frame(controller, protocol.MSG_MONITOR, "60")
+    _upload(controller, src)
+    frames = []
+    while not frames or frames[-1][0] not in (protocol.MSG_DONE, protocol.MSG_ERR):
+        frames.append(protocol.recv_frame(controller))
+    controller.close()
+    runner.join(timeout=10)
+
+    # stats parsed by the agent, and no more often than asked
+    assert frames[0][0] == protocol.MSG_PROGRESS
+    assert json.loads(frames[0][1]) == {'frame': 100, 'fps': '50', 'q': '20.0', 'size': 1024 * 1024, 'time': 1,
+                                        'speed': '2.0x'}
+    output = [payload.decode() for mtype, payload in frames if mtype == protocol.MSG_OUTPUT]
+    if fail:
+        # the output is only sent when there is an error to explain
+        assert [mtype for mtype, _ in frames[1:]] == [protocol.MSG_OUTPUT] * 4 + [protocol.MSG_ERR]
+        assert output[-1] == "Conversion failed!\n"
+    else:
+        assert [mtype for mtype, _ in frames] == [protocol.MSG_PROGRESS, protocol.MSG_DONE]
+
+
+def test_agent_resumes_transfers(tmp_path):
+    src = tmp_path / "source.mkv"
+    src.write_bytes(os.urandom(300_000))
+    size = src.stat().st_size
+    agent_dir = tmp_path / "agent"
+    agent_dir.mkdir()
+    partials = PartialFiles(60)
+    cli = "$".join([sys.executable, "-c", FAKE_FFMPEG, "{FILENAME}"])
+    hello = protocol.offer(f"HELLO|{wandarr.__version__}|{size}|{agent_dir}|source.mkv|{cli}")
+
+    def connect(offered=None):
+        controller, agent = socket.socketpair()
+        runner = Runner(agent, "test", 1, offered=offered, partials=partials)
+        runner.start()
+        if offered is None:
+            controller.send(hello.encode())
+            controller.recv(4096)
+            protocol.send_frame(controller, protocol.MSG_MONITOR, "0")
+        return controller, runner
+
+    # upload breaks off part way, the agent keeps what it got
+    controller, runner = connect()
+    protocol.send_frame(controller, protocol.MSG_UPLOAD, "key")
+    assert protocol.recv_frame(controller) == (protocol.MSG_OFFSET, b"0")
+    controller.sendall(src.read_bytes()[:100_000])
+    controller.close()
+    runner.join(timeout=10)
+    assert (agent_dir / "source.mkv").stat().st_size == 100_000
+
+    # the upload carries on from there, then the result download breaks off
+    controller, runner = connect()
+    _upload(controller, src, offset=100_000)
+    ffmpeg = FFmpeg("ffmpeg")
+    ffmpeg.monitor_interval = 0
+    assert list(ffmpeg.monitor_agent_framed(controller))[-1] == f"DONE|0|{size}"
+    protocol.send_frame(controller, protocol.MSG_ACK)
+    received = bytearray()
+    while len(received) < 50_000:
+        received.extend(controller.recv(50_000 - len(received)))
+    controller.close()
+    runner.join(timeout=10)
+    assert os.listdir(agent_dir) == ["source.mkv.tmp"]
+
+    # and is resumed on a new connection
+    result = tmp_path / "result.mkv"
+    result.write_bytes(received)
+    controller, runner = connect(offered="RESUME|key|50000")
+    assert protocol.recv_frame(controller) == (protocol.MSG_DONE, f"DONE|0|{size}".encode())
+    assert _download(controller, result, size, offset=50_000) == src.read_bytes()
+    runner.join(timeout=10)
+    controller.close()
+    assert os.listdir(agent_dir) == [] and len(partials) == 0
+
+
+def test_agent_source_cache(tmp_path):
+    src = tmp_path / "source.mkv"
+    src.write_bytes(os.urandom(100_000))
+    agent_dir = tmp_path / "agent"
+    agent_dir.mkdir()
+    cache = SourceCache(150_000)
+    cli = "$".join([sys.executable, "-c", FAKE_FFMPEG, "{FILENAME}"])
+    hello = protocol.offer(f"HELLO|{wandarr.__version__}|{src.stat().st_size}|{agent_dir}|source.mkv|{cli}")
+    ffmpeg = FFmpeg("ffmpeg")
+    ffmpeg.monitor_interval = 0
+    upload_fingerprint = fingerprint(str(src))
+
+    for upload in (True, False):
+        controller, agent = socket.socketpair()
+        runner = Runner(agent, "test", 1, cache=cache)
+        runner.start()
+        controller.send(hello.encode())
+        controller.recv(4096)
+        protocol.send_frame(controller, protocol.MSG_MONITOR, "0")
+        protocol.send_frame(controller, protocol.MSG_UPLOAD, f"key|{upload_fingerprint}")
+        if upload:
+            assert protocol.recv_frame(controller) == (protocol.MSG_OFFSET, b"0")
+            send_checked(controller, str(src))
+        else:
+            # second run of the same source skips the upload
+            assert protocol.recv_frame(controller) == (protocol.MSG_CACHED, b"")
+        assert list(ffmpeg.monitor_agent_framed(controller))[-1].startswith("DONE|0|")
+        protocol.send_frame(controller, protocol.MSG_ACK)
+        assert _download(controller, tmp_path / "result.mkv", src.stat().st_size) == src.read_bytes()
+        runner.join(timeout=10)
+        controller.close()
+        assert os.listdir(agent_dir) == [SourceCache.DIR]
+
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
+    # a restarted agent finds what was cached, and a second source pushes the first out
+    cache = SourceCache(150_000)
+    assert cache.lookup(str(agent_dir), upload_fingerprint) is not None
+    other = agent_dir / "other.mkv"
+    other.write_bytes(os.urandom(100_000))
+    assert cache.add(str(agent_dir), "other", str(other)) is not None
+    assert cache.stats()['evictions'] == 0, "pinned sources are not evicted"
+    cache.release(upload_fingerprint)
+    cache.release("other")
+    stats = cache.stats()
+    assert stats['evictions'] == 1 and stats['evicted_bytes'] == 100_000 and stats['files'] == 1
+    assert os.listdir(agent_dir / SourceCache.DIR) == ["other"]
+
+
+def test_agent_waits_for_slot(tmp_path, monkeypatch):
+    monkeypatch.setattr(Runner, "SLOT_NOTICE_SECS", 0.05)
+    src = tmp_path / "source.mkv"
+    src.write_bytes(os.urandom(1000))
+    slots = Semaphore(0)
+
+    controller, agent = socket.socketpair()
+    runner = Runner(agent, "test", 1, slots=slots)
+    runner.start()
+
+    cli = "$".join([sys.executable, "-c", FAKE_FFMPEG, "{FILENAME}"])
+    hello = protocol.offer(f"HELLO|{wandarr.__version__}|{src.stat().st_size}|{tmp_path}|upload.mkv|{cli}")
+    controller.send(hello.encode())
+    controller.recv(4096)
+    protocol.send_frame(controller, protocol.MSG_MONITOR, "0")
+    _upload(controller, src)
+
+    # the client is told it is waiting rather than left to time out
+    assert protocol.recv_frame(controller) == (protocol.MSG_OUTPUT, b"waiting for a free encode slot\n")
+    slots.release()
+    ffmpeg = FFmpeg("ffmpeg")
+    ffmpeg.monitor_interval = 0
+    assert list(ffmpeg.monitor_agent_framed(controller))[-1].startswith("DONE|0|")
+    controller.close()
+    runner.join(timeout=10)
+    # slot handed back, temp files gone
+    assert slots.acquire(blocking=False)
+    assert sorted(os.listdir(tmp_path)) == ["source.mkv"]
+
+
+def test_agent_server_busy(tmp_path):
+    server = Agent(slots=1, queue_size=0, port=0)
+    t = Thread(target=lambda: asyncio.run(server.serve_async()))
+    t.start()
+    while not server.port:
+        time.sleep(0.01)
+
+    with socket.create_connection(("127.0.0.1", server.port)) as s:
+        s.send(b"PING")
+        assert s.recv(4) == b"PONG"
+
+    cli = "$".join([sys.executable, "-c", FAKE_FFMPEG, "{FILENAME}"])
+    hello = f"HELLO|{wandarr.__version__}|1000|{tmp_path}|source.mkv|{cli}"
+    first = socket.create_connection(("127.0.0.1", server.port))
+    first.send(hello.encode())
+    assert first.recv(4096).decode() == hello
+    # the first job holds the only place, so the next is turned away
+    with socket.create_connection(("127.0.0.1", server.port)) as s:
+        s.send(hello.encode())
+        assert s.recv(4096) == b"BUSY"
+
+    fake_ffmpeg = tmp_path / "ffmpeg"
+    fake_ffmpeg.write_text(f"#!{sys.executable}\n{FAKE_ENCODERS}\n")
+    fake_ffmpeg.chmod(0o755)
+    status = query_agent_status("127.0.0.1", str(fake_ffmpeg), str(tmp_path), port=server.port)
+    fake_ffmpeg.unlink()
+    assert status['version'] == wandarr.__version__
+    assert status['encoders'] == ["libx264", "hevc_nvenc"]
+    # still uploading, so not using its encode slot yet
+    assert status['free_slots'] == 1 and status['accepting'] == 0
+    assert [job['file'] for job in status['jobs']] == ["source.mkv"]
+    assert status['jobs'][0]['state'] in ("connected", "receiving")
+    assert status['temp_free'] > 0
+
+    server.stop()
+    t.join(timeout=5)
+    # shutting down drops the job that was still uploading
+    server.shutdown()
+    assert not any(r.is_alive() for r in server.runners)
+    first.close()
+    assert os.listdir(tmp_path) == []
+
+
+def test_pipe_format():
+    assert pipe_format("/media/a.mkv", ".mkv") == "matroska"
+    assert pipe_format("/media/a.TS", ".ts") == "mpegts"
+    # mp4 needs to seek back for its index
+    assert pipe_format("/media/a.mp4", ".mkv") is None
+    assert pipe_format("/media/a.mkv", ".mp4") is None
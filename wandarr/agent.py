@@ -1,18 +1,283 @@
+import asyncio
+import io
+import json
+import queue
+import shutil
+import signal
 import socket
 import os
 import subprocess
 import sys
-from threading import Thread
+import time
+from collections import OrderedDict, deque
+from tempfile import gettempdir
+from threading import Lock, Semaphore, Thread
+from typing import Callable, Dict, List, Optional, Set, Tuple
 
 import wandarr
+from wandarr import protocol
+from wandarr.ffmpeg import FFmpeg
+from wandarr.transfer import send_file, recv_file, send_checked, recv_checked
+
+
+class PartialFiles:
+    """Files of interrupted transfers (protocol 5), kept for a while so a controller that reconnects can
+       carry on where it left off rather than sending or fetching the whole file again
+    """
+
+    def __init__(self, keep_secs: float):
+        self.keep_secs = keep_secs
+        self._files: Dict[Tuple[str, str], Tuple[str, float]] = {}    # (key, "source" or "result") -> (path, expiry)
+        self._lock = Lock()
+
+    def keep(self, key: str, kind: str, path: str):
+        if self.keep_secs <= 0:
+            os.remove(path)
+            return
+        with self._lock:
+            self._files[(key, kind)] = (path, time.monotonic() + self.keep_secs)
+
+    def claim(self, key: str, kind: str) -> Optional[str]:
+        """Take back a kept file, None if there isn't one"""
+        with self._lock:
+            path, _ = self._files.pop((key, kind), (None, 0))
+        return path if path and os.path.exists(path) else None
+
+    def expire(self, everything: bool = False):
+        now = time.monotonic()
+        with self._lock:
+            expired = [entry for entry, (_, expiry) in self._files.items() if everything or expiry <= now]
+            paths = [self._files.pop(entry)[0] for entry in expired]
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def __len__(self):
+        return len(self._files)
+
+
+class SourceCache:
+    """Sources received from controllers, kept in working_dir/wandarr-cache under their content fingerprint
+       so running the same file again with another template or quality doesn't upload it again (protocol 6).
+       The least recently used go once the cache is over capacity, but not while a job is using them.
+    """
+    DIR = "wandarr-cache"
+
+    def __init__(self, capacity: int):
+        """
+        :param capacity:    Bytes of sources to keep, 0 to cache nothing
+        """
+        self.capacity = capacity
+        self._entries: OrderedDict[str, Tuple[str, int]] = OrderedDict()   # fingerprint -> (path, size), oldest first
+        self._pins: Dict[str, int] = {}
+        self._scanned: Set[str] = set()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+
+    def lookup(self, tempdir: str, fingerprint: str) -> Optional[str]:
+        """Path of the cached source, pinned until released, or None if it isn't cached"""
+        if self.capacity <= 0:
+            return None
+        with self._lock:
+            self._scan(tempdir)
+            path, _ = self._entries.get(fingerprint, (None, 0))
+            if path is None or not os.path.exists(path):
+                self._entries.pop(fingerprint, None)
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(fingerprint)
+            self._pins[fingerprint] = self._pins.get(fingerprint, 0) + 1
+        # so the order survives an agent restart
+        os.utime(path)
+        return path
+
+    def add(self, tempdir: str, fingerprint: str, path: str) -> Optional[str]:
+        """Move a received source into the cache, pinned until released. Returns where it is now, or None
+           if it wasn't cached and is left where it was.
+        """
+        size = os.path.getsize(path)
+        if self.capacity <= 0 or size > self.capacity:
+            return None
+        cache_dir = os.path.join(tempdir, self.DIR)
+        os.makedirs(cache_dir, exist_ok=True)
+        with self._lock:
+            self._scan(tempdir)
+            if fingerprint in self._entries:
+                # another job uploaded the same source meanwhile
+                os.remove(path)
+                self._entries.move_to_end(fingerprint)
+            else:
+                cached = os.path.join(cache_dir, fingerprint)
+                os.replace(path, cached)
+                self._entries[fingerprint] = (cached, size)
+            self._pins[fingerprint] = self._pins.get(fingerprint, 0) + 1
+            self._evict()
+            return self._entries[fingerprint][0]
+
+    def release(self, fingerprint: str):
+        with self._lock:
+            self._pins[fingerprint] -= 1
+            if not self._pins[fingerprint]:
+                del self._pins[fingerprint]
+            self._evict()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {'capacity': self.capacity,
+                    'used': sum(size for _, size in self._entries.values()),
+                    'files': len(self._entries),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'evicted_bytes': self.evicted_bytes}
+
+    def _evict(self):
+        used = sum(size for _, size in self._entries.values())
+        for fingerprint in list(self._entries):
+            if used <= self.capacity:
+                break
+            if self._pins.get(fingerprint):
+                continue
+            path, size = self._entries.pop(fingerprint)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            used -= size
+            self.evictions += 1
+            self.evicted_bytes += size
+
+    def _scan(self, tempdir: str):
+        """Pick up sources an earlier run of the agent cached in this working_dir"""
+        cache_dir = os.path.join(tempdir, self.DIR)
+        if cache_dir in self._scanned:
+            return
+        self._scanned.add(cache_dir)
+        if not os.path.isdir(cache_dir):
+            return
+        found = []
+        for name in os.listdir(cache_dir):
+            path = os.path.join(cache_dir, name)
+            st = os.stat(path)
+            found.append((st.st_mtime, name, path, st.st_size))
+        for _, name, path, size in sorted(found):
+            self._entries.setdefault(name, (path, size))
+        self._evict()
+
+
+class ControlReader(Thread):
+    """Reads control messages from the controller while ffmpeg output is streamed to it (framed protocol only).
+       VETO and STOP kill ffmpeg straight away, source data in streaming mode is fed to ffmpeg, and
+       anything else is queued for the runner.
+    """
+
+    def __init__(self, c, proc, thread_id: int):
+        super().__init__(name=f"Control {thread_id}", daemon=True)
+        self.c = c
+        self.proc = proc
+        self.thread_id = thread_id
+        self.vetoed = False
+        self.replies = queue.Queue()
+        self._input_lock = Lock()
+
+    def run(self):
+        try:
+            while True:
+                mtype, payload = protocol.recv_frame(self.c)
+                if mtype in (protocol.MSG_VETO, protocol.MSG_STOP):
+                    reason = "vetoed" if mtype == protocol.MSG_VETO else "stopped"
+                    print(f"[{self.thread_id}] Client {reason} the transcode, cleaning up")
+                    self.abandon()
+                elif mtype == protocol.MSG_INPUT:
+                    self.write_input(payload)
+                elif mtype == protocol.MSG_INPUT_END:
+                    self.close_input()
+                else:
+                    self.replies.put(mtype)
+        except (OSError, ConnectionError):
+            # controller went away - nobody is left to collect the result
+            if self.proc.poll() is None:
+                print(f"[{self.thread_id}] Lost connection to client, cleaning up")
+                self.abandon()
+            self.replies.put(None)
+
+    def write_input(self, data: bytes):
+        with self._input_lock:
+            if self.proc.stdin.closed:
+                # ffmpeg stopped reading, drain the rest of the source
+                return
+            try:
+                self.proc.stdin.write(data)
+                self.proc.stdin.flush()
+            except OSError:
+                # ffmpeg exited early, the runner reports the error
+                self._close_stdin()
+
+    def close_input(self):
+        with self._input_lock:
+            self._close_stdin()
+
+    def _close_stdin(self):
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+
+    def abandon(self):
+        self.vetoed = True
+        self.proc.kill()
+
+    def wait_reply(self, timeout: float = 60):
+        try:
+            return self.replies.get(timeout=timeout)
+        except queue.Empty:
+            return None
 
 
 class Runner(Thread):
-    def __init__(self, c, addr, thread_id: int):
+    # how often a framed client waiting for an encode slot is told so, well inside its socket timeout
+    SLOT_NOTICE_SECS = 20
+    # lines of ffmpeg output held back to send if the transcode fails (protocol 7)
+    OUTPUT_LINES = 500
+
+    def __init__(self, c, addr, thread_id: int, offered: str = None, slots: Semaphore = None,
+                 on_exit: Callable = None, partials: PartialFiles = None, cache: SourceCache = None):
+        """
+        :param offered:     HELLO already read from the connection by the server
+        :param slots:       Encode slots shared by all runners, None for no limit
+        :param on_exit:     Called with this runner once the connection is finished with
+        :param partials:    Where interrupted transfers are kept to be resumed, None to always start over
+        :param cache:       Sources kept for later jobs, None not to keep them
+        """
         super().__init__(name=f"Runner {thread_id}", daemon=True)
         self.c = c
         self.addr = addr
         self.thread_id = thread_id
+        self.offered = offered
+        self.slots = slots
+        self.on_exit = on_exit
+        self.partials = partials
+        self.cache = cache
+        self.cached = None      # fingerprint of the cached source in use
+        self.proc: Optional[subprocess.Popen] = None
+        self.holding_slot = False
+        self.stopping = False
+        self.temp_files = []
+        # temp files part way through a transfer, kept on failure if partials are -> (transfer key, kind)
+        self.resumable: Dict[str, Tuple[str, str]] = {}
+        # reported by STATUS
+        self.file = None
+        self.state = "connected"
+        self.progress: Dict = {}
+        # protocol 7 - ffmpeg stats are parsed here and sent as PROGRESS every progress_interval seconds
+        self.progress_interval: Optional[float] = None
+        self.full_log = False
+        self.next_progress = 0.0
+        self.output = deque(maxlen=self.OUTPUT_LINES)
 
     def run(self):
         c = self.c
@@ -26,12 +291,18 @@ class Runner(Thread):
             tmp_filename = None
 
             print(f'[{self.thread_id}]: got connection from addr', self.addr)
-            hello = c.recv(2048).decode()
-            print(f"[{self.thread_id}]", hello)
-            if hello.startswith("PING"):
+            offered = self.offered or c.recv(2048).decode()
+            print(f"[{self.thread_id}]", offered)
+            if offered.startswith("PING"):
                 c.send(bytes("PONG".encode()))
                 c.close()
                 return
+            if offered.startswith("RESUME|"):
+                self.resume_result(c, offered)
+                return
+
+            hello, proto = protocol.accept(offered)
+            framed = proto >= 2
 
             cli_parts = []
             if hello.startswith("HELLO|") | hello.startswith("HELLOS|"):
@@ -52,12 +323,7 @@ class Runner(Thread):
                     filename = parts[4]
                     cli = parts[5]
                     tmp_filename = os.path.join(tempdir, filename + ".tmp")
-
-                    output_filename = self.receive_file(filesize, tempdir, filename, c)
-
-                    cli = cli.replace(r"{FILENAME}", output_filename)
-                    cli_parts = cli.split(r"$")
-                    cli_parts.append(tmp_filename)
+                    self.file = filename
 
                 elif parts[0] == "HELLOS":
                     has_sharing = True
@@ -67,6 +333,7 @@ class Runner(Thread):
                     shared_out_path = parts[3]
                     cli = parts[4]
                     keep_source = parts[5] == '1'
+                    self.file = os.path.basename(shared_in_path)
                     cli_parts = cli.split(r"$")
 
                     # do some verifications first
@@ -82,8 +349,9 @@ class Runner(Thread):
                     c.send(bytes(f"NAK|{error}".encode()))
                     return
 
-                print(f"[{self.thread_id}] echoing back hello")
-                c.send(bytes(hello.encode()))
+                print(f"[{self.thread_id}] echoing back hello (protocol {proto})")
+                reply = offered if offered == hello else protocol.accepted_reply(offered, proto)
+                c.send(bytes(reply.encode()))
 
                 if not upstream_version:
                     print("** Your client version of wandarr needs to be updated.")
@@ -92,9 +360,44 @@ class Runner(Thread):
                 if upstream_version != wandarr.__version__:
                     print(f"** WARNING: Your client wandarr is version {upstream_version} and this host is on {wandarr.__version__}. There may be incompatibilities.")
 
+                if proto >= 7:
+                    self.monitor_options(c)
+
+                mode = protocol.MSG_UPLOAD
+                key = None
+                fingerprint = None
+                if not has_sharing and proto >= 3:
+                    mode, payload = protocol.recv_frame(c)
+                    if mode == protocol.MSG_STREAM:
+                        # no temp files, source and result are streamed through ffmpeg
+                        self.stream_transcode(c, cli, payload.decode())
+                        return
+                    if proto >= 5:
+                        key, _, fingerprint = payload.decode().partition("|")
+
+                if not has_sharing:
+                    # client sends the file once it has our reply, both it and the result go when we're done
+                    self.temp_files = [os.path.join(tempdir, filename), tmp_filename]
+                    if key:
+                        try:
+                            output_filename = self.obtain_source(filesize, tempdir, filename, c, key, fingerprint)
+                        except ValueError as ex:
+                            print(f"[{self.thread_id}] {ex}")
+                            self.reply(c, framed, protocol.MSG_ERR, f"ERR|{ex}")
+                            return
+                    else:
+                        output_filename = self.receive_file(filesize, tempdir, filename, c)
+                    if mode == protocol.MSG_PREFETCH and not self.wait_start(c):
+                        print(f"[{self.thread_id}] Client abandoned the prefetched job, cleaning up")
+                        return
+                    cli = cli.replace(r"{FILENAME}", output_filename)
+                    cli_parts = cli.split(r"$")
+                    cli_parts.append(tmp_filename)
+
                 #
                 # start ffmpeg and pipe output back to wandarr controller for monitoring
                 #
+                self.wait_for_slot(c, framed)
                 print(f"[{self.thread_id}] receive complete - executing " + " ".join(cli_parts))
                 vetoed = False
                 with subprocess.Popen(cli_parts,
@@ -102,55 +405,35 @@ class Runner(Thread):
                                       stderr=subprocess.STDOUT,
                                       universal_newlines=True,
                                       shell=False) as proc:
+                    self.proc = proc
+                    self.state = "encoding"
 
                     if proc.poll() is not None:
                         # terminated too quick, grab the output
                         buf = proc.stdout.readlines()
-                        c.send(bytes(f"ERR|{buf}".encode()))
+                        self.reply(c, framed, protocol.MSG_ERR, f"ERR|{buf}")
                         print(buf)
                         return
 
-                    while proc.poll() is None:
-                        line = proc.stdout.readline()
-
-                        c.send(bytes(line.encode()))
-                        response = c.recv(20)
-
-                        if "video:" in line:
-                            print("video: trigger detected")
-                            # transcode complete
-                            break
-
-                        confirmation = response.decode()
-                        if confirmation == "PING":
-                            # ping received out of context, ignore
-                            continue
-                        if confirmation == "STOP":
-                            proc.kill()
-                            print(f"[{self.thread_id}] Client stopped the transcode, cleaning up")
-                            vetoed = True
-                            break
-                        if confirmation == "VETO":
-                            proc.kill()
-                            print(f"[{self.thread_id}] Client vetoed the transcode, cleaning up")
-                            vetoed = True
-                            break
-                        if confirmation != "ACK!":
-                            proc.kill()
-                            print(f"[{self.thread_id}] Protocol error - expected ACK from client, got {confirmation}")
-                            print("Cleaning up")
-                            vetoed = True
-                            break
-
-                    # wait for process to end
-                    proc.wait()
+                    if framed:
+                        control = ControlReader(c, proc, self.thread_id)
+                        control.start()
+                        self.stream_output(c, proc)
+                        proc.wait()
+                        vetoed = control.vetoed
+                    else:
+                        control = None
+                        vetoed = self.lockstep_output(c, proc)
+                        # wait for process to end
+                        proc.wait()
 
                     print(f"[{self.thread_id}] ffmpeg exit with code {proc.returncode}")
 
                     if not vetoed:
                         if proc.returncode != 0:
                             print(f"[{self.thread_id}] Error returned from ffmpeg. Try running manually to troubleshoot")
-                            c.send(bytes(f"ERR|{proc.returncode}".encode()))
+                            self.send_output(lambda mtype, payload: protocol.send_frame(c, mtype, payload))
+                            self.reply(c, framed, protocol.MSG_ERR, f"ERR|{proc.returncode}")
                             print(f"[{self.thread_id}] Cleaning up")
                         else:
                             print(f"[{self.thread_id}] > DONE")
@@ -158,24 +441,30 @@ class Runner(Thread):
                             if not has_sharing:
                                 # send the results back to the client
                                 filesize = os.path.getsize(tmp_filename)
-                                c.send(bytes(f"DONE|{proc.returncode}|{filesize}".encode()))
-                                response = c.recv(4).decode()
-                                if response == "ACK!":
+                                self.reply(c, framed, protocol.MSG_DONE, f"DONE|{proc.returncode}|{filesize}")
+                                if framed:
+                                    acked = control.wait_reply() == protocol.MSG_ACK
+                                else:
+                                    acked = c.recv(4).decode() == "ACK!"
+                                if acked:
                                     # send the file back
                                     print(f"[{self.thread_id}] sending transcoded file")
-                                    with open(tmp_filename, "rb") as input_file:
-                                        blk = input_file.read(100_000)
-                                        while len(blk) > 0:
-                                            c.send(blk)
-                                            blk = input_file.read(100_000)
+                                    self.state = "sending"
+                                    if key:
+                                        self.send_result(c, control, tmp_filename, key)
+                                    else:
+                                        send_file(c, tmp_filename)
                                     print(f"[{self.thread_id}] done")
                                 else:
-                                    print(f"[{self.thread_id}] expected ACK, got {response}")
+                                    print(f"[{self.thread_id}] expected ACK from client")
                             else:
                                 # send the results back to the client
                                 filesize = os.path.getsize(shared_out_path)
-                                c.send(bytes(f"DONE|{proc.returncode}|{filesize}".encode()))
-                                response = c.recv(4).decode()
+                                self.reply(c, framed, protocol.MSG_DONE, f"DONE|{proc.returncode}|{filesize}")
+                                if framed:
+                                    control.wait_reply()
+                                else:
+                                    c.recv(4)
                                 # file is on a share, so just rename in place
                                 if not keep_source:
                                     os.remove(shared_in_path)
@@ -183,44 +472,459 @@ class Runner(Thread):
                     else:
                         print(f"[{self.thread_id}] veto")
 
-                    if not has_sharing:
-                        if tmp_filename:
-                            os.remove(tmp_filename)
-                        if output_filename:
-                            os.remove(output_filename)
-
         except Exception as ex:
             print(str(ex))
-
-        c.close()
+        finally:
+            self.release_slot()
+            if self.cached:
+                self.cache.release(self.cached)
+            for path in self.temp_files:
+                if not os.path.exists(path):
+                    continue
+                if self.partials is not None and path in self.resumable:
+                    print(f"[{self.thread_id}] keeping {os.path.basename(path)} to resume the transfer")
+                    self.partials.keep(*self.resumable[path], path)
+                else:
+                    os.remove(path)
+            c.close()
+            if self.on_exit:
+                self.on_exit(self)
+
+    def wait_for_slot(self, c, framed: bool):
+        """Block until an encode slot is free. A framed client is kept informed so it doesn't time out."""
+        if self.slots is None:
+            return
+        self.state = "waiting"
+        while not self.slots.acquire(timeout=self.SLOT_NOTICE_SECS):
+            if self.stopping:
+                raise ConnectionError("agent shutting down")
+            print(f"[{self.thread_id}] waiting for a free encode slot")
+            if framed:
+                protocol.send_frame(c, protocol.MSG_OUTPUT, "waiting for a free encode slot\n")
+        self.holding_slot = True
+
+    def release_slot(self):
+        if self.holding_slot:
+            self.holding_slot = False
+            self.slots.release()
+
+    @staticmethod
+    def drain(c):
+        """Discard whatever the client is still sending until it hangs up, so our last reply isn't lost to a reset"""
+        try:
+            c.shutdown(socket.SHUT_WR)
+            c.settimeout(30)
+            while c.recv(protocol.STREAM_CHUNK):
+                pass
+        except OSError:
+            pass
+
+    def abandon(self):
+        """Agent is shutting down - kill ffmpeg and drop the client"""
+        self.stopping = True
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.kill()
+        try:
+            self.c.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    @staticmethod
+    def reply(c, framed: bool, mtype: int, message: str):
+        if framed:
+            protocol.send_frame(c, mtype, message)
+        else:
+            c.send(bytes(message.encode()))
+
+    def stream_output(self, c, proc):
+        """Framed protocol - pass on ffmpeg output as it comes, control messages are handled by ControlReader"""
+        try:
+            for line in proc.stdout:
+                self.relay(lambda mtype, payload: protocol.send_frame(c, mtype, payload), line)
+        except OSError:
+            # client has gone, ControlReader will kill ffmpeg
+            pass
+
+    def monitor_options(self, c):
+        """Protocol 7 - how often the client wants progress, and whether it wants the ffmpeg output as well"""
+        mtype, payload = protocol.recv_frame(c)
+        if mtype != protocol.MSG_MONITOR:
+            raise ConnectionError(f"expected monitor options from client, got message type {mtype}")
+        interval, _, option = payload.decode().partition("|")
+        self.progress_interval = max(0.0, float(interval))
+        self.full_log = option == "log"
+
+    def relay(self, send: Callable, line: str):
+        """Pass a line of ffmpeg output to the client. From protocol 7 stats lines become PROGRESS messages at the
+           interval asked for, and the output is only sent if asked for - otherwise it's held in case of error.
+        """
+        info = self.track(line)
+        if self.progress_interval is None or self.full_log:
+            send(protocol.MSG_OUTPUT, line)
+        if self.progress_interval is None:
+            return
+        if not self.full_log:
+            self.output.append(line)
+        now = time.monotonic()
+        if info is not None and now >= self.next_progress:
+            self.next_progress = now + self.progress_interval
+            send(protocol.MSG_PROGRESS, json.dumps(info))
+
+    def send_output(self, send: Callable):
+        """Protocol 7 - ffmpeg output held back, sent before an error is reported"""
+        while self.output:
+            send(protocol.MSG_OUTPUT, self.output.popleft())
+
+    def track(self, line: str) -> Optional[Dict]:
+        info = FFmpeg.parse_status(line)
+        if info is not None:
+            self.progress = info
+        return info
+
+    def describe(self) -> Dict:
+        """This job for STATUS"""
+        return {'id': self.thread_id, 'client': str(self.addr[0]) if isinstance(self.addr, tuple) else str(self.addr),
+                'file': self.file, 'state': self.state, 'time': self.progress.get('time'),
+                'fps': self.progress.get('fps'), 'speed': self.progress.get('speed')}
+
+    def wait_start(self, c) -> bool:
+        """Prefetch mode - confirm the source is staged and hold it until the client says to start"""
+        self.state = "staged"
+        protocol.send_frame(c, protocol.MSG_STAGED)
+        print(f"[{self.thread_id}] source staged, waiting for client to start the transcode")
+        try:
+            mtype, _ = protocol.recv_frame(c)
+        except (OSError, ConnectionError):
+            return False
+        return mtype == protocol.MSG_START
+
+    def stream_transcode(self, c, cli: str, output_format: str):
+        """Streaming mode - ffmpeg reads the source from the client as it arrives (pipe:0) and writes the
+           result to pipe:1, which is sent straight back while encoding continues
+        """
+        cli_parts = cli.replace(r"{FILENAME}", "pipe:0").split(r"$")
+        cli_parts.extend(["-f", output_format, "pipe:1"])
+        sender = protocol.FrameSender(c)
+        if self.slots is not None:
+            # the source is already on its way, so there is no waiting for a slot
+            if not self.slots.acquire(blocking=False):
+                print(f"[{self.thread_id}] no free encode slot for streaming job, client told busy")
+                sender.send(protocol.MSG_ERR, "BUSY")
+                self.drain(c)
+                return
+            self.holding_slot = True
+        print(f"[{self.thread_id}] streaming - executing " + " ".join(cli_parts))
+        with subprocess.Popen(cli_parts,
+                              stdin=subprocess.PIPE,
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE,
+                              shell=False) as proc:
+            self.proc = proc
+            self.state = "encoding"
+            control = ControlReader(c, proc, self.thread_id)
+            control.start()
+            progress = Thread(target=self.stream_progress, args=(sender, proc), daemon=True)
+            progress.start()
+
+            filesize = 0
+            try:
+                while chunk := proc.stdout.read1(protocol.STREAM_CHUNK):
+                    sender.send(protocol.MSG_RESULT, chunk)
+                    filesize += len(chunk)
+            except OSError:
+                # client has gone, ControlReader will kill ffmpeg
+                pass
+            proc.wait()
+            progress.join()
+            control.close_input()
+
+        print(f"[{self.thread_id}] ffmpeg exit with code {proc.returncode}")
+        if control.vetoed:
+            print(f"[{self.thread_id}] veto")
+        elif proc.returncode != 0:
+            print(f"[{self.thread_id}] Error returned from ffmpeg. Try running manually to troubleshoot")
+            self.send_output(sender.send)
+            sender.send(protocol.MSG_ERR, f"ERR|{proc.returncode}")
+        else:
+            print(f"[{self.thread_id}] > DONE, streamed {filesize} bytes")
+            sender.send(protocol.MSG_DONE, f"DONE|{proc.returncode}|{filesize}")
+
+    def stream_progress(self, sender: protocol.FrameSender, proc):
+        """Streaming mode - ffmpeg progress comes from stderr since stdout carries the encoded file"""
+        try:
+            for line in io.TextIOWrapper(proc.stderr, errors="replace"):
+                self.relay(sender.send, line)
+        except OSError:
+            pass
+
+    def lockstep_output(self, c, proc) -> bool:
+        """Original protocol - send each line of ffmpeg output and wait for the client to acknowledge it.
+           Returns True if the transcode was vetoed or stopped.
+        """
+        while proc.poll() is None:
+            line = proc.stdout.readline()
+            self.track(line)
+
+            c.send(bytes(line.encode()))
+            response = c.recv(20)
+
+            if "video:" in line:
+                print("video: trigger detected")
+                # transcode complete
+                break
+
+            confirmation = response.decode()
+            if confirmation == "PING":
+                # ping received out of context, ignore
+                continue
+            if confirmation == "STOP":
+                proc.kill()
+                print(f"[{self.thread_id}] Client stopped the transcode, cleaning up")
+                return True
+            if confirmation == "VETO":
+                proc.kill()
+                print(f"[{self.thread_id}] Client vetoed the transcode, cleaning up")
+                return True
+            if confirmation != "ACK!":
+                proc.kill()
+                print(f"[{self.thread_id}] Protocol error - expected ACK from client, got {confirmation}")
+                print("Cleaning up")
+                return True
+        return False
 
     def receive_file(self, filesize: int, tempdir: str, filename: str, c) -> str:
 
         print(f"[{self.thread_id}] receiving {filesize} bytes to {filename}...")
+        self.state = "receiving"
         output_filename = os.path.join(tempdir, filename)
+        recv_file(c, output_filename, filesize)
+        return output_filename
 
-        with open(output_filename, "wb") as f:
-            while filesize > 0:
-                chunk = c.recv(min(4096, filesize))
-                if len(chunk) == 0:
-                    break
-                filesize -= len(chunk)
-                f.write(chunk)
+    def obtain_source(self, filesize: int, tempdir: str, filename: str, c, key: str, fingerprint: str) -> str:
+        """Protocol 5 and up - the source from the cache if it's there, otherwise uploaded and then cached"""
+        if self.cache is not None and fingerprint:
+            cached = self.cache.lookup(tempdir, fingerprint)
+            if cached:
+                print(f"[{self.thread_id}] using cached copy of {filename}")
+                self.cached = fingerprint
+                protocol.send_frame(c, protocol.MSG_CACHED)
+                return cached
+        output_filename = self.receive_checked(filesize, tempdir, filename, c, key)
+        if self.cache is not None and fingerprint:
+            cached = self.cache.add(tempdir, fingerprint, output_filename)
+            if cached:
+                self.cached = fingerprint
+                return cached
         return output_filename
 
+    def receive_checked(self, filesize: int, tempdir: str, filename: str, c, key: str) -> str:
+        """Protocol 5 - tell the controller how much of the source is here from an interrupted upload,
+           receive the rest and check it arrived intact
+        """
+        output_filename = os.path.join(tempdir, filename)
+        offset = 0
+        kept = self.partials.claim(key, "source") if self.partials is not None else None
+        if kept == output_filename and os.path.getsize(kept) <= filesize:
+            offset = os.path.getsize(kept)
+        elif kept:
+            os.remove(kept)
+        resuming = f", resuming at {offset}" if offset else ""
+        print(f"[{self.thread_id}] receiving {filesize} bytes to {filename}{resuming}...")
+        self.state = "receiving"
+        self.resumable[output_filename] = (key, "source")
+        protocol.send_frame(c, protocol.MSG_OFFSET, str(offset))
+        recv_checked(c, output_filename, filesize, offset)
+        del self.resumable[output_filename]
+        return output_filename
+
+    def send_result(self, c, control: ControlReader, path: str, key: str, offset: int = 0):
+        """Protocol 5 - send the result with its checksum. It is kept to resume from until the controller
+           confirms it arrived.
+        """
+        self.resumable[path] = (key, "result")
+        send_checked(c, path, offset)
+        confirmed = control.wait_reply() if control else protocol.recv_frame(c)[0]
+        if confirmed == protocol.MSG_ACK:
+            del self.resumable[path]
+
+    def resume_result(self, c, request: str):
+        """Carry on sending a result whose transfer broke off - RESUME|transfer key|offset"""
+        _, key, offset = request.split("|")
+        path = self.partials.claim(key, "result") if self.partials is not None else None
+        if path is None:
+            print(f"[{self.thread_id}] no result kept to resume")
+            protocol.send_frame(c, protocol.MSG_ERR, "ERR|nothing to resume")
+            return
+        self.temp_files = [path]
+        self.file = os.path.basename(path)
+        self.state = "sending"
+        filesize = os.path.getsize(path)
+        print(f"[{self.thread_id}] resuming {self.file} at {offset} of {filesize} bytes")
+        protocol.send_frame(c, protocol.MSG_DONE, f"DONE|0|{filesize}")
+        self.send_result(c, None, path, key, int(offset))
+
 
 class Agent:
     PORT = 9567
+    # connections that don't send their HELLO within this many seconds are dropped
+    HELLO_TIMEOUT = 30
+    # how often kept partial transfers are checked for expiry
+    EXPIRE_INTERVAL = 60
+
+    def __init__(self, slots: int = 2, queue_size: int = 4, port: int = None, keep_partial: float = 600,
+                 cache_size: int = 0):
+        """
+        :param slots:           Maximum concurrent transcodes
+        :param queue_size:      Jobs allowed to upload or wait for a slot beyond those. Any more are told BUSY.
+        :param port:            Port to listen on, default PORT
+        :param keep_partial:    Seconds to keep the files of interrupted transfers for the controller to resume, 0 not to
+        :param cache_size:      Bytes of received sources to keep for later jobs, 0 not to keep any
+        """
+        self.slots = slots
+        self.queue_size = queue_size
+        self.port = self.PORT if port is None else port
+        self.encode_slots = Semaphore(slots)
+        self.partials = PartialFiles(keep_partial)
+        self.cache = SourceCache(cache_size)
+        self.runners: Set[Runner] = set()
+        self.thread_count = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stopping: Optional[asyncio.Event] = None
+        self._tasks = set()
+        self._encoders: Dict[str, List[str]] = {}   # ffmpeg path -> encoders, discovered once
 
     def serve(self):
+        try:
+            asyncio.run(self.serve_async())
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        finally:
+            self.shutdown()
+
+    async def serve_async(self):
+        self._loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                self._loop.add_signal_handler(sig, self._stopping.set)
+            except (NotImplementedError, RuntimeError, ValueError):
+                # not on Windows or outside the main thread - ctrl-c interrupts asyncio.run instead
+                pass
+
         s = socket.socket()
-        s.bind(("", self.PORT))
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind(("", self.port))
         s.listen(10)
-        thread_count = 1
+        s.setblocking(False)
+        self.port = s.getsockname()[1]
+        print(f"listening on port {self.port} with {self.slots} encode slots and room for {self.queue_size} more jobs...")
+        accepting = asyncio.create_task(self.accept(s))
+        expiring = asyncio.create_task(self.expire_partials())
+        await self._stopping.wait()
+        accepting.cancel()
+        expiring.cancel()
+        s.close()
+
+    def stop(self):
+        """Ask a running server to shut down, from any thread"""
+        if self._loop is not None and self._stopping is not None:
+            self._loop.call_soon_threadsafe(self._stopping.set)
+
+    async def accept(self, s: socket.socket):
+        while True:
+            c, addr = await self._loop.sock_accept(s)
+            task = asyncio.create_task(self.admit(c, addr))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
 
+    async def expire_partials(self):
         while True:
-            print(f"listening on port {self.PORT}...")
-            c, addr = s.accept()
-            print(f"thread {thread_count} start")
-            Runner(c, addr, thread_count).start()
-            thread_count += 1
+            await asyncio.sleep(self.EXPIRE_INTERVAL)
+            self.partials.expire()
+
+    async def admit(self, c: socket.socket, addr):
+        """Read the opening message and either answer it here or hand the job to a Runner thread"""
+        try:
+            offered = (await asyncio.wait_for(self._loop.sock_recv(c, 2048), self.HELLO_TIMEOUT)).decode()
+            if offered.startswith("PING"):
+                await self._loop.sock_sendall(c, bytes("PONG".encode()))
+                c.close()
+                return
+            if offered.startswith("STATUS"):
+                # STATUS|ffmpeg path|temp dir, both optional
+                fields = offered.split("|")
+                ffmpeg_path = fields[1] if len(fields) > 1 and fields[1] else "ffmpeg"
+                tempdir = fields[2] if len(fields) > 2 and fields[2] else gettempdir()
+                status = await self.status(ffmpeg_path, tempdir)
+                await self._loop.sock_sendall(c, json.dumps(status).encode())
+                c.close()
+                return
+            # resuming a result doesn't add a job, so it is never turned away
+            if len(self.runners) >= self.slots + self.queue_size and not offered.startswith("RESUME|"):
+                print(f"busy - {len(self.runners)} jobs running or waiting, turning away {addr}")
+                await self._loop.sock_sendall(c, bytes("BUSY".encode()))
+                c.close()
+                return
+        except (OSError, asyncio.TimeoutError):
+            c.close()
+            return
+
+        self.thread_count += 1
+        c.setblocking(True)
+        runner = Runner(c, addr, self.thread_count, offered=offered, slots=self.encode_slots, on_exit=self._exited,
+                        partials=self.partials, cache=self.cache)
+        self.runners.add(runner)
+        print(f"thread {self.thread_count} start, {len(self.runners)} jobs running or waiting")
+        runner.start()
+
+    async def status(self, ffmpeg_path: str, tempdir: str) -> Dict:
+        """What this agent can do and is doing, for controllers to decide where to send work"""
+        if ffmpeg_path not in self._encoders:
+            try:
+                self._encoders[ffmpeg_path] = await asyncio.to_thread(FFmpeg(ffmpeg_path).encoders)
+            except (OSError, subprocess.SubprocessError) as ex:
+                print(f"cannot list encoders of {ffmpeg_path}: {ex}")
+                self._encoders[ffmpeg_path] = []
+        runners = list(self.runners)
+        encoding = len([r for r in runners if r.holding_slot])
+        try:
+            load_average = list(os.getloadavg())
+        except (AttributeError, OSError):
+            # not available on Windows
+            load_average = None
+        try:
+            temp_free = shutil.disk_usage(tempdir).free
+        except OSError:
+            temp_free = None
+        return {'version': wandarr.__version__,
+                'protocol': protocol.PROTOCOL_VERSION,
+                'encoders': self._encoders[ffmpeg_path],
+                'slots': self.slots,
+                'free_slots': max(0, self.slots - encoding),
+                'accepting': max(0, self.slots + self.queue_size - len(runners)),
+                'jobs': [r.describe() for r in runners],
+                'load_average': load_average,
+                'temp_dir': tempdir,
+                'temp_free': temp_free,
+                'partial_transfers': len(self.partials),
+                'cache': self.cache.stats()}
+
+    def _exited(self, runner: Runner):
+        # runner thread has finished - let the loop account for it
+        try:
+            self._loop.call_soon_threadsafe(self.runners.discard, runner)
+        except RuntimeError:
+            # loop already closed during shutdown
+            self.runners.discard(runner)
+
+    def shutdown(self):
+        """Kill any running transcodes and wait for their threads to clean up"""
+        runners = list(self.runners)
+        if runners:
+            print(f"shutting down, stopping {len(runners)} jobs")
+        for runner in runners:
+            runner.abandon()
+        for runner in runners:
+            runner.join(timeout=10)
+        # nobody will be back for these once the agent has gone
+        self.partials.expire(everything=True)
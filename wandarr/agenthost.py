@@ -1,30 +1,57 @@
 import datetime
+import json
 import os
 import traceback
-from queue import Queue
 import socket
+import time
+from threading import Thread
+from typing import Dict, List, Optional, Tuple
 
 import wandarr
+from wandarr import protocol
 from wandarr.agent import Agent
-from wandarr.base import ManagedHost, RemoteHostProperties, EncodeJob
+from wandarr.base import ManagedHost, RemoteHostProperties, EncodeJob, pipe_format
+from wandarr.scheduler import Scheduler
+from wandarr.transfer import send_file, recv_file, send_checked, recv_checked, transfer_key, fingerprint
+
+
+def query_agent_status(ip: str, ffmpeg_path: str = None, tmpdir: str = None, port: int = Agent.PORT,
+                       timeout: float = 10) -> Optional[Dict]:
+    """Ask an agent what it can do and is doing. None if it can't be reached or is too old to answer."""
+    try:
+        with socket.create_connection((ip, port), timeout=timeout) as s:
+            s.send(bytes(f"STATUS|{ffmpeg_path or ''}|{tmpdir or ''}".encode()))
+            buf = bytearray()
+            while chunk := s.recv(65536):
+                buf.extend(chunk)
+        return json.loads(buf.decode()) if buf else None
+    except (OSError, ValueError):
+        return None
 
 
 class AgentManagedHost(ManagedHost):
     """Implementation of an agent host worker thread"""
 
-    def __init__(self, hostname, props: RemoteHostProperties, queue: Queue):
-        super().__init__(hostname, props, queue)
+    SOCKET_TIMEOUT = 60
+    # handshake result when the agent has no room for another job
+    BUSY = -1
+    # connections tried for a file transfer that keeps breaking off (protocol 5), and the pause before reconnecting
+    RESUME_ATTEMPTS = 3
+    RESUME_DELAY = 5
+
+    def __init__(self, hostname, props: RemoteHostProperties, scheduler: Scheduler):
+        super().__init__(hostname, props, scheduler)
 
         self.remote_in_path = None
         self.remote_out_path = None
+        self._staging: Optional[StagedUpload] = None     # next job's source being uploaded
+        self._ready: Optional[StagedUpload] = None       # staged source of the job just handed out
 
     #
-    # override the standard ssh-based host_ok for agent verification
+    # override the standard ssh-based host_ok for agent verification. Connecting to the agent port
+    # doubles as the reachability test.
     #
     def host_ok(self):
-        if not super().ping_test_ok():
-            return False
-
         s = socket.socket()
         s.settimeout(2)
         try:
@@ -42,6 +69,8 @@ class AgentManagedHost(ManagedHost):
             else:
                 print(str(ex))
                 print(f"Agent not running on {self.props.ip}")
+        finally:
+            s.close()
         return False
 
     #
@@ -54,163 +83,445 @@ class AgentManagedHost(ManagedHost):
     # normal threaded entry point
     #
     def run(self):
-        if self.host_ok():
-            self.go()
-        else:
+        if not self.host_ok():
             self.log(f"{self.props.name} not available")
+            self.scheduler.retire(self.worker_name)
+            return
+        status = self.agent_status()
+        if status is not None and not self.use_encoders(status.get('encoders')):
+            self.scheduler.retire(self.worker_name)
+            return
+        self.go()
+
+    def agent_status(self) -> Optional[Dict]:
+        return query_agent_status(self.props.ip, self.props.ffmpeg_path, self.props.working_dir)
+
+    def use_encoders(self, encoders: List[str]) -> bool:
+        """Stop taking qualities that need a video encoder the agent's ffmpeg doesn't have.
+           Returns False if that leaves nothing this thread can do.
+        """
+        if not encoders:
+            return True
+        usable = {}
+        for quality, cli in self.qualities.items():
+            missing = [enc for enc in self.ffmpeg.video_encoders(cli) if enc not in encoders]
+            if missing:
+                self.log(f"agent ffmpeg has no {', '.join(missing)} encoder - not taking {quality} jobs on {self.engine_name}",
+                         style="magenta")
+            else:
+                usable[quality] = cli
+        if len(usable) < len(self.qualities):
+            self.qualities = usable
+            self.scheduler.register(self.worker_name, usable.keys(), self.hostname, self.engine_name)
+        return len(usable) > 0
+
+    def agent_ready(self, job: EncodeJob, has_sharing: bool) -> bool:
+        """Check the agent has room for the job before sending it, deferring or failing it if not"""
+        status = self.agent_status()
+        if status is None:
+            # older agent, just try it
+            return True
+        if not status.get('accepting', 1):
+            self.job_deferred(job)
+            return False
+        streamable = self.props.pipe and pipe_format(job.in_path, job.template.extension())
+        temp_free = status.get('temp_free')
+        if not has_sharing and not streamable and temp_free is not None:
+            # room for the source and the encoded result, assuming it isn't bigger
+            needed = 2 * os.path.getsize(job.in_path)
+            if temp_free < needed:
+                self.job_failed(job, f"only {int(temp_free / (1024 * 1024))}mb free in agent temp dir {status.get('temp_dir')}")
+                return False
+        return True
 
-    def handshake(self, s: socket.socket, hello: str) -> bool:
+    def handshake(self, s: socket.socket, hello: str) -> int:
+        """Send the job details and negotiate the protocol. Returns the protocol version agreed, 0 if refused
+           or BUSY if the agent has no room for the job right now.
+        """
         if wandarr.VERBOSE:
             self.log("handshaking with remote agent", style="info")
+        hello = protocol.offer(hello)
         s.send(bytes(hello.encode()))
-        rsp = s.recv(1024).decode()
+        rsp = s.recv(4096).decode()
+        if rsp == "BUSY":
+            return self.BUSY
         if rsp.startswith("NAK"):
             self.log(rsp[4:])
-            return False
-        if rsp != hello:
+            return 0
+        version = protocol.negotiated(hello, rsp)
+        if not version:
             self.log("Received unexpected response from agent: " + rsp, style="magenta")
-            return False
-        return True
+        elif wandarr.VERBOSE:
+            self.log(f"agent protocol version {version}")
+        if version >= 7:
+            # the agent parses the stats and only sends them as often as we look at them
+            protocol.send_frame(s, protocol.MSG_MONITOR,
+                                f"{self.ffmpeg.monitor_interval}{'|log' if wandarr.VERBOSE else ''}")
+        return version
+
+    def sendfile(self, s: socket.socket, in_path: str, proto: int = 1):
+        if proto < 5:
+            send_file(s, in_path)
+            return
+        mtype, payload = protocol.recv_frame(s)
+        if mtype == protocol.MSG_CACHED:
+            if wandarr.VERBOSE:
+                self.log(f"agent already has {os.path.basename(in_path)}, not uploading")
+            return
+        if mtype != protocol.MSG_OFFSET:
+            raise ConnectionError(f"expected upload offset from agent, got message type {mtype}")
+        offset = int(payload)
+        if offset and wandarr.VERBOSE:
+            self.log(f"resuming upload at {offset} bytes")
+        send_checked(s, in_path, offset)
+
+    def upload(self, s: socket.socket, job: EncodeJob, hello: str, mode: int, proto: int) -> socket.socket:
+        """Send the source to the agent. From protocol 5 a dropped connection is reopened and the upload
+           carries on from what the agent already has. Returns the connection the upload finished on.
+        """
+        attempt = 1
+        while True:
+            try:
+                self.sendfile(s, job.in_path, proto)
+                return s
+            except OSError as ex:
+                if proto < 5 or attempt >= self.RESUME_ATTEMPTS:
+                    raise
+                self.log(f"upload of {os.path.basename(job.in_path)} interrupted ({ex}), reconnecting", style="magenta")
+                s.close()
+                time.sleep(self.RESUME_DELAY)
+                attempt += 1
+                s = socket.socket()
+                self.connect(s)
+                proto = self.handshake(s, hello)
+                if proto < 5:
+                    s.close()
+                    raise ConnectionError("agent did not take the job back to resume the upload")
+                protocol.send_frame(s, mode, self.upload_id(job.in_path, proto))
+
+    @staticmethod
+    def upload_id(in_path: str, proto: int) -> str:
+        """UPLOAD and PREFETCH payload - the transfer key to resume by (v5) and the content fingerprint
+           the agent may have cached the source under (v6)
+        """
+        if proto >= 6:
+            return f"{transfer_key(in_path)}|{fingerprint(in_path)}"
+        return transfer_key(in_path) if proto >= 5 else ""
+
+    def recvfile(self, s: socket.socket, filesize: int, tmp_file: str, key: str = None):
+        """Receive the transcoded file. From protocol 5 (given the job's transfer key) it is checked, and a
+           dropped connection is reopened to fetch the rest.
+        """
+        if key is None:
+            recv_file(s, tmp_file, filesize)
+            return
+        attempt = 1
+        while True:
+            try:
+                if attempt == 1:
+                    recv_checked(s, tmp_file, filesize)
+                    protocol.send_frame(s, protocol.MSG_ACK)
+                else:
+                    offset = os.path.getsize(tmp_file) if os.path.exists(tmp_file) else 0
+                    if wandarr.VERBOSE:
+                        self.log(f"resuming download at {offset} bytes")
+                    with socket.socket() as rs:
+                        self.connect(rs)
+                        rs.send(bytes(f"RESUME|{key}|{offset}".encode()))
+                        mtype, payload = protocol.recv_frame(rs)
+                        if mtype != protocol.MSG_DONE:
+                            raise ConnectionError(f"agent cannot resume: {payload.decode()}")
+                        recv_checked(rs, tmp_file, filesize, offset)
+                        protocol.send_frame(rs, protocol.MSG_ACK)
+                return
+            except OSError as ex:
+                if attempt >= self.RESUME_ATTEMPTS:
+                    raise
+                self.log(f"download of {os.path.basename(tmp_file)} interrupted ({ex}), reconnecting", style="magenta")
+                # let the agent see the old connection go so it keeps the file for us
+                s.close()
+                time.sleep(self.RESUME_DELAY)
+                attempt += 1
 
-    def sendfile(self, s: socket.socket, in_path: str):
-        with open(in_path, "rb") as f:
-            while True:
-                buf = f.read(4096)
-                s.send(buf)
-                if len(buf) < 4096:
-                    break
-
-    def recvfile(self, s: socket.socket, filesize: int, tmp_file: str):
-        with open(tmp_file, "wb") as out:
-            while filesize > 0:
-                blk = s.recv(1_000_000)
-                out.write(blk)
-                filesize -= len(blk)
+    @staticmethod
+    def feed(sender: protocol.FrameSender, in_path: str):
+        """Streaming mode - send the source to the agent while the encode is monitored"""
+        try:
+            with open(in_path, "rb") as f:
+                while chunk := f.read(protocol.STREAM_CHUNK):
+                    sender.send(protocol.MSG_INPUT, chunk)
+            sender.send(protocol.MSG_INPUT_END)
+        except OSError:
+            # connection closed under us, the monitor reports why
+            pass
+
+    @staticmethod
+    def discard(path: str):
+        if os.path.exists(path):
+            os.remove(path)
 
     def connect(self, s: socket.socket):
         s.connect((self.props.ip, Agent.PORT))
+        # a stalled agent should fail the job rather than hang this thread
+        s.settimeout(self.SOCKET_TIMEOUT)
+
+    def ack(self, s: socket.socket, framed: bool = False):
+        if framed:
+            protocol.send_frame(s, protocol.MSG_ACK)
+        else:
+            s.send(bytes("ACK!".encode()))
+
+    def build_command(self, job: EncodeJob, video_cli: str) -> Tuple[List[str], bool]:
+        """ffmpeg command line for the agent, and whether the agent reads the file from a share rather than being sent it"""
+        in_path = job.in_path
+        video_options = video_cli.split(" ")
+        stream_map = super().map_streams(job)
+        #
+        # if path substitutions were given then the host where the agent resides has access to shared file,
+        # so map the paths same as mountedhost.
+        #
+        if self.props.has_path_subst:
+            out_path = in_path[0:in_path.rfind('.')] + job.template.extension() + '.tmp'
+            self.remote_in_path, self.remote_out_path = self.props.substitute_paths(in_path, out_path)
+            if wandarr.VERBOSE:
+                print(f"substituted {self.remote_in_path} for {in_path}")
+            cmd = [self.props.ffmpeg_path, '-stats_period', '2', '-y', *job.template.input_options_list(), '-i', self.remote_in_path,
+                   *video_options,
+                   *job.template.output_options_list(), *stream_map, self.remote_out_path]
+            return cmd, True
+        # no path mapping, so we're sending the file
+        cmd = [self.props.ffmpeg_path, '-stats_period', '2', '-y', *job.template.input_options_list(), '-i', '{FILENAME}',
+               *video_options,
+               *job.template.output_options_list(), *stream_map]
+        return cmd, False
+
+    def job_hello(self, job: EncodeJob, cmd: List[str], has_sharing: bool) -> str:
+        cmd_str = "$".join(cmd)
+        if has_sharing:
+            return f"HELLOS|{wandarr.__version__}|{self.remote_in_path}|{self.remote_out_path}|{cmd_str}|{'1' if wandarr.KEEP_SOURCE else '0'}"
+        input_size = os.path.getsize(job.in_path)
+        return f"HELLO|{wandarr.__version__}|{input_size}|{self.props.working_dir}|{os.path.basename(job.in_path)}|{cmd_str}"
+
+    #
+    # prefetch - while a job encodes, the source of the next one is uploaded to the agent and
+    # held there, and the result of a finished job is retrieved in the background
+    #
+    def next_job(self) -> Optional[EncodeJob]:
+        self._ready = None
+        if self._staging is not None:
+            stage, self._staging = self._staging, None
+            stage.join()
+            if stage.sock is None:
+                self.log(f"prefetch of {os.path.basename(stage.job.in_path)} failed: {stage.error}", style="magenta")
+                self.scheduler.unstage(self.worker_name, stage.job)
+            elif self.scheduler.start_staged(self.worker_name, stage.job):
+                self.switch_quality(stage.job)
+                self._ready = stage
+                return stage.job
+            else:
+                # host was quarantined, dropping the connection discards the staged file
+                stage.sock.close()
+        return super().next_job()
+
+    def start_prefetch(self, proto: int):
+        if self.props.prefetch < 1 or self.props.has_path_subst or proto < 4 or self._staging is not None:
+            return
+        job = self.scheduler.prefetch(self.worker_name)
+        if job is not None:
+            self._staging = StagedUpload(self, job)
+            self._staging.start()
+
+    def retrieve(self, s: socket.socket, job: EncodeJob, proto: int, filesize: int, tmp_file: str):
+        """Have the agent send the transcoded file and put it in place of the source"""
+        basename = os.path.basename(job.in_path)
+        orig_file_size_mb = int(os.path.getsize(job.in_path) / (1024 * 1024))
+        self.ack(s, proto >= 2)
+        wandarr.status_queue.put({'host': f"{self.hostname}/{self.engine_name}",
+                                  'file': basename,
+                                  'completed': 100,
+                                  'status': 'Retrieving'})
+
+        if wandarr.VERBOSE:
+            self.log(f"receiving ({filesize} bytes)")
+
+        self.recvfile(s, filesize, tmp_file, transfer_key(job.in_path) if proto >= 5 else None)
+        self.replace_source(job, tmp_file, orig_file_size_mb)
+
+    def replace_source(self, job: EncodeJob, tmp_file: str, orig_file_size_mb: int):
+        if not wandarr.KEEP_SOURCE:
+            os.unlink(job.in_path)
+            os.rename(tmp_file, job.in_path)
+            new_filesize_mb = int(os.path.getsize(job.in_path) / (1024 * 1024))
+
+            wandarr.status_queue.put({'host': f"{self.hostname}/{self.engine_name}",
+                                      'file': os.path.basename(job.in_path),
+                                      'completed': 100,
+                                      'status': f'{orig_file_size_mb}mb -> {new_filesize_mb}mb'})
+
+    def retrieve_later(self, s: socket.socket, job: EncodeJob, proto: int, filesize: int, tmp_file: str,
+                       elapsed: int) -> Thread:
+        """Retrieve the result in the background so the next (prefetched) job can start encoding now"""
+        self.scheduler.encode_finished(self.worker_name, job)
+
+        def run():
+            failure = None
+            try:
+                self.retrieve(s, job, proto, filesize, tmp_file)
+                self.complete(job.in_path, elapsed)
+            except Exception as ex:
+                failure = str(ex)
+                self.log(f"{os.path.basename(job.in_path)} failed: {failure}", style="magenta")
+                self.discard(tmp_file)
+            finally:
+                s.close()
+                self.scheduler.job_done(self.worker_name, job, failure)
 
-    def ack(self, s:socket.socket):
-        s.send(bytes("ACK!".encode()))
+        t = Thread(target=run, name=f"{self.worker_name} retrieve", daemon=True)
+        t.start()
+        return t
 
     def go(self):
 
-        while not self.queue.empty():
+        retrievals: List[Thread] = []
+        while (job := self.next_job()) is not None:
+            handed_off = False
             try:
-                job: EncodeJob = self.queue.get()
                 in_path = job.in_path
                 orig_file_size_mb = int(os.path.getsize(in_path) / (1024 * 1024))
 
                 #
                 # build command line
                 #
-                video_options = self.video_cli.split(" ")
-                stream_map = super().map_streams(job)
-
-                has_sharing = False
-                #
-                # if path substitutions were given then the host where the agent resides has access to shared file,
-                # so map the paths same as mountedhost.
-                #
-                if self.props.has_path_subst:
-                    out_path = in_path[0:in_path.rfind('.')] + job.template.extension() + '.tmp'
-                    self.remote_in_path, self.remote_out_path = self.props.substitute_paths(in_path, out_path)
-                    if wandarr.VERBOSE:
-                        print(f"substituted {self.remote_in_path} for {in_path}")
-                    cmd = [self.props.ffmpeg_path, '-stats_period', '2', '-y', *job.template.input_options_list(), '-i', self.remote_in_path,
-                           *video_options,
-                           *job.template.output_options_list(), *stream_map, self.remote_out_path]
-                    has_sharing = True
-                else:
-                    # no path mapping, so we're sending the file
-                    cmd = [self.props.ffmpeg_path, '-stats_period', '2', '-y', *job.template.input_options_list(), '-i', '{FILENAME}',
-                           *video_options,
-                           *job.template.output_options_list(), *stream_map]
-
+                cmd, has_sharing = self.build_command(job, self.video_cli)
                 basename = os.path.basename(job.in_path)
 
                 if super().dump_job_info(job, cmd):
                     continue
 
-                #
-                # Send to agent
-                #
-                s = socket.socket()
-
-                opts_only = [*job.template.input_options_list(), *video_options,
-                             *job.template.output_options_list(), *stream_map]
+                opts_only = [*job.template.input_options_list(), *self.video_cli.split(" "),
+                             *job.template.output_options_list(), *super().map_streams(job)]
                 print(f"{basename} -> ffmpeg {' '.join(opts_only)}")
 
-                wandarr.status_queue.put({'host': f"{self.hostname}/{self.engine_name}",
-                                          'file': basename,
-                                          'completed': 0,
-                                          'status': 'Connect'})
-
-                if wandarr.VERBOSE:
-                    self.log(f"connect to '{self.props.ip}'", style="info")
-
-                self.connect(s)
-
-                input_size = os.path.getsize(in_path)
-                cmd_str = "$".join(cmd)
-                if has_sharing:
-                    hello = f"HELLOS|{wandarr.__version__}|{self.remote_in_path}|{self.remote_out_path}|{cmd_str}|{'1' if wandarr.KEEP_SOURCE else '0'}"
+                tmp_file = in_path + ".tmp"
+                stream_format = None
+                feeder = None
+                stage, self._ready = self._ready, None
+                if stage is not None:
+                    #
+                    # source is already on the agent, just tell it to go
+                    #
+                    s, proto = stage.sock, stage.proto
+                    framed = True
+                    sender = protocol.FrameSender(s)
+                    sender.send(protocol.MSG_START)
                 else:
-                    tmpdir = self.props.working_dir
-                    hello = f"HELLO|{wandarr.__version__}|{input_size}|{tmpdir}|{basename}|{cmd_str}"
+                    if not self.agent_ready(job, has_sharing):
+                        continue
 
-                if not self.handshake(s, hello):
-                    continue
+                    #
+                    # Send to agent
+                    #
+                    s = socket.socket()
 
-                if not has_sharing:
-                    # send the file
                     wandarr.status_queue.put({'host': f"{self.hostname}/{self.engine_name}",
                                               'file': basename,
-                                              'status': 'Copying...'})
+                                              'completed': 0,
+                                              'status': 'Connect'})
 
-                    self.sendfile(s, in_path)
+                    if wandarr.VERBOSE:
+                        self.log(f"connect to '{self.props.ip}'", style="info")
+
+                    self.connect(s)
+
+                    hello = self.job_hello(job, cmd, has_sharing)
+                    proto = self.handshake(s, hello)
+                    if proto == self.BUSY:
+                        self.job_deferred(job)
+                        s.close()
+                        continue
+                    if not proto:
+                        self.job_failed(job, "agent refused job")
+                        s.close()
+                        continue
+                    framed = proto >= 2
+                    sender = protocol.FrameSender(s)
+
+                    #
+                    # pipe the job through the agent's ffmpeg if enabled and both containers can be streamed,
+                    # otherwise copy the whole file over first
+                    #
+                    if not has_sharing and self.props.pipe and proto >= 3:
+                        stream_format = pipe_format(in_path, job.template.extension())
+
+                    if stream_format:
+                        if wandarr.VERBOSE:
+                            self.log(f"streaming job through agent as {stream_format}")
+                        sender.send(protocol.MSG_STREAM, stream_format)
+                        feeder = Thread(target=self.feed, args=(sender, in_path), daemon=True)
+                        feeder.start()
+                    elif not has_sharing:
+                        if proto >= 3:
+                            sender.send(protocol.MSG_UPLOAD, self.upload_id(in_path, proto))
+                        # send the file
+                        wandarr.status_queue.put({'host': f"{self.hostname}/{self.engine_name}",
+                                                  'file': basename,
+                                                  'status': 'Copying...'})
+
+                        s = self.upload(s, job, hello, protocol.MSG_UPLOAD, proto)
+                        sender = protocol.FrameSender(s)
 
                 wandarr.status_queue.put({'host': f"{self.hostname}/{self.engine_name}",
                                           'file': basename,
                                           'status': 'Running'})
+                # agent is busy encoding, so use the network to stage the next job
+                self.start_prefetch(proto)
+
                 job_start = datetime.datetime.now()
-                finished, stats = self.ffmpeg.monitor_agent_ffmpeg(s, super().callback_wrapper(job),
-                                                                   self.ffmpeg.monitor_agent)
+                if stream_format:
+                    try:
+                        with open(tmp_file, "wb") as sink:
+                            finished, stats = self.ffmpeg.monitor_agent_ffmpeg(
+                                s, super().callback_wrapper(job),
+                                lambda sock: self.ffmpeg.monitor_agent_framed(sock, sink),
+                                lambda sock: sender.send(protocol.MSG_VETO))
+                    except Exception:
+                        self.discard(tmp_file)
+                        raise
+                elif framed:
+                    finished, stats = self.ffmpeg.monitor_agent_ffmpeg(
+                        s, super().callback_wrapper(job), self.ffmpeg.monitor_agent_framed,
+                        lambda sock: sender.send(protocol.MSG_VETO))
+                else:
+                    finished, stats = self.ffmpeg.monitor_agent_ffmpeg(s, super().callback_wrapper(job),
+                                                                       self.ffmpeg.monitor_agent)
                 job_stop = datetime.datetime.now()
 
                 try:
                     if finished and stats:
                         parts = stats.split(r"|")
                         if parts[0] == "DONE":
-                            self.ack(s)
-
                             if not has_sharing:
-                                #
-                                # agent will send us the transcoded file
-                                #
                                 tag, exitcode, sent_filesize = parts
                                 filesize = int(sent_filesize)
-                                tmp_file = in_path + ".tmp"
-                                wandarr.status_queue.put({'host': f"{self.hostname}/{self.engine_name}",
-                                                          'file': basename,
-                                                          'completed': 100,
-                                                          'status': 'Retrieving'})
-
-                                if wandarr.VERBOSE:
-                                    self.log(f"receiving ({filesize} bytes)")
-
-                                self.recvfile(s, filesize, tmp_file)
-
-                                if not wandarr.KEEP_SOURCE:
-                                    os.unlink(in_path)
-                                    os.rename(tmp_file, in_path)
-                                    new_filesize_mb = int(os.path.getsize(in_path) / (1024 * 1024))
-
-                                    wandarr.status_queue.put({'host': f"{self.hostname}/{self.engine_name}",
-                                                              'file': basename,
-                                                              'completed': 100,
-                                                              'status': f'{orig_file_size_mb}mb -> {new_filesize_mb}mb'})
+                                if stream_format:
+                                    # transcoded file arrived while the agent was encoding
+                                    received = os.path.getsize(tmp_file)
+                                    if received != filesize:
+                                        self.discard(tmp_file)
+                                        raise ConnectionError(f"received {received} of {filesize} bytes streamed by agent")
+                                    self.replace_source(job, tmp_file, orig_file_size_mb)
+                                elif self.props.prefetch > 0:
+                                    retrievals.append(self.retrieve_later(s, job, proto, filesize, tmp_file,
+                                                                          (job_stop - job_start).seconds))
+                                    handed_off = True
+                                    continue
+                                else:
+                                    #
+                                    # agent will send us the transcoded file
+                                    #
+                                    self.retrieve(s, job, proto, filesize, tmp_file)
                             else:
+                                self.ack(s, framed)
                                 # agent already put the new file in place on the share
                                 new_filesize = parts[2]
                                 new_filesize_mb = int(int(new_filesize) / (1024 * 1024))
@@ -219,18 +530,88 @@ class AgentManagedHost(ManagedHost):
                                                           'completed': 100,
                                                           'status': f'{orig_file_size_mb}mb -> {new_filesize_mb}mb'})
 
+                            self.complete(in_path, (job_stop - job_start).seconds)
+
                         elif parts[0] == "ERR":
-                            self.log(f"Agent returned process error code '{parts[1]}'")
+                            if stream_format:
+                                self.discard(tmp_file)
+                            if parts[1] == "BUSY":
+                                # no free slot for a streamed job
+                                self.job_deferred(job)
+                            else:
+                                self.job_failed(job, f"agent process error code {parts[1]}")
+                                self.log(f"Agent returned process error code '{parts[1]}'")
                         else:
+                            if stream_format:
+                                self.discard(tmp_file)
+                            self.job_failed(job, f"unknown agent response {parts[0]}")
                             self.log(f"Unknown process code from agent: '{parts[0]}'")
-                        self.complete(in_path, (job_stop - job_start).seconds)
+                    elif finished:
+                        if stream_format:
+                            self.discard(tmp_file)
+                        self.job_failed(job, "agent connection lost")
+                    else:
+                        # vetoed by threshold checker
+                        if stream_format:
+                            self.discard(tmp_file)
+                        self.job_skipped(job)
 
                 except KeyboardInterrupt:
-                    s.send(bytes("STOP".encode()))
+                    if framed:
+                        sender.send(protocol.MSG_STOP)
+                    else:
+                        s.send(bytes("STOP".encode()))
 
                 s.close()
+                if feeder:
+                    feeder.join()
 
-            except Exception:
+            except Exception as ex:
+                self.job_failed(job, str(ex))
                 print(traceback.format_exc())
             finally:
-                self.queue.task_done()
+                if not handed_off:
+                    self.job_done(job)
+
+        for t in retrievals:
+            t.join()
+
+
+class StagedUpload(Thread):
+    """Uploads the source of a prefetched job to an agent. On success sock is left open, with the agent
+       holding the file until it is told to start - closing it instead discards the file.
+    """
+
+    def __init__(self, host: AgentManagedHost, job: EncodeJob):
+        super().__init__(name=f"{host.worker_name} prefetch", daemon=True)
+        self.host = host
+        self.job = job
+        self.sock: Optional[socket.socket] = None
+        self.proto = 0
+        self.error = None
+
+    def run(self):
+        host = self.host
+        s = socket.socket()
+        try:
+            status = host.agent_status()
+            if status is not None and status.get('temp_free') is not None:
+                if status['temp_free'] < 2 * os.path.getsize(self.job.in_path):
+                    raise ConnectionError("not enough space in agent temp dir")
+            cmd, _ = host.build_command(self.job, host.qualities[self.job.quality])
+            host.connect(s)
+            hello = host.job_hello(self.job, cmd, False)
+            self.proto = host.handshake(s, hello)
+            if self.proto == host.BUSY:
+                raise ConnectionError("agent busy")
+            if self.proto < 4:
+                raise ConnectionError("agent does not support prefetch")
+            protocol.send_frame(s, protocol.MSG_PREFETCH, host.upload_id(self.job.in_path, self.proto))
+            s = host.upload(s, self.job, hello, protocol.MSG_PREFETCH, self.proto)
+            mtype, _ = protocol.recv_frame(s)
+            if mtype != protocol.MSG_STAGED:
+                raise ConnectionError(f"unexpected reply {mtype} to prefetch")
+            self.sock = s
+        except Exception as ex:
+            self.error = str(ex)
+            s.close()
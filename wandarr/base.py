@@ -1,19 +1,34 @@
+import socket
 import subprocess
 import sys
 from pathlib import PureWindowsPath, PosixPath
 from threading import Thread
-from typing import Dict, List
+from typing import Dict, List, Optional
 import os
 
 import wandarr
 from wandarr.ffmpeg import FFmpeg
 from wandarr.media import MediaInfo
 from wandarr.template import Template
-from wandarr.utils import get_local_os_type, calculate_progress
+from wandarr.utils import get_local_os_type, calculate_progress, parse_speed
 
 if wandarr.console:
     from rich import print
 
+#
+# containers ffmpeg can read from and write to a pipe without seeking, by file extension.
+# Output maps to the ffmpeg muxer name passed with -f.
+#
+PIPE_INPUT_TYPES = ['.mkv', '.webm', '.ts', '.m2ts']
+PIPE_OUTPUT_FORMATS = {'.mkv': 'matroska', '.webm': 'webm', '.ts': 'mpegts'}
+
+
+def pipe_format(in_path: str, out_extension: str) -> Optional[str]:
+    """ffmpeg output format to use when piping a job through, None if either container needs a seekable file"""
+    if os.path.splitext(in_path)[1].lower() not in PIPE_INPUT_TYPES:
+        return None
+    return PIPE_OUTPUT_FORMATS.get(out_extension.lower())
+
 
 class RemoteHostProperties:
     name: str
@@ -63,6 +78,32 @@ class RemoteHostProperties:
     def engines(self) -> Dict:
         return self.props.get('engines')
 
+    @property
+    def slots(self) -> int:
+        """Maximum concurrent encodes on this host across all engines, default one per engine"""
+        return int(self.props.get('slots', len(self.engines or [])))
+
+    @property
+    def check_port(self) -> Optional[int]:
+        """TCP port to connect to when checking the host is up, None to use the default for the host type"""
+        port = self.props.get('check-port')
+        return int(port) if port else None
+
+    @property
+    def pipe(self) -> bool:
+        """Pipe media through ffmpeg while it is being transferred instead of copying it first, where the containers allow"""
+        return self.props.get('pipe', False) is True
+
+    @property
+    def prefetch(self) -> int:
+        """Agent hosts - how many upcoming jobs may have their source uploaded ahead, 0 for none"""
+        return int(self.props.get('prefetch', 0))
+
+    def engine_slots(self, engine_name: str) -> int:
+        """Maximum concurrent encodes for one engine (ie. NVENC session limits), never more than the host allows"""
+        per_engine = self.props.get('engine-slots', {})
+        return min(int(per_engine.get(engine_name, self.slots)), self.slots)
+
     def substitute_paths(self, in_path, out_path):
         lst = self.props['path-substitutions']
         for item in lst:
@@ -104,6 +145,13 @@ class RemoteHostProperties:
         if self.props['type'] == 'streaming':
             if 'working_dir' not in self.props:
                 msg.append('Missing "working_dir"')
+        if 'slots' in self.props and (not isinstance(self.props['slots'], int) or self.props['slots'] < 1):
+            msg.append('"slots" must be a number greater than 0')
+        if 'prefetch' in self.props and (not isinstance(self.props['prefetch'], int) or self.props['prefetch'] < 0):
+            msg.append('"prefetch" must be a number, 0 or more')
+        for engine_name, count in self.props.get('engine-slots', {}).items():
+            if not isinstance(count, int) or count < 1:
+                msg.append(f'"engine-slots" for {engine_name} must be a number greater than 0')
         if len(msg) > 0:
             print(f'Validation error(s) for host {self.name}:')
             print('\n'.join(msg))
@@ -116,11 +164,26 @@ class EncodeJob:
     in_path: str
     media_info: MediaInfo
     template_name: str
+    quality: str
 
-    def __init__(self, in_path: str, info: MediaInfo, template: Template):
+    def __init__(self, in_path: str, info: MediaInfo, template: Template, quality: str = None):
         self.in_path = os.path.abspath(in_path)
         self.media_info = info
         self.template = template
+        self.quality = quality or template.video_select()
+        self.speeds: List[float] = []   # encode speed samples reported by ffmpeg
+        self.attempts = 0               # failed attempts so far
+        self.failed_hosts = set()
+        self.not_before = 0.0           # monotonic time before which a retry should not start
+
+    def estimated_work(self) -> float:
+        """Relative size of this job in pixels to encode. Only useful for comparing jobs with each other."""
+        mi = self.media_info
+        frames = mi.frames or (mi.runtime * mi.fps)
+        if frames and mi.res_width and mi.res_height:
+            return float(frames * mi.res_width * mi.res_height)
+        # no usable metadata, so fall back to the file size scaled to roughly the same magnitude
+        return float(mi.filesize_mb) * 1_000_000_000
 
     def should_abort(self, pct_done, pct_comp) -> bool:
         if self.template.threshold_check() < 100:
@@ -133,25 +196,76 @@ class ManagedHost(Thread):
         Base thread class for all remote host types.
     """
 
-    def __init__(self, hostname, props, queue):
+    def __init__(self, hostname, props, scheduler):
         """
         :param hostname:    name of host from cluster
         :param props:       dictionary of properties from cluster
-        :param queue:       Work queue assigned to this thread, could be many-to-one in the future.
+        :param scheduler:   Scheduler shared by all hosts, handing out jobs this host can encode
         """
         super().__init__(name=hostname, group=None, daemon=True)
         self.hostname = hostname
         self.props = props
-        self.queue = queue
+        self.scheduler = scheduler
         self._complete = []
         self.ffmpeg = FFmpeg(props.ffmpeg_path)
+        self.qualities: Dict[str, str] = {}  # quality name -> video cli for this engine
         self.video_cli = None
-        self.qname = None  # assigned queue
+        self.qname = None  # quality of the current job
         self.engine_name = None
+        self.slot = 0
+        self._failure = None
+        self._skipped = False
+        self._deferred = False
+
+    @property
+    def worker_name(self) -> str:
+        if self.slot:
+            return f"{self.hostname}/{self.engine_name}#{self.slot + 1}"
+        return f"{self.hostname}/{self.engine_name}"
 
     def validate_settings(self):
         return self.props.validate_settings()
 
+    def attach(self, engine_name: str, qualities: Dict[str, str], slot: int = 0):
+        """Bind this thread to an engine slot and register the qualities it can encode with the scheduler"""
+        self.engine_name = engine_name
+        self.qualities = qualities
+        self.slot = slot
+        self.scheduler.register(self.worker_name, qualities.keys(), self.hostname, engine_name)
+
+    def next_job(self) -> Optional[EncodeJob]:
+        """Wait for the next job, or None when there is no more work.
+           The video options are switched to match the quality of the job handed out.
+        """
+        job = self.scheduler.next_job(self.worker_name)
+        if job is not None:
+            self.switch_quality(job)
+        return job
+
+    def switch_quality(self, job: EncodeJob):
+        self.qname = job.quality
+        self.video_cli = self.qualities.get(job.quality, self.video_cli)
+
+    def job_failed(self, job: EncodeJob, reason: str):
+        """Flag the current job as failed so it is retried, preferably on another host, once this one lets it go"""
+        self._failure = reason
+        self.log(f"{os.path.basename(job.in_path)} failed: {reason}", style="magenta")
+
+    def job_skipped(self, job: EncodeJob):
+        """Flag the current job as abandoned for not meeting the template threshold"""
+        self._skipped = True
+
+    def job_deferred(self, job: EncodeJob):
+        """Flag the current job as turned away by a busy host, to be put back without counting as a failure"""
+        self._deferred = True
+        self.log(f"{os.path.basename(job.in_path)} deferred: host busy", style="info")
+
+    def job_done(self, job: EncodeJob):
+        failure, self._failure = self._failure, None
+        skipped, self._skipped = self._skipped, False
+        deferred, self._deferred = self._deferred, False
+        self.scheduler.job_done(self.worker_name, job, failure, skipped, deferred)
+
     def complete(self, source, elapsed=0):
         self._complete.append((source, elapsed))
 
@@ -181,18 +295,19 @@ class ManagedHost(Thread):
     def ssh_cmd(self):
         return [wandarr.SSH, self.props.user + '@' + self.props.ip]
 
-    def ping_test_ok(self):
+    # port connected to by port_test_ok, unless the host sets check-port
+    CHECK_PORT = 22
+
+    def port_test_ok(self):
+        """Quick reachability test - a TCP connect to the ssh (or agent) port rather than running ping"""
         addr = self.props.ip
-        if os.name == "nt":
-            ping = [r'C:\WINDOWS\system32\ping.exe', '-n', '1', '-w', '5', addr]
-        else:
-            ping = ['ping', '-c', '1', '-W', '5', addr]
-        with subprocess.Popen(ping, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=False) as p:
-            p.communicate()
-            if p.returncode != 0:
-                self.log(f"ping test: Host at address {addr} cannot be reached - skipped", style="magenta")
-                return False
-            return True
+        port = self.props.check_port or self.CHECK_PORT
+        try:
+            with socket.create_connection((addr, port), timeout=5):
+                return True
+        except OSError as ex:
+            self.log(f"port test: Host at address {addr}:{port} cannot be reached ({ex}) - skipped", style="magenta")
+            return False
 
     def ssh_test_ok(self):
         try:
@@ -208,7 +323,7 @@ class ManagedHost(Thread):
             return False
 
     def host_ok(self):
-        return self.ping_test_ok() and self.ssh_test_ok()
+        return self.port_test_ok() and self.ssh_test_ok()
 
     def run_process(self, *args):
         p = subprocess.run(*args, check=False)
@@ -234,6 +349,9 @@ class ManagedHost(Thread):
                 return False
 
             pct_done, pct_comp = calculate_progress(job.media_info, stats)
+            speed = parse_speed(stats.get('speed'))
+            if speed:
+                job.speeds.append(speed)
             wandarr.status_queue.put({'host': f"{self.hostname}/{self.engine_name}",
                                       'file': os.path.basename(job.in_path),
                                       'speed': "---" if stats['speed'] == "N/A" else f"{stats['speed']}x",
@@ -4,8 +4,10 @@
 import os
 import signal
 import sys
-from queue import Queue
+import traceback
 import queue
+import time
+from concurrent.futures import ThreadPoolExecutor
 from threading import Thread
 from typing import Dict, List
 from rich.console import Console
@@ -16,36 +18,78 @@ from wandarr.base import ManagedHost, RemoteHostProperties, EncodeJob
 from wandarr.config import ConfigFile
 from wandarr.ffmpeg import FFmpeg
 from wandarr.localhost import LocalHost
+from wandarr.journal import Journal
+from wandarr.media import MediaInfo
 from wandarr.mountedhost import MountedManagedHost
+from wandarr.probe import Prober
+from wandarr.scheduler import Scheduler
+from wandarr.throughput import ThroughputModel
 from wandarr.streaminghost import StreamingManagedHost
 
+HOST_TYPES = {
+    "local": LocalHost,
+    "mounted": MountedManagedHost,
+    "streaming": StreamingManagedHost,
+    "agent": AgentManagedHost,
+}
+
+
+class ProbeProducer(Thread):
+    """Probe and queue files in the background so hosts can start encoding as soon as the first job is ready"""
+
+    def __init__(self, cluster: 'Cluster', files: List[str], template_name: str, vq_override: str):
+        super().__init__(daemon=True, name="ProbeProducer")
+        self.cluster = cluster
+        self.files = files
+        self.template_name = template_name
+        self.vq_override = vq_override
+
+    def run(self):
+        try:
+            self.cluster.enqueue_all(self.files, self.template_name, self.vq_override)
+        except Exception:
+            print(traceback.format_exc())
+        finally:
+            # always release the hosts, even if probing failed part way
+            self.cluster.close_queues()
+            self.cluster.prober.close()
+
 
 class Cluster(Thread):
     """Thread to create host threads and wait for their completion."""
 
-    def __init__(self, config: ConfigFile):
+    def __init__(self, config: ConfigFile, resume: bool = False):
         """
         :param config:      The full configuration object
+        :param resume:      Continue the job journal of an interrupted run instead of starting a new one
         """
         super().__init__(daemon=True)
-        self.queues: Dict[str, Queue] = {}
+        model = ThroughputModel(config.throughput_db_path) if config.throughput_db_path else None
+        journal = None
+        if config.journal_path and not wandarr.DRY_RUN:
+            try:
+                journal = Journal(config.journal_path, resume)
+            except OSError as ex:
+                print(f"Job journal {config.journal_path} unavailable: {ex}")
+        self.scheduler = Scheduler(config.dispatch_order, model, max_attempts=config.max_attempts,
+                                   retry_backoff=config.retry_backoff, quarantine_after=config.quarantine_after,
+                                   order_window=config.order_window, journal=journal)
         self.hosts: List[ManagedHost] = []
         self.config = config
         self.ffmpeg = FFmpeg(config.ffmpeg_path)
+        self.prober = Prober.from_config(config)
         self.completed: List = []
 
-        down_hosts = []
-        up_hosts = []
+        host_status = self.check_hosts({host: RemoteHostProperties(host, props) for host, props in config.hosts.items()})
+
         for host, props in config.hosts.items():
-            if host in down_hosts:
-                continue
             host_props = RemoteHostProperties(host, props)
-            if not host_props.is_enabled:
+            if not host_props.is_enabled or not host_status.get(host, True):
                 continue
             host_type = host_props.host_type
 
             #
-            # each host gets a queue for each quality type, whether it is used or not
+            # each host gets a thread per engine, able to take a job of any quality that engine supports
             #
             host_engines: Dict = host_props.engines
             if len(host_engines) == 0:
@@ -53,104 +97,91 @@ class Cluster(Thread):
                 continue
 
             for host_engine_name in host_engines:
-                if host in down_hosts:
-                    continue
                 engine = self.config.engine(host_engine_name)
                 if not engine:
                     print(f"Engine {host_engine_name} not found for host {host} - skipping")
                     continue
-                eng_qualities = engine.qualities()
-                for qname, cli in eng_qualities.items():
-                    if host in down_hosts:
-                        continue
-                    if qname not in self.queues:
-                        self.queues[qname] = Queue()
-
-                    match host_type:
-                        case "local":
-                            if wandarr.VERBOSE:
-                                print(f"{host=} {qname=} {host_engine_name=} {cli=}")
-                            self._init_host_local(host, host_props, qname, host_engine_name, cli)
-
-                        case "mounted":
-                            if wandarr.VERBOSE:
-                                print(f"{host=} {qname=} {host_engine_name=} {cli=}")
-                            if not self._init_host_mounted(host, host_props, qname, host_engine_name, cli, host not in up_hosts):
-                                down_hosts.append(host)
-                                continue
-                            up_hosts.append(host)
-
-                        case "streaming":
-                            if wandarr.VERBOSE:
-                                print(f"{host=} {qname=} {host_engine_name=} {cli=}")
-                            if not self._init_host_streaming(host, host_props, qname, host_engine_name, cli, host not in up_hosts):
-                                down_hosts.append(host)
-                                continue
-                            up_hosts.append(host)
-
-                        case "agent":
-                            if wandarr.VERBOSE:
-                                print(f"{host=} {qname=} {host_engine_name=} {cli=}")
-                            if not self._init_host_agent(host, host_props, qname, host_engine_name, cli, host not in up_hosts):
-                                down_hosts.append(host)
-                                continue
-                            up_hosts.append(host)
-
-                        case _:
-                            print(f'Unknown cluster host type "{host_type}" - skipping')
-
-    def _init_host_local(self, host: str, host_props: RemoteHostProperties, qname: str, engine_name: str, cli: str):
-        _h = LocalHost(host, host_props, self.queues[qname])
-        if not _h.validate_settings():
-            sys.exit(1)
-        _h.video_cli = cli
-        _h.qname = qname
-        _h.engine_name = engine_name
+                eng_qualities: Dict[str, str] = engine.qualities()
+                if wandarr.VERBOSE:
+                    print(f"{host=} {host_engine_name=} slots={host_props.engine_slots(host_engine_name)} "
+                          f"qualities={list(eng_qualities.keys())}")
+
+                #
+                # one thread per engine slot, all sharing the host slot limit enforced by the scheduler
+                #
+                for slot in range(host_props.engine_slots(host_engine_name)):
+                    if host_type not in HOST_TYPES:
+                        print(f'Unknown cluster host type "{host_type}" - skipping')
+                        break
+                    _h = HOST_TYPES[host_type](host, host_props, self.scheduler)
+                    if not _h.validate_settings():
+                        sys.exit(1)
+                    self._add_host(_h, host_engine_name, eng_qualities, slot)
+
+            self.scheduler.set_slots(host, host_props.slots)
+            if host_type == 'agent':
+                self.scheduler.set_prefetch(host, host_props.prefetch)
+
+    def check_hosts(self, hosts: Dict[str, RemoteHostProperties]) -> Dict[str, bool]:
+        """Check all enabled remote hosts are up, in parallel so unreachable hosts don't add up their timeouts.
+           Returns host name -> up/down for every host checked.
+        """
+        to_check = {host: props for host, props in hosts.items()
+                    if props.is_enabled and props.host_type in HOST_TYPES and props.host_type != "local"}
+        if not to_check:
+            return {}
+
+        def check(host: str):
+            start = time.monotonic()
+            props = to_check[host]
+            ok = HOST_TYPES[props.host_type](host, props, self.scheduler).host_ok()
+            return host, ok, time.monotonic() - start
+
+        status = {}
+        workers = min(self.config.health_check_workers, len(to_check))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="hostcheck") as executor:
+            for host, ok, elapsed in executor.map(check, to_check):
+                status[host] = ok
+                if wandarr.VERBOSE or not ok:
+                    print(f"{host}: {'up' if ok else 'not available'} (checked in {elapsed * 1000:.0f}ms)")
+        return status
+
+    def _add_host(self, _h: ManagedHost, engine_name: str, qualities: Dict[str, str], slot: int):
+        _h.attach(engine_name, qualities, slot)
         self.hosts.append(_h)
 
-    def _init_host_mounted(self, host: str, host_props: RemoteHostProperties, qname: str, engine_name: str, cli: str, check_host: bool):
-        _h = MountedManagedHost(host, host_props, self.queues[qname])
-        if check_host and not _h.host_ok():
-            return False
-
-        if not _h.validate_settings():
+    def video_quality(self, template_name: str, vq_override: str = None) -> str:
+        """Determine the quality name for jobs using this template, exit if no host engine supports it"""
+        template = self.config.templates[template_name]
+        video_quality = vq_override or template.video_select()
+        if not video_quality:
+            print(f"Template setting 'video-quality' not set for template {template_name}")
             sys.exit(1)
-        _h.video_cli = cli
-        _h.qname = qname
-        _h.engine_name = engine_name
-        self.hosts.append(_h)
-        return True
-
-    def _init_host_streaming(self, host: str, host_props: RemoteHostProperties, qname: str, engine_name: str, cli: str, check_host: bool):
-        _h = StreamingManagedHost(host, host_props, self.queues[qname])
-        if check_host and not _h.host_ok():
-            return False
 
-        if not _h.validate_settings():
+        if not self.scheduler.supports(video_quality):
+            print((f"Cannot match quality '{video_quality}' to any related host engines. "
+                  "Make sure there is at least one host with an engine that supports this quality."))
             sys.exit(1)
-        _h.video_cli = cli
-        _h.qname = qname
-        _h.engine_name = engine_name
-        self.hosts.append(_h)
-        return True
+        return video_quality
 
-    def _init_host_agent(self, host: str, host_props: RemoteHostProperties, qname: str, engine_name: str, cli: str, check_host: bool):
-        _h = AgentManagedHost(host, host_props, self.queues[qname])
-        if check_host and not _h.host_ok():
-            return False
+    def close_queues(self):
+        """Signal hosts that no more jobs are coming"""
+        self.scheduler.close()
 
-        if not _h.validate_settings():
-            sys.exit(1)
-        _h.video_cli = cli
-        _h.qname = qname
-        _h.engine_name = engine_name
-        self.hosts.append(_h)
-        return True
+    def enqueue_all(self, files: List[str], template_name: str, vq_override: str = None):
+        """Probe all files using the configured worker pool and queue them in the order given"""
+        paths = [os.path.abspath(file) for file in files]
+        for file, (_, media_info) in zip(files, self.prober.fetch_all(paths)):
+            if media_info is None:
+                continue
+            self.enqueue(file, template_name, vq_override, media_info)
 
-    def enqueue(self, file, template_name: str, vq_override: str = None):
+    def enqueue(self, file, template_name: str, vq_override: str = None, media_info: MediaInfo = None):
         """Add a media file to this cluster queue.
            This is different from in local mode in that we only care about handling skips here.
            The profile will be selected once a host is assigned to the work
+
+           :param media_info:   Details from an earlier probe, otherwise the file is probed here
         """
         if template_name is None:
             print("No template specified")
@@ -163,7 +194,8 @@ class Cluster(Thread):
         if wandarr.VERBOSE:
             print('matching ' + path)
 
-        media_info = self.ffmpeg.fetch_details(path)
+        if media_info is None:
+            media_info = self.prober.fetch_details(path)
 
         if media_info is None:
             print(f'File not found: {path}')
@@ -173,26 +205,19 @@ class Cluster(Thread):
                 print(str(media_info))
 
             template = self.config.templates[template_name]
-            video_quality = vq_override or template.video_select()
-            if not video_quality:
-                print(f"Template setting 'video-quality' not set for template {template_name}")
-                sys.exit(1)
-
-            if video_quality not in self.queues:
-                print((f"Cannot match quality '{video_quality}' to any related host engines. "
-                      "Make sure there is at least one host with an engine that supports this quality."))
-                sys.exit(1)
-            job = EncodeJob(file, media_info, template)
-            self.queues[video_quality].put(job)
+            video_quality = self.video_quality(template_name, vq_override)
+            job = EncodeJob(file, media_info, template, video_quality)
+            self.scheduler.submit(job)
             return video_quality, job
         return None, None
 
     def testrun(self):
         for host in self.hosts:
             host.testrun()
+        self.scheduler.shutdown()
 
     def run(self):
-        """Start all host threads and wait until queue is drained"""
+        """Start all host threads and wait until the scheduler is drained"""
 
         if len(self.hosts) == 0:
             print(f'No hosts available in cluster "{self.name}"')
@@ -200,7 +225,7 @@ class Cluster(Thread):
 
         for host in self.hosts:
             if wandarr.VERBOSE:
-                print(f"Starting {host.name} thread with queue {host.qname}")
+                print(f"Starting {host.worker_name} thread for qualities {', '.join(host.qualities.keys())}")
             host.start()
 
         # all hosts running, wait for them to finish
@@ -208,12 +233,20 @@ class Cluster(Thread):
             host.join()
             self.completed.extend(host.completed)
 
+        for job in self.scheduler.failed:
+            print(f"Failed after {job.attempts} attempts: {job.in_path}")
+        for job in self.scheduler.pending:
+            print(f"Not run, no working host left: {job.in_path}")
+        for host in sorted(self.scheduler.quarantined):
+            print(f"Host {host} was quarantined after repeated failures")
+        self.scheduler.shutdown()
+
     def terminate(self):
         for host in self.hosts:
             host.terminate()
 
 
-def manage_cluster(files, config: ConfigFile, template_name: str, vq_override: str, testing=False) -> List:
+def manage_cluster(files, config: ConfigFile, template_name: str, vq_override: str, testing=False, resume=False) -> List:
     """Main entry point for setup and execution of all jobs
 
         There is one thread for the cluster that manages multiple hosts, each having their own thread.
@@ -231,20 +264,26 @@ def manage_cluster(files, config: ConfigFile, template_name: str, vq_override: s
     wandarr.SSH = config.ssh_path
 
     try:
-        cluster = Cluster(config)
+        cluster = Cluster(config, resume)
     except ValueError as ve:
         print("Error initializing: " + str(ve))
         sys.exit(1)
 
-    for item in files:
-        cluster.enqueue(item, template_name, vq_override)
+    if template_name not in config.templates:
+        print(f"Template {template_name} not found")
+        return completed
+    cluster.video_quality(template_name, vq_override)
 
     #
-    # Start cluster, which will start hosts too
+    # Start cluster, which will start hosts too. Files are probed and queued by the producer while
+    # the hosts are already consuming.
     #
+    producer = ProbeProducer(cluster, files, template_name, vq_override)
     if testing:
+        producer.run()
         cluster.testrun()
     else:
+        producer.start()
         cluster.start()
 
     def sig_handler(sig, frame):
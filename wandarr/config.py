@@ -1,10 +1,14 @@
 import os
 import sys
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 import yaml
 
 from wandarr.template import Template
 
+DEFAULT_PROBE_CACHE_NAME = ".wandarr-probe.db"
+DEFAULT_THROUGHPUT_DB_NAME = ".wandarr-throughput.db"
+DEFAULT_JOURNAL_NAME = ".wandarr-journal.jsonl"
+
 
 class Engine:
 
@@ -24,6 +28,7 @@ class ConfigFile:
         self.templates: Dict[str, Template] = {}
         self.engines: Dict[str, Engine] = {}
         self.hosts: Dict = {}
+        self.path = None
 
         self.directives = {}
         if configuration is not None:
@@ -33,6 +38,7 @@ class ConfigFile:
                 if not os.path.exists(configuration):
                     print(f'Configuration file {configuration} not found')
                     sys.exit(1)
+                self.path = os.path.abspath(configuration)
                 with open(configuration, 'r', encoding="utf8") as f:
                     yml = yaml.load(f, Loader=yaml.Loader)
             self.settings = yml['config']
@@ -85,3 +91,81 @@ class ConfigFile:
     @property
     def ssh_path(self):
         return self.settings.get('ssh', '/usr/bin/ssh')
+
+    @property
+    def probe_workers(self) -> int:
+        return int(self.settings.get('probe-workers', 4))
+
+    @probe_workers.setter
+    def probe_workers(self, v):
+        self.settings['probe-workers'] = v
+
+    @property
+    def probe_mode(self) -> str:
+        return self.settings.get('probe-mode', 'thread')
+
+    def _state_path(self, setting: str, default_name: str) -> Optional[str]:
+        """Location of a persistent state file, None if disabled. Defaults to alongside the config file."""
+        location = self.settings.get(setting, True)
+        if location is False:
+            return None
+        if isinstance(location, str):
+            return os.path.expanduser(location)
+        config_dir = os.path.dirname(self.path) if self.path else os.path.expanduser('~')
+        return os.path.join(config_dir, default_name)
+
+    @property
+    def probe_cache_path(self) -> Optional[str]:
+        return self._state_path('probe-cache', DEFAULT_PROBE_CACHE_NAME)
+
+    @probe_cache_path.setter
+    def probe_cache_path(self, v):
+        self.settings['probe-cache'] = v if v else False
+
+    @property
+    def probe_cache_size(self) -> int:
+        return int(self.settings.get('probe-cache-size', 50_000))
+
+    @property
+    def throughput_db_path(self) -> Optional[str]:
+        return self._state_path('throughput-db', DEFAULT_THROUGHPUT_DB_NAME)
+
+    @throughput_db_path.setter
+    def throughput_db_path(self, v):
+        self.settings['throughput-db'] = v if v else False
+
+    @property
+    def journal_path(self) -> Optional[str]:
+        return self._state_path('journal', DEFAULT_JOURNAL_NAME)
+
+    @journal_path.setter
+    def journal_path(self, v):
+        self.settings['journal'] = v if v else False
+
+    @property
+    def dispatch_order(self) -> str:
+        return self.settings.get('dispatch-order', 'fifo')
+
+    @dispatch_order.setter
+    def dispatch_order(self, v):
+        self.settings['dispatch-order'] = v
+
+    @property
+    def health_check_workers(self) -> int:
+        return int(self.settings.get('health-check-workers', 8))
+
+    @property
+    def order_window(self) -> float:
+        return float(self.settings.get('order-window', 120))
+
+    @property
+    def max_attempts(self) -> int:
+        return int(self.settings.get('max-attempts', 3))
+
+    @property
+    def retry_backoff(self) -> float:
+        return float(self.settings.get('retry-backoff', 30))
+
+    @property
+    def quarantine_after(self) -> int:
+        return int(self.settings.get('quarantine-after', 3))
@@ -8,10 +8,11 @@ from pathlib import PurePath
 from random import randint
 import socket
 from tempfile import gettempdir
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional
 import json
 
 import wandarr
+from wandarr import protocol
 from wandarr.media import MediaInfo
 
 status_re = re.compile(
@@ -46,7 +47,10 @@ class FFmpeg:
                         return None
             return p.returncode
 
-    def monitor_agent_ffmpeg(self, sock, event_callback, monitor):
+    def monitor_agent_ffmpeg(self, sock, event_callback, monitor, send_veto=None):
+        """
+        :param send_veto:   Tells the agent to abandon the transcode, defaults to the original protocol VETO
+        """
         stats = None
         for stats in monitor(sock):
             if isinstance(stats, str):
@@ -54,7 +58,10 @@ class FFmpeg:
             if event_callback is not None:
                 veto = event_callback(stats)
                 if veto:
-                    sock.send(bytes("VETO".encode()))
+                    if send_veto:
+                        send_veto(sock)
+                    else:
+                        sock.send(bytes("VETO".encode()))
                     return False, stats
         return True, stats
 
@@ -171,11 +178,67 @@ class FFmpeg:
         # yield the final info results before terminating loop
         yield info
 
-    def monitor_agent(self, sock: socket.socket):
+    def _agent_log_path(self) -> PurePath:
         suffix = randint(100, 999)
-        self.log_path: PurePath = PurePath(gettempdir(), 'wandarr-' +
-                                           threading.current_thread().name + '-' +
-                                           str(suffix) + '.log')
+        return PurePath(gettempdir(), 'wandarr-' + threading.current_thread().name + '-' + str(suffix) + '.log')
+
+    @staticmethod
+    def parse_status(line: str) -> Optional[Dict[str, Any]]:
+        """Progress details from an ffmpeg stats line, None if it isn't one"""
+        match = status_re.match(line)
+        if match is None or len(match.groups()) < 5:
+            return None
+        info: Dict[str, Any] = match.groupdict()
+        info['frame'] = int(info['frame'])
+        info['size'] = int(info['size'].strip()) * 1024
+        if info['time'] != 'N/A':
+            hh, mm, ss = info['time'].split(':')
+            ss = ss.split('.')[0]
+            info['time'] = (int(hh) * 3600) + (int(mm) * 60) + int(ss)
+        return info
+
+    def monitor_agent_framed(self, sock: socket.socket, sink=None):
+        """Framed protocol version of monitor_agent. Each message is a whole line of ffmpeg output, so no
+           stats are lost to chunking and nothing needs acknowledging. From protocol 7 the agent sends parsed
+           stats instead, and output lines only ahead of an error.
+
+        :param sink:    Open file the encoded output is written to as it arrives, when streaming
+        """
+        self.log_path = self._agent_log_path()
+        diff = datetime.timedelta(seconds=self.monitor_interval)
+        event = datetime.datetime.now() + diff
+        with open(str(self.log_path), 'w', encoding="utf8") as logfile:
+            while True:
+                mtype, payload = protocol.recv_frame(sock)
+                if mtype == protocol.MSG_RESULT:
+                    if sink is None:
+                        raise ConnectionError("agent sent output data that was not asked for")
+                    sink.write(payload)
+                    continue
+                if mtype == protocol.MSG_PROGRESS:
+                    # parsed by the agent, at the interval we asked for
+                    yield json.loads(payload)
+                    continue
+                text = payload.decode(errors="replace")
+                if mtype == protocol.MSG_OUTPUT:
+                    logfile.write(text)
+                    info = self.parse_status(text)
+                    if info is not None and datetime.datetime.now() > event:
+                        event = datetime.datetime.now() + diff
+                        yield info
+                elif mtype in (protocol.MSG_DONE, protocol.MSG_ERR):
+                    logfile.write(text + "\n")
+                    logfile.flush()
+                    if mtype == protocol.MSG_ERR:
+                        print(f"See error log at {self.log_path}")
+                    else:
+                        os.remove(str(self.log_path))
+                        self.log_path = None
+                    yield text
+                    return
+
+    def monitor_agent(self, sock: socket.socket):
+        self.log_path: PurePath = self._agent_log_path()
 
         diff = datetime.timedelta(seconds=self.monitor_interval)
         event = datetime.datetime.now() + diff
@@ -184,6 +247,8 @@ class FFmpeg:
             while True:
                 sock.settimeout(10)
                 c = sock.recv(4096).decode()
+                if not c:
+                    raise ConnectionError("agent closed connection during transcode")
                 logfile.write(c)
                 logfile.flush()
                 if c.startswith("DONE|") or c.startswith("ERR|"):
@@ -203,21 +268,34 @@ class FFmpeg:
                 sock.send(bytes("ACK!".encode()))
                 line = c
 
-                match = status_re.match(line)
-                if match is not None and len(match.groups()) >= 5:
-                    if datetime.datetime.now() > event:
-                        event = datetime.datetime.now() + diff
-                        info: Dict[str, Any] = match.groupdict()
-
-                        info['frame'] = int(info['frame'])
-                        info['size'] = int(info['size'].strip()) * 1024
-                        hh, mm, ss = info['time'].split(':')
-                        ss = ss.split('.')[0]
-                        info['time'] = (int(hh) * 3600) + (int(mm) * 60) + int(ss)
-                        yield info
+                info = self.parse_status(line)
+                if info is not None and datetime.datetime.now() > event:
+                    event = datetime.datetime.now() + diff
+                    yield info
 
     def run(self, params, event_callback) -> Optional[int]:
         return self.execute_and_monitor(params, event_callback, self.monitor_ffmpeg)
 
+    def encoders(self) -> List[str]:
+        """Names of the encoders this ffmpeg was built with, from ffmpeg -encoders"""
+        p = subprocess.run([self.path, '-hide_banner', '-encoders'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                           check=False, timeout=30)
+        output = p.stdout.decode(_CHARSET, errors="replace")
+        # the list of encoders follows the legend, after a ------ line
+        _, _, listing = output.partition("------")
+        names = []
+        for line in listing.splitlines():
+            fields = line.split()
+            if len(fields) >= 2:
+                names.append(fields[1])
+        return names
+
+    @staticmethod
+    def video_encoders(cli: str) -> List[str]:
+        """Video encoders named in a set of ffmpeg options, ignoring stream copy"""
+        tokens = cli.split()
+        return [tokens[i + 1] for i, token in enumerate(tokens[:-1])
+                if token in ('-c:v', '-vcodec', '-codec:v') and tokens[i + 1] != 'copy']
+
     def run_remote(self, sshcli: str, user: str, ip: str, params: list, event_callback) -> Optional[int]:
         return self.remote_execute_and_monitor(sshcli, user, ip, params, event_callback, self.monitor_ffmpeg)
@@ -0,0 +1,71 @@
+"""
+    Write-ahead journal of job state, so an interrupted batch can be resumed
+"""
+import json
+import os
+import time
+from threading import Lock
+from typing import Dict, List, Optional
+
+QUEUED = "queued"
+STARTED = "started"
+COMPLETED = "completed"
+SKIPPED = "skipped"       # did not meet the template threshold
+FAILED = "failed"
+
+# nothing left to do for a file in one of these states
+FINISHED_STATES = [COMPLETED, SKIPPED]
+
+
+class Journal:
+    """Append-only file of job state changes, one JSON object per line.
+       Every record is flushed to disk before returning so a crash loses at most the line being written.
+    """
+
+    def __init__(self, path: str, resume: bool = False):
+        """
+        :param path:    Journal location
+        :param resume:  Append to the existing journal rather than starting a new batch
+        """
+        self.path = path
+        self._lock = Lock()
+        self._file = open(path, 'a' if resume else 'w', encoding="utf8")
+
+    def record(self, state: str, path: str, **fields):
+        entry = {'time': time.time(), 'state': state, 'path': path, **fields}
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.write(json.dumps(entry) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    @staticmethod
+    def replay(path: str) -> Dict[str, Dict]:
+        """Latest state of every file in the journal, keyed by path. The queued details (template,
+           quality) are carried forward into later states.
+        """
+        entries: Dict[str, Dict] = {}
+        with open(path, 'r', encoding="utf8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # torn last line from a crash mid-write
+                    continue
+                entries[entry['path']] = {**entries.get(entry['path'], {}), **entry}
+        return entries
+
+    @staticmethod
+    def unfinished(entries: Dict[str, Dict]) -> List[str]:
+        """Files that were queued, in flight or failed, in the order they were journaled"""
+        return [path for path, entry in entries.items() if entry['state'] not in FINISHED_STATES]
+
+    @staticmethod
+    def last_template(entries: Dict[str, Dict]) -> Optional[str]:
+        templates = [entry['template'] for entry in entries.values() if entry.get('template')]
+        return templates[-1] if templates else None
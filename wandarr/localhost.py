@@ -1,10 +1,10 @@
 import os
 import datetime
 import traceback
-from queue import Queue
 
 import wandarr
 from .base import RemoteHostProperties, EncodeJob, ManagedHost
+from .scheduler import Scheduler
 from .utils import filter_threshold
 
 
@@ -12,8 +12,8 @@ class LocalHost(ManagedHost):
     """Implementation of a worker thread when the local machine is in the same cluster.
     Pretty much the same as the LocalHost class but without multiple dedicated queues"""
 
-    def __init__(self, hostname, props: RemoteHostProperties, queue: Queue):
-        super().__init__(hostname, props, queue)
+    def __init__(self, hostname, props: RemoteHostProperties, scheduler: Scheduler):
+        super().__init__(hostname, props, scheduler)
 
     #
     # initiate tests through here to avoid a new thread
@@ -29,9 +29,8 @@ class LocalHost(ManagedHost):
 
     def go(self):
 
-        while not self.queue.empty():
+        while (job := self.next_job()) is not None:
             try:
-                job: EncodeJob = self.queue.get()
 
                 in_path = job.in_path
 
@@ -78,6 +77,7 @@ class LocalHost(ManagedHost):
                 #
                 if code is None:
                     # was vetoed by threshold checker, clean up
+                    self.job_skipped(job)
                     self.complete(in_path, (job_stop - job_start).seconds)
                     os.remove(out_path)
                     continue
@@ -85,6 +85,7 @@ class LocalHost(ManagedHost):
                 if code == 0:
                     wandarr.status_queue.put({'host': f"{self.hostname}/{self.engine_name}", 'file': basename, 'completed': 100})
                     if not filter_threshold(job.template, in_path, out_path):
+                        self.job_skipped(job)
                         self.complete(in_path, (job_stop - job_start).seconds)
                         os.remove(out_path)
                         continue
@@ -105,6 +106,7 @@ class LocalHost(ManagedHost):
                                                   'status': f'{orig_file_size_mb}mb -> {new_filesize_mb}mb'})
 
                 elif code is not None:
+                    self.job_failed(job, f"ffmpeg exit code {code}")
                     self.log(f'Did not complete normally: {self.ffmpeg.last_command}')
                     self.log(f'Output can be found in {self.ffmpeg.log_path}')
                     try:
@@ -112,7 +114,8 @@ class LocalHost(ManagedHost):
                     except OSError:
                         pass
 
-            except Exception:
+            except Exception as ex:
+                self.job_failed(job, str(ex))
                 self.log(traceback.format_exc())
             finally:
-                self.queue.task_done()
+                self.job_done(job)
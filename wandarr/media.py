@@ -68,6 +68,31 @@ class MediaInfo:
         self.audio: List[StreamInfoWrapper] = info['audio']
         self.subtitle: List[StreamInfoWrapper] = info['subtitle']
 
+    def to_dict(self) -> Dict:
+        """Plain dictionary form, suitable for json serialization"""
+        return {
+            'path': self.path,
+            'vcodec': self.vcodec,
+            'frames': self.frames,
+            'stream': self.stream,
+            'res_height': self.res_height,
+            'res_width': self.res_width,
+            'runtime': self.runtime,
+            'filesize_mb': self.filesize_mb,
+            'fps': self.fps,
+            'colorspace': self.colorspace,
+            'audio': [a.data for a in self.audio],
+            'subtitle': [s.data for s in self.subtitle],
+        }
+
+    @staticmethod
+    def from_dict(info: Dict) -> 'MediaInfo':
+        """Inverse of to_dict()"""
+        info = dict(info)
+        info['audio'] = [StreamInfoWrapper(a) for a in info['audio']]
+        info['subtitle'] = [StreamInfoWrapper(s) for s in info['subtitle']]
+        return MediaInfo(info)
+
     def __str__(self):
         runtime = "{:0>8}".format(str(timedelta(seconds=self.runtime)))
         for a in self.audio:
@@ -94,6 +119,9 @@ class MediaInfo:
 
     @staticmethod
     def show_info(use_rich, files, ffmpeg):
+        """
+        :param ffmpeg:  anything providing fetch_details(path), normally a Prober
+        """
         if use_rich:
             console = Console()
             table = Table(title="Technical Details")
@@ -1,18 +1,18 @@
 import datetime
 import os
 import traceback
-from queue import Queue
 
 import wandarr
 from .base import ManagedHost, RemoteHostProperties, EncodeJob
+from .scheduler import Scheduler
 from .utils import filter_threshold
 
 
 class MountedManagedHost(ManagedHost):
     """Implementation of a mounted host worker thread"""
 
-    def __init__(self, hostname, props: RemoteHostProperties, queue: Queue):
-        super().__init__(hostname, props, queue)
+    def __init__(self, hostname, props: RemoteHostProperties, scheduler: Scheduler):
+        super().__init__(hostname, props, scheduler)
 
         # last modified paths - used for testing
         self.remote_in_path = None
@@ -30,12 +30,13 @@ class MountedManagedHost(ManagedHost):
     def run(self):
         if self.host_ok():
             self.go()
+        else:
+            self.scheduler.retire(self.worker_name)
 
     def go(self):
 
-        while not self.queue.empty():
+        while (job := self.next_job()) is not None:
             try:
-                job: EncodeJob = self.queue.get()
                 in_path = job.in_path
                 orig_file_size_mb = int(os.path.getsize(in_path) / (1024 * 1024))
 
@@ -92,12 +93,14 @@ class MountedManagedHost(ManagedHost):
                 #
                 if code is None:
                     # was vetoed by threshold checker, clean up
+                    self.job_skipped(job)
                     self.complete(in_path, (job_stop - job_start).seconds)
                     os.remove(out_path)
                     continue
 
                 if code == 0:
                     if not filter_threshold(job.template, in_path, out_path):
+                        self.job_skipped(job)
                         self.complete(in_path, (job_stop - job_start).seconds)
                         os.remove(out_path)
                         continue
@@ -117,6 +120,7 @@ class MountedManagedHost(ManagedHost):
                                                   'completed': 100,
                                                   'status': f'{orig_file_size_mb}mb -> {new_filesize_mb}mb'})
                 elif code is not None:
+                    self.job_failed(job, f"ffmpeg exit code {code}")
                     self.log(f'Did not complete normally: {self.ffmpeg.last_command}')
                     self.log(f'Output can be found in {self.ffmpeg.log_path}')
                     try:
@@ -124,7 +128,8 @@ class MountedManagedHost(ManagedHost):
                     except OSError:
                         pass
 
-            except Exception:
+            except Exception as ex:
+                self.job_failed(job, str(ex))
                 print(traceback.format_exc())
             finally:
-                self.queue.task_done()
+                self.job_done(job)
@@ -0,0 +1,110 @@
+"""
+    Media probe stage - runs ffprobe/ffmpeg across a pool of workers
+"""
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Iterator, List, Optional, Tuple
+
+import wandarr
+from wandarr.config import ConfigFile
+from wandarr.ffmpeg import FFmpeg
+from wandarr.media import MediaInfo
+from wandarr.probecache import ProbeCache
+
+PROBE_STATUS_NAME = "media probe"
+
+
+def _probe(ffmpeg_path: str, path: str) -> Tuple[Optional[MediaInfo], Optional[str]]:
+    """Worker entry point. Module-level so it can be pickled when using a process pool."""
+    try:
+        return FFmpeg(ffmpeg_path).fetch_details(path), None
+    except Exception as ex:
+        return None, str(ex)
+
+
+class Prober:
+    """Fetch media details for one or many files, optionally in parallel"""
+
+    def __init__(self, ffmpeg: FFmpeg, workers: int = 1, mode: str = "thread", cache: ProbeCache = None):
+        """
+        :param ffmpeg:      FFmpeg instance for the controller host
+        :param workers:     Maximum number of concurrent probes
+        :param mode:        "thread" or "process"
+        :param cache:       Optional persistent cache of earlier probe results
+        """
+        if mode not in ["thread", "process"]:
+            raise ValueError(f"Unknown probe mode '{mode}' - must be thread or process")
+        self.ffmpeg = ffmpeg
+        self.workers = max(1, workers)
+        self.mode = mode
+        self.cache = cache
+
+    @staticmethod
+    def from_config(config: ConfigFile) -> 'Prober':
+        cache = None
+        if config.probe_cache_path:
+            try:
+                cache = ProbeCache(config.probe_cache_path, config.probe_cache_size)
+            except sqlite3.Error as ex:
+                print(f"Probe cache {config.probe_cache_path} unavailable: {ex}")
+        return Prober(FFmpeg(config.ffmpeg_path), config.probe_workers, config.probe_mode, cache)
+
+    def fetch_details(self, path: str) -> MediaInfo:
+        """Same contract as FFmpeg.fetch_details, for a single file"""
+        # cache is keyed by absolute path, same as the paths given by the cluster
+        path = os.path.abspath(path)
+        if self.cache:
+            media_info = self.cache.get(path)
+            if media_info:
+                return media_info
+        media_info = self.ffmpeg.fetch_details(path)
+        if self.cache:
+            self.cache.put(path, media_info)
+        return media_info
+
+    def _executor(self):
+        if self.mode == "process":
+            return ProcessPoolExecutor(max_workers=self.workers)
+        return ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="probe")
+
+    def fetch_all(self, paths: List[str]) -> Iterator[Tuple[str, Optional[MediaInfo]]]:
+        """Probe all paths, yielding (path, MediaInfo) in the same order as given.
+           A MediaInfo of None means the probe failed and the reason has been printed.
+        """
+        total = len(paths)
+        if total == 0:
+            return
+
+        # cache lookups stay in this thread so process workers never touch the database
+        cached = [self.cache.get(p) if self.cache else None for p in paths]
+        misses = [p for p, mi in zip(paths, cached) if mi is None]
+
+        if self.workers == 1 or len(misses) <= 1:
+            probed = map(lambda p: _probe(self.ffmpeg.path, p), misses)
+            yield from self._report(paths, cached, probed, total)
+        else:
+            with self._executor() as executor:
+                probed = executor.map(_probe, [self.ffmpeg.path] * len(misses), misses)
+                yield from self._report(paths, cached, probed, total)
+
+    def _report(self, paths: List[str], cached: List, probed, total: int) -> Iterator[Tuple[str, Optional[MediaInfo]]]:
+        for done, (path, media_info) in enumerate(zip(paths, cached), start=1):
+            if media_info is None:
+                media_info, error = next(probed)
+                if error:
+                    print(f"Unable to probe {path}: {error}")
+                elif self.cache:
+                    self.cache.put(path, media_info)
+            wandarr.status_queue.put({'host': 'controller',
+                                      'file': PROBE_STATUS_NAME,
+                                      'completed': int((done * 100) / total),
+                                      'status': f'Probed {done}/{total}'})
+            yield path, media_info
+
+    def close(self):
+        if self.cache:
+            if wandarr.VERBOSE:
+                print(self.cache.stats())
+            self.cache.close()
+            self.cache = None
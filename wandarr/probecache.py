@@ -0,0 +1,103 @@
+"""
+    Persistent cache of media probe results
+"""
+import json
+import os
+import sqlite3
+import time
+from threading import Lock
+from typing import Optional
+
+from wandarr.media import MediaInfo
+
+
+class ProbeCache:
+    """MediaInfo results keyed by absolute path, invalidated by a change in file size or mtime.
+       Least recently used entries are evicted once max_entries is exceeded.
+    """
+
+    COMMIT_EVERY = 100
+
+    def __init__(self, db_path: str, max_entries: int = 50_000):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._pending = 0
+        self._lock = Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS probe (
+                                path TEXT PRIMARY KEY,
+                                size INTEGER NOT NULL,
+                                mtime INTEGER NOT NULL,
+                                info TEXT NOT NULL,
+                                last_used REAL NOT NULL)""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS probe_last_used ON probe(last_used)")
+        self._db.commit()
+        self._count = self._db.execute("SELECT COUNT(*) FROM probe").fetchone()[0]
+
+    @staticmethod
+    def _stat(path: str):
+        st = os.stat(path)
+        return st.st_size, st.st_mtime_ns
+
+    def get(self, path: str) -> Optional[MediaInfo]:
+        """Return the cached details for path, or None if absent or stale"""
+        try:
+            size, mtime = self._stat(path)
+        except OSError:
+            return None
+        with self._lock:
+            row = self._db.execute("SELECT size, mtime, info FROM probe WHERE path = ?", (path,)).fetchone()
+            if row is None or row[0] != size or row[1] != mtime:
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE probe SET last_used = ? WHERE path = ?", (time.time(), path))
+            self._dirty()
+            self.hits += 1
+        return MediaInfo.from_dict(json.loads(row[2]))
+
+    def put(self, path: str, media_info: MediaInfo):
+        if not media_info or not media_info.valid:
+            return
+        try:
+            size, mtime = self._stat(path)
+        except OSError:
+            return
+        info = json.dumps(media_info.to_dict())
+        with self._lock:
+            exists = self._db.execute("SELECT 1 FROM probe WHERE path = ?", (path,)).fetchone()
+            self._db.execute("INSERT OR REPLACE INTO probe (path, size, mtime, info, last_used) "
+                             "VALUES (?, ?, ?, ?, ?)", (path, size, mtime, info, time.time()))
+            if not exists:
+                self._count += 1
+            if self._count > self.max_entries:
+                self._evict(self._count - self.max_entries)
+            self._dirty()
+
+    def _evict(self, count: int):
+        self._db.execute("DELETE FROM probe WHERE path IN "
+                         "(SELECT path FROM probe ORDER BY last_used LIMIT ?)", (count,))
+        self.evictions += count
+        self._count -= count
+
+    def _dirty(self):
+        self._pending += 1
+        if self._pending >= self.COMMIT_EVERY:
+            self._db.commit()
+            self._pending = 0
+
+    @property
+    def entries(self) -> int:
+        return self._count
+
+    def stats(self) -> str:
+        return f"probe cache: {self.hits} hits, {self.misses} misses, {self.evictions} evicted, {self._count} entries"
+
+    def close(self):
+        with self._lock:
+            self._db.commit()
+            self._db.close()
@@ -0,0 +1,132 @@
+"""
+    Framed agent protocol (version 2 and up)
+
+    After the HELLO handshake every message is a 5 byte header - type (1 byte) and payload length
+    (4 bytes, network order) - followed by the payload. The agent streams ffmpeg output without
+    waiting for acknowledgement, and the controller can send VETO or STOP at any time.
+    Version 1 is the original protocol of unframed strings with an ACK for every line of output.
+    Version 3 adds a job mode message after the handshake - either UPLOAD (source file follows
+    unframed, as before) or STREAM (source sent as INPUT messages and the encode returned as RESULT
+    messages while ffmpeg runs).
+    Version 4 adds the PREFETCH job mode - the source is uploaded as for UPLOAD, acknowledged with STAGED,
+    and the agent holds it until the controller sends START. Dropping the connection first discards it.
+    Version 5 checks and resumes file transfers. The UPLOAD and PREFETCH payload is a key identifying the
+    source, and the agent answers with OFFSET - how much of it is already there from an interrupted upload.
+    Both uploads and results are followed by a CHECKSUM of the whole file, and the controller sends ACK once
+    a result checks out. A result whose transfer broke off is continued on a new connection opened with
+    "RESUME|key|offset" instead of a HELLO, which the agent answers with DONE and the rest of the file.
+    Version 6 adds the source's content fingerprint to the UPLOAD and PREFETCH payload ("key|fingerprint").
+    An agent that has the source cached from an earlier job answers CACHED instead of OFFSET and no upload follows.
+    Version 7 moves stats parsing to the agent. The controller sends MONITOR straight after the handshake with
+    how often it wants progress ("seconds", or "seconds|log" for the full ffmpeg output as well) and the agent
+    sends PROGRESS messages of parsed stats instead of every line of output. The output is only sent ahead of
+    an ERR, so the controller can still log why a transcode failed.
+"""
+import socket
+import struct
+from threading import Lock
+from typing import Tuple, Union
+
+PROTOCOL_VERSION = 7
+
+# agent -> controller
+MSG_OUTPUT = 1      # one line of ffmpeg output
+MSG_DONE = 2        # "DONE|exitcode|filesize"
+MSG_ERR = 3         # "ERR|exitcode or output"
+MSG_RESULT = 4      # chunk of the encoded file, streaming mode
+MSG_STAGED = 5      # prefetched source received, waiting for START
+MSG_OFFSET = 6      # v5 - bytes of the source already received, the upload continues from there
+MSG_CACHED = 7      # v6 - source is in the agent's cache, nothing to upload
+MSG_PROGRESS = 8    # v7 - JSON of the latest ffmpeg stats (frame, fps, q, size, time, speed)
+# controller -> agent
+MSG_ACK = 10        # ready to receive the result file, and (v5) result received intact
+MSG_VETO = 11       # threshold not met, abandon the transcode
+MSG_STOP = 12       # controller is shutting down
+MSG_UPLOAD = 13     # v3 job mode - the source file follows unframed
+MSG_STREAM = 14     # v3 job mode - payload is the output format for ffmpeg, source follows as MSG_INPUT
+MSG_INPUT = 15      # chunk of the source file, streaming mode
+MSG_INPUT_END = 16  # all of the source has been sent
+MSG_PREFETCH = 17   # v4 job mode - the source file follows unframed, hold it until START
+MSG_START = 18      # begin the prefetched transcode
+MSG_MONITOR = 19    # v7 - progress interval wanted, "seconds" or "seconds|log"
+# either way
+MSG_CHECKSUM = 20   # v5 - hex digest of the whole file just sent
+
+# size of the INPUT and RESULT messages carrying file data in streaming mode
+STREAM_CHUNK = 1024 * 1024
+
+_HEADER = struct.Struct("!BI")
+# sanity limit - streamed file data is sent in chunks well under this
+MAX_PAYLOAD = 16 * 1024 * 1024
+
+
+def offer(hello: str) -> str:
+    """Add the protocol version this controller speaks to a HELLO/HELLOS message"""
+    return f"{hello}|proto={PROTOCOL_VERSION}"
+
+
+def accept(hello: str) -> Tuple[str, int]:
+    """Agent side - split the protocol offer from a HELLO message, returning the hello without it and
+       the version both ends support. Older controllers make no offer and get version 1.
+    """
+    base, _, field = hello.rpartition("|")
+    if base and field.startswith("proto="):
+        try:
+            return base, min(int(field[6:]), PROTOCOL_VERSION)
+        except ValueError:
+            pass
+    return hello, 1
+
+
+def accepted_reply(hello: str, version: int) -> str:
+    """Agent reply to a HELLO carrying an offer. Older agents just echo the hello, so the controller can tell them apart."""
+    return f"{hello}|accept={version}"
+
+
+def negotiated(hello: str, reply: str) -> int:
+    """Controller side - protocol version from the agent's reply to an offered hello, 0 if the reply is not valid"""
+    if reply == hello:
+        # older agent echoing the hello back
+        return 1
+    prefix = hello + "|accept="
+    if reply.startswith(prefix):
+        try:
+            return int(reply[len(prefix):])
+        except ValueError:
+            pass
+    return 0
+
+
+def send_frame(sock: socket.socket, mtype: int, payload: Union[str, bytes] = b""):
+    if isinstance(payload, str):
+        payload = payload.encode()
+    sock.sendall(_HEADER.pack(mtype, len(payload)) + payload)
+
+
+class FrameSender:
+    """Send frames on a socket shared by several threads without interleaving them"""
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self._lock = Lock()
+
+    def send(self, mtype: int, payload: Union[str, bytes] = b""):
+        with self._lock:
+            send_frame(self.sock, mtype, payload)
+
+
+def _recv_exact(sock: socket.socket, size: int) -> bytes:
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            raise ConnectionError("connection closed mid-message")
+        buf.extend(chunk)
+    return bytes(buf)
+
+
+def recv_frame(sock: socket.socket) -> Tuple[int, bytes]:
+    mtype, length = _HEADER.unpack(_recv_exact(sock, _HEADER.size))
+    if length > MAX_PAYLOAD:
+        raise ConnectionError(f"message of {length} bytes exceeds protocol limit")
+    return mtype, _recv_exact(sock, length) if length else b""
@@ -0,0 +1,492 @@
+"""
+    Central job scheduler shared by all host threads
+"""
+import bisect
+import datetime
+import os
+import time
+from pathlib import PurePath
+from tempfile import gettempdir
+from threading import Condition
+from typing import Dict, List, Optional, Tuple
+
+import wandarr
+from wandarr.base import EncodeJob
+from wandarr import journal as jstate
+from wandarr.journal import Journal
+from wandarr.throughput import ThroughputModel
+
+ORDER_FIFO = "fifo"
+ORDER_LPT = "lpt"
+ORDER_SMALLEST = "smallest"
+ORDER_POLICIES = [ORDER_FIFO, ORDER_LPT, ORDER_SMALLEST]
+
+
+def order_key(order: str):
+    """Sort key for pending jobs under a dispatch order policy. Jobs with equal keys stay in submission order."""
+    if order == ORDER_LPT:
+        # longest processing time first - big jobs start early so they don't run alone at the end of the batch
+        return lambda job: -job.estimated_work()
+    if order == ORDER_SMALLEST:
+        return lambda job: job.estimated_work()
+    return lambda job: 0
+
+
+class Scheduler:
+    """Hands out jobs to host threads on request.
+
+       There is a single pending list for all qualities. When a host thread asks for work it is given the
+       first pending job whose quality one of its engines can encode, so an idle host is never stuck waiting
+       on its "own" queue while compatible work remains elsewhere.
+       A host may have several threads (engines and engine slots) but never runs more jobs at once than
+       its slot count, no matter which thread asks.
+       Pending jobs are kept in dispatch order (see ORDER_POLICIES). Since jobs arrive while probing is still
+       going, any order other than fifo holds dispatch until probing is done or order_window seconds have
+       passed since the first job arrived, otherwise idle hosts would just take whatever was probed first.
+       With a ThroughputModel, a job is only handed to a thread if no other host is expected to finish it
+       sooner, taking into account what every host is already running.
+       A failed job is put back with a backoff delay and is given to a different host if one can take it.
+       A host that fails several jobs in a row is quarantined for the rest of the run.
+       Every decision is written to an audit log for checking utilisation after the run, and job state
+       changes to the optional Journal so an interrupted batch can be resumed.
+    """
+
+    # how many compatible pending jobs to consider when looking for one this host is best at
+    LOOKAHEAD = 200
+    # how often a thread waiting on a faster host re-checks the estimates
+    REEVALUATE_SECS = 15
+    # another host must be at least this much faster before a job is held back for it
+    MARGIN = 0.95
+    # seconds a host that said it was busy gets no new work
+    BUSY_REST = 15
+
+    def __init__(self, order: str = ORDER_FIFO, model: ThroughputModel = None, log_path: str = None,
+                 max_attempts: int = 3, retry_backoff: float = 30, quarantine_after: int = 3,
+                 order_window: float = 120, journal: Journal = None):
+        """
+        :param order:               Dispatch order policy, one of ORDER_POLICIES
+        :param model:               Optional learned throughput, used to pick the fastest host for each job
+        :param log_path:            Audit log location, defaults to the temp directory
+        :param max_attempts:        Times a job is tried before giving up on it
+        :param retry_backoff:       Seconds to wait before the first retry, doubled for each one after
+        :param quarantine_after:    Consecutive failures before a host is given no more work
+        :param order_window:        Longest to hold dispatch waiting for probing to finish when not fifo
+        :param journal:             Optional write-ahead record of job state for --resume
+        """
+        if order not in ORDER_POLICIES:
+            raise ValueError(f"Unknown dispatch order '{order}' - must be one of {', '.join(ORDER_POLICIES)}")
+        self.order = order
+        self._order_key = order_key(order)
+        self.model = model
+        self.journal = journal
+        self.order_window = order_window
+        self._first_submit: Optional[float] = None
+        self.pending: List[EncodeJob] = []
+        self.closed = False
+        self.cond = Condition()
+        self.capabilities: Dict[str, set] = {}   # worker name -> qualities
+        self.worker_host: Dict[str, str] = {}
+        self.worker_engine: Dict[str, str] = {}
+        self.retired = set()
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.quarantine_after = quarantine_after
+        self.quarantined = set()
+        self.consecutive_failures: Dict[str, int] = {}
+        self.failed: List[EncodeJob] = []
+        self.host_slots: Dict[str, int] = {}
+        self.host_running: Dict[str, int] = {}
+        self.busy_time: Dict[str, float] = {}
+        self.idle_time: Dict[str, float] = {}
+        self.dispatched: Dict[str, int] = {}
+        self._current: Dict[str, Tuple[EncodeJob, float]] = {}
+        # seconds each job spent encoding, kept from the time its slot is freed until it is done
+        self._encode_secs: Dict[str, float] = {}
+        self._rest_until: Dict[str, float] = {}   # host -> monotonic time a busy host can be tried again
+        self.host_prefetch: Dict[str, int] = {}
+        self.host_staged: Dict[str, int] = {}
+        # one log per process, appended to, so concurrent runs don't clobber each other's audit trail
+        self.log_path = log_path or str(PurePath(gettempdir(), f'wandarr-scheduler-{os.getpid()}.log'))
+        self._log = open(self.log_path, 'a', encoding="utf8")
+
+    def register(self, worker: str, qualities, host: str = None, engine: str = None):
+        """Declare a host thread and the qualities it can encode"""
+        with self.cond:
+            self.capabilities[worker] = set(qualities)
+            self.worker_host[worker] = host or worker
+            self.worker_engine[worker] = engine or worker
+            self.host_running.setdefault(host or worker, 0)
+            self.busy_time.setdefault(worker, 0.0)
+            self.idle_time.setdefault(worker, 0.0)
+            self.dispatched.setdefault(worker, 0)
+
+    def retire(self, worker: str):
+        """Host thread has stopped and will take no more work"""
+        with self.cond:
+            self.retired.add(worker)
+            self.cond.notify_all()
+
+    def set_slots(self, host: str, slots: int):
+        """Limit how many jobs may run at once on a host"""
+        with self.cond:
+            self.host_slots[host] = slots
+
+    def set_prefetch(self, host: str, count: int):
+        """Allow up to count jobs to be staged on a host ahead of a free slot"""
+        with self.cond:
+            self.host_prefetch[host] = count
+
+    def _slot_free(self, worker: str) -> bool:
+        host = self.worker_host.get(worker, worker)
+        slots = self.host_slots.get(host)
+        return slots is None or self.host_running.get(host, 0) < slots
+
+    def supports(self, quality: str) -> bool:
+        return any(quality in q for q in self.capabilities.values())
+
+    def submit(self, job: EncodeJob):
+        with self.cond:
+            if self._first_submit is None:
+                self._first_submit = time.monotonic()
+            bisect.insort(self.pending, job, key=self._order_key)
+            self._journal(jstate.QUEUED, job, template=job.template.name(), quality=job.quality)
+            self.log(f"queued {os.path.basename(job.in_path)} quality={job.quality} "
+                     f"work={job.estimated_work():.3g} order={self.order} pending={len(self.pending)}")
+            self.cond.notify_all()
+
+    def close(self):
+        """No more jobs will be submitted - wake up any waiting host threads"""
+        with self.cond:
+            self.closed = True
+            self.log(f"closed pending={len(self.pending)}")
+            self.cond.notify_all()
+
+    def pending_count(self, quality: str = None) -> int:
+        with self.cond:
+            return len([j for j in self.pending if quality is None or j.quality == quality])
+
+    def _resting(self, worker: str) -> float:
+        """Seconds until the worker's host, having said it was busy, should be offered work again"""
+        until = self._rest_until.get(self.worker_host.get(worker, worker))
+        return max(0.0, until - time.monotonic()) if until else 0
+
+    def _active(self, worker: str) -> bool:
+        return worker not in self.retired and self.worker_host.get(worker, worker) not in self.quarantined
+
+    def _compatible(self, worker: str) -> Optional[int]:
+        """First pending job this worker could ever run, ignoring retry delays and failed hosts"""
+        qualities = self.capabilities.get(worker, set())
+        for i, job in enumerate(self.pending):
+            if job.quality in qualities:
+                return i
+        return None
+
+    def _eligible(self, worker: str, job: EncodeJob, now: float) -> bool:
+        if job.quality not in self.capabilities.get(worker, set()) or job.not_before > now:
+            return False
+        if self.worker_host[worker] in job.failed_hosts:
+            # only try the same host again if there's nowhere else left to send it
+            return not any(self._active(w) and job.quality in self.capabilities[w]
+                           and self.worker_host[w] not in job.failed_hosts for w in self.capabilities)
+        return True
+
+    def _first_eligible(self, worker: str) -> Optional[int]:
+        now = time.monotonic()
+        for i, job in enumerate(self.pending):
+            if self._eligible(worker, job, now):
+                return i
+        return None
+
+    def _next_retry(self, worker: str) -> Optional[float]:
+        """Seconds until the earliest delayed retry this worker could run"""
+        now = time.monotonic()
+        delays = [job.not_before - now for job in self.pending
+                  if job.quality in self.capabilities.get(worker, set()) and job.not_before > now]
+        return max(0.1, min(delays)) if delays else None
+
+    def _estimate(self, worker: str, job: EncodeJob) -> Optional[float]:
+        if not self.model:
+            return None
+        return self.model.estimate(self.worker_host[worker], self.worker_engine[worker], job.quality, job.media_info)
+
+    def _host_lanes(self, now: float) -> Dict[str, List[float]]:
+        """For each active host, the times its slots are expected to be free to start another job"""
+        threads: Dict[str, int] = {}
+        running: Dict[str, List[float]] = {}
+        for worker in self.capabilities:
+            if not self._active(worker):
+                continue
+            host = self.worker_host[worker]
+            threads[host] = threads.get(host, 0) + 1
+            running.setdefault(host, [])
+            if worker in self._current:
+                job, started = self._current[worker]
+                est = self._estimate(worker, job)
+                running[host].append(now if est is None else max(now, started + est))
+        lanes = {}
+        for host, count in threads.items():
+            capacity = min(self.host_slots.get(host, count), count)
+            idle = max(0, capacity - len(running[host]))
+            lanes[host] = sorted([now] * idle + running[host])[:capacity]
+        return lanes
+
+    def _select_fastest(self, worker: str) -> Tuple[Optional[int], Optional[str]]:
+        """Simulate handing out the pending jobs to whichever host would finish each soonest, and return the
+           first job that lands on this worker's host. Also returns the host a job was held back for, if any.
+        """
+        now = time.monotonic()
+        own_host = self.worker_host[worker]
+        lanes = self._host_lanes(now)
+        held_for = None
+        considered = 0
+        for i, job in enumerate(self.pending):
+            if not self._eligible(worker, job, now):
+                continue
+            own_est = self._estimate(worker, job)
+            if own_est is None:
+                # no history for this host yet, so take it and learn
+                return i, None
+            considered += 1
+            if considered > self.LOOKAHEAD:
+                break
+
+            best_host, best_finish = own_host, lanes[own_host][0] + own_est
+            for other in self.capabilities:
+                other_host = self.worker_host[other]
+                if (not self._active(other) or other_host == own_host or other_host in job.failed_hosts
+                        or job.quality not in self.capabilities[other]):
+                    continue
+                est = self._estimate(other, job)
+                if est is None:
+                    continue
+                finish = lanes[other_host][0] + est
+                # margin applies to the time from now, not the monotonic clock value
+                if finish - now < (best_finish - now) * self.MARGIN:
+                    best_host, best_finish = other_host, finish
+            if best_host == own_host:
+                return i, None
+            # pretend the faster host took it and carry on looking
+            lanes[best_host][0] = best_finish
+            lanes[best_host].sort()
+            held_for = held_for or best_host
+        return None, held_for
+
+    def _ordering_hold(self) -> float:
+        """Seconds left to wait for more jobs to arrive before dispatching in order, 0 if no need to wait"""
+        if self.order == ORDER_FIFO or self.closed or self._first_submit is None:
+            return 0
+        return max(0.0, self._first_submit + self.order_window - time.monotonic())
+
+    def _select(self, worker: str) -> Tuple[Optional[int], Optional[str]]:
+        if (not self._active(worker) or not self._slot_free(worker) or self._ordering_hold()
+                or self._resting(worker)):
+            return None, None
+        if self.model:
+            return self._select_fastest(worker)
+        return self._first_eligible(worker), None
+
+    def next_job(self, worker: str) -> Optional[EncodeJob]:
+        """Block until a job this worker can handle is available. Returns None once closed and no
+           compatible work remains.
+        """
+        wait_start = time.monotonic()
+        deferred = False
+        holding = False
+        with self.cond:
+            while True:
+                index, held_for = self._select(worker)
+                if index is not None:
+                    job = self.pending.pop(index)
+                    self._dispatch(worker, job, time.monotonic() - wait_start)
+                    return job
+                quarantined = self.worker_host[worker] in self.quarantined
+                if quarantined or (self.closed and self._compatible(worker) is None):
+                    self.idle_time[worker] = self.idle_time.get(worker, 0.0) + (time.monotonic() - wait_start)
+                    self.log(f"release {worker} - " + ("host quarantined" if quarantined else "no compatible work remaining"))
+                    self.retired.add(worker)
+                    self.cond.notify_all()
+                    return None
+                if held_for and not deferred:
+                    deferred = True
+                    self.log(f"defer {worker} - pending work expected to finish sooner on {held_for}")
+                hold = self._ordering_hold()
+                if hold and not holding:
+                    holding = True
+                    self.log(f"hold {worker} - waiting up to {hold:.0f}s for probing to finish before {self.order} dispatch")
+                timeouts = [t for t in [self.REEVALUATE_SECS if held_for else None, self._next_retry(worker), hold,
+                                        self._resting(worker)] if t]
+                self.cond.wait(min(timeouts) if timeouts else None)
+
+    def _dispatch(self, worker: str, job: EncodeJob, waited: float):
+        self.idle_time[worker] = self.idle_time.get(worker, 0.0) + waited
+        self.dispatched[worker] = self.dispatched.get(worker, 0) + 1
+        self._current[worker] = (job, time.monotonic())
+        host = self.worker_host.get(worker, worker)
+        self.host_running[host] = self.host_running.get(host, 0) + 1
+        self._journal(jstate.STARTED, job, host=worker)
+        est = self._estimate(worker, job)
+        self.log(f"dispatch {os.path.basename(job.in_path)} quality={job.quality} -> {worker} "
+                 f"waited={waited:.1f}s pending={len(self.pending)} "
+                 f"slots={self.host_running[host]}/{self.host_slots.get(host, '-')}"
+                 + (f" est={est:.0f}s" if est is not None else ""))
+
+    def prefetch(self, worker: str) -> Optional[EncodeJob]:
+        """Without waiting, hand out the job this worker would run next so its source can be staged on the
+           host while the current job encodes. None if there is no such job yet or the host already holds
+           as many staged jobs as allowed.
+        """
+        with self.cond:
+            host = self.worker_host.get(worker, worker)
+            if (self.host_staged.get(host, 0) >= self.host_prefetch.get(host, 0)
+                    or not self._active(worker) or self._ordering_hold() or self._resting(worker)):
+                return None
+            index = self._select_fastest(worker)[0] if self.model else self._first_eligible(worker)
+            if index is None:
+                return None
+            job = self.pending.pop(index)
+            self.host_staged[host] = self.host_staged.get(host, 0) + 1
+            self.log(f"prefetch {os.path.basename(job.in_path)} quality={job.quality} -> {worker} "
+                     f"staged={self.host_staged[host]}/{self.host_prefetch[host]}")
+            return job
+
+    def start_staged(self, worker: str, job: EncodeJob) -> bool:
+        """Wait for a free slot to encode a job this worker prefetched. Returns False, putting the job
+           back, if the host has been quarantined in the meantime.
+        """
+        wait_start = time.monotonic()
+        with self.cond:
+            while self._active(worker) and not self._slot_free(worker):
+                self.cond.wait()
+            if not self._active(worker):
+                self._unstage(worker, job)
+                return False
+            host = self.worker_host.get(worker, worker)
+            self.host_staged[host] = max(0, self.host_staged.get(host, 0) - 1)
+            self._dispatch(worker, job, time.monotonic() - wait_start)
+            return True
+
+    def unstage(self, worker: str, job: EncodeJob):
+        """A prefetched job could not be staged, so put it back for any host to take"""
+        with self.cond:
+            self._unstage(worker, job)
+
+    def _unstage(self, worker: str, job: EncodeJob):
+        host = self.worker_host.get(worker, worker)
+        self.host_staged[host] = max(0, self.host_staged.get(host, 0) - 1)
+        bisect.insort(self.pending, job, key=self._order_key)
+        self.log(f"unstage {os.path.basename(job.in_path)} from {worker}")
+        self.cond.notify_all()
+
+    def _release(self, worker: str, job: EncodeJob):
+        """Free the slot a job was encoding in, if it still holds it"""
+        current = self._current.get(worker)
+        if current is None or current[0] is not job:
+            return
+        del self._current[worker]
+        elapsed = time.monotonic() - current[1]
+        host = self.worker_host.get(worker, worker)
+        self.busy_time[worker] = self.busy_time.get(worker, 0.0) + elapsed
+        self.host_running[host] = max(0, self.host_running.get(host, 0) - 1)
+        self._encode_secs[job.in_path] = elapsed
+        self.cond.notify_all()
+
+    def encode_finished(self, worker: str, job: EncodeJob):
+        """Encode is over but the result is still being retrieved in the background. Frees the slot for
+           the next job, job_done is still to come.
+        """
+        with self.cond:
+            self._release(worker, job)
+
+    def job_done(self, worker: str, job: EncodeJob, failure: str = None, skipped: bool = False,
+                 deferred: bool = False):
+        """Host thread has finished with a job. A failure reason means it should be retried elsewhere,
+           skipped means it was abandoned for not meeting the template threshold, and deferred means the
+           host was too busy to take it.
+        """
+        with self.cond:
+            host = self.worker_host.get(worker, worker)
+            self._release(worker, job)
+            elapsed = self._encode_secs.pop(job.in_path, None)
+            if deferred:
+                # not the job's fault, so no attempt is counted - just give the host a rest
+                self._rest_until[host] = time.monotonic() + self.BUSY_REST
+                job.speeds = []
+                bisect.insort(self.pending, job, key=self._order_key)
+                self.log(f"busy {host} - {os.path.basename(job.in_path)} put back, no work for {host} for {self.BUSY_REST}s")
+                self.cond.notify_all()
+                return
+            if elapsed is not None:
+                if failure:
+                    self.log(f"done {os.path.basename(job.in_path)} on {worker} in {elapsed:.1f}s (failed)")
+                else:
+                    # a failed attempt says nothing useful about how fast this host is
+                    speed = (sum(job.speeds) / len(job.speeds)) if job.speeds else None
+                    if self.model and speed:
+                        self.model.record(host, self.worker_engine.get(worker, worker), job.quality, job.media_info, speed)
+                    self.log(f"done {os.path.basename(job.in_path)} on {worker} in {elapsed:.1f}s"
+                             + (f" speed={speed:.2f}x" if speed else ""))
+            if failure:
+                self._job_failed(worker, job, failure)
+            else:
+                self.consecutive_failures[host] = 0
+                self._journal(jstate.SKIPPED if skipped else jstate.COMPLETED, job, host=worker)
+            # a slot has been freed up for the other threads on this host
+            self.cond.notify_all()
+
+    def _job_failed(self, worker: str, job: EncodeJob, failure: str):
+        host = self.worker_host.get(worker, worker)
+        basename = os.path.basename(job.in_path)
+        job.attempts += 1
+        job.failed_hosts.add(host)
+        self.consecutive_failures[host] = self.consecutive_failures.get(host, 0) + 1
+        self.log(f"failed {basename} on {worker} attempt={job.attempts}/{self.max_attempts}: {failure}")
+
+        if self.consecutive_failures[host] >= self.quarantine_after and host not in self.quarantined:
+            self.quarantined.add(host)
+            self.log(f"quarantine {host} after {self.consecutive_failures[host]} consecutive failures")
+
+        self._journal(jstate.FAILED, job, host=worker, reason=failure, attempts=job.attempts)
+        if job.attempts < self.max_attempts:
+            delay = self.retry_backoff * (2 ** (job.attempts - 1))
+            job.not_before = time.monotonic() + delay
+            job.speeds = []
+            bisect.insort(self.pending, job, key=self._order_key)
+            self.log(f"retry {basename} in {delay:.0f}s, avoiding {', '.join(sorted(job.failed_hosts))}")
+        else:
+            self.failed.append(job)
+            self.log(f"giving up on {basename} after {job.attempts} attempts")
+
+    def _journal(self, state: str, job: EncodeJob, **fields):
+        if self.journal:
+            self.journal.record(state, job.in_path, **fields)
+
+    def log(self, message: str):
+        if self._log.closed:
+            return
+        self._log.write(f"{datetime.datetime.now().isoformat(timespec='seconds')} {message}\n")
+        self._log.flush()
+        if wandarr.VERBOSE:
+            print(f"scheduler: {message}")
+
+    def utilisation(self) -> List[str]:
+        """Per-worker summary of jobs dispatched and time spent busy vs idle"""
+        lines = []
+        with self.cond:
+            for worker in self.capabilities:
+                busy = self.busy_time.get(worker, 0.0)
+                idle = self.idle_time.get(worker, 0.0)
+                pct = int((busy * 100) / (busy + idle)) if busy + idle > 0 else 0
+                lines.append(f"{worker:30} jobs={self.dispatched.get(worker, 0):4} "
+                             f"busy={int(busy):6}s idle={int(idle):6}s util={pct:3}%")
+        return lines
+
+    def shutdown(self):
+        """Write the utilisation summary and close the audit log"""
+        for line in self.utilisation():
+            self.log(f"utilisation {line}")
+        with self.cond:
+            self._log.close()
+            if self.model:
+                self.model.close()
+            if self.journal:
+                self.journal.close()
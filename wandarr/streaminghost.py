@@ -2,19 +2,19 @@ import os
 import datetime
 import shutil
 import traceback
-from queue import Queue
 from tempfile import gettempdir
 
 import wandarr
 from wandarr.base import ManagedHost, RemoteHostProperties, EncodeJob
+from wandarr.scheduler import Scheduler
 from wandarr.utils import filter_threshold, run, get_local_os_type
 
 
 class StreamingManagedHost(ManagedHost):
     """Implementation of a streaming host worker thread"""
 
-    def __init__(self, hostname, props: RemoteHostProperties, queue: Queue):
-        super().__init__(hostname, props, queue)
+    def __init__(self, hostname, props: RemoteHostProperties, scheduler: Scheduler):
+        super().__init__(hostname, props, scheduler)
 
     #
     # initiate tests through here to avoid a new thread
@@ -28,18 +28,28 @@ class StreamingManagedHost(ManagedHost):
     def run(self):
         if self.host_ok():
             self.go()
+        else:
+            self.scheduler.retire(self.worker_name)
+
+    def remove_remote(self, ssh_cmd: list, remote_out_path: str):
+        if self.props.is_windows():
+            remote_out_path = remote_out_path.replace("/", "\\")
+            if get_local_os_type() == "linux":
+                remote_out_path = remote_out_path.replace(r"\\", "\\")
+            self.run_process([*ssh_cmd, f'del "{remote_out_path}"'])
+        else:
+            self.run_process([*ssh_cmd, f'"rm {remote_out_path}"'])
 
     def go(self):
 
         ssh_cmd = [wandarr.SSH, self.props.user + '@' + self.props.ip]
 
         #
-        # Keep pulling items from the queue until done. Other threads will be pulling from the same queue
+        # Keep pulling jobs from the scheduler until done. Other threads will be pulling from the same scheduler
         # if multiple hosts configured on the same cluster.
         #
-        while not self.queue.empty():
+        while (job := self.next_job()) is not None:
             try:
-                job: EncodeJob = self.queue.get()
                 in_path = job.in_path
 
                 #
@@ -94,6 +104,7 @@ class StreamingManagedHost(ManagedHost):
 
                 code, output = run(scp)
                 if code != 0:
+                    self.job_failed(job, "copy to remote failed")
                     self.log('Unknown error copying source to remote - media skipped', style="magenta")
                     if wandarr.VERBOSE:
                         self.log(output)
@@ -112,6 +123,19 @@ class StreamingManagedHost(ManagedHost):
                 code = self.ffmpeg.run_remote(wandarr.SSH, self.props.user, self.props.ip, cmd,
                                               super().callback_wrapper(job))
                 job_stop = datetime.datetime.now()
+                if code is None:
+                    # vetoed by threshold checker, nothing worth copying back
+                    self.job_skipped(job)
+                    self.complete(in_path, (job_stop - job_start).seconds)
+                    self.remove_remote(ssh_cmd, remote_out_path)
+                    continue
+                if code != 0:
+                    # don't bring back a partial encode, it will be retried
+                    self.job_failed(job, f"ffmpeg exit code {code}")
+                    self.log(f'Did not complete normally: {self.ffmpeg.last_command}')
+                    self.log(f'Output can be found in {self.ffmpeg.log_path}')
+                    self.remove_remote(ssh_cmd, remote_out_path)
+                    continue
 
                 #
                 # copy results back to local
@@ -125,14 +149,9 @@ class StreamingManagedHost(ManagedHost):
                 #
                 # process completed, check results and finish
                 #
-                if code is None:
-                    # was vetoed by threshold checker, clean up
-                    self.complete(in_path, (job_stop - job_start).seconds)
-                    os.remove(retrieved_copy_name)
-                    continue
-
                 if code == 0:
                     if not filter_threshold(job.template, in_path, retrieved_copy_name):
+                        self.job_skipped(job)
 #                        self.log(
 #                            f'Encoding file {in_path} did not meet minimum savings threshold, skipped')
                         self.complete(in_path, (job_stop - job_start).seconds)
@@ -147,21 +166,15 @@ class StreamingManagedHost(ManagedHost):
                             self.log(f'moving media to {in_path}')
                         shutil.move(retrieved_copy_name, in_path)
                 elif code is not None:
-                    self.log(f'error during remote transcode of {in_path}', style="magenta")
-                    self.log(f' Did not complete normally: {self.ffmpeg.last_command}')
-                    self.log(f'Output can be found in {self.ffmpeg.log_path}')
+                    self.job_failed(job, "copy from remote failed")
+                    self.log(f'error retrieving remote transcode of {in_path}', style="magenta")
+                    if wandarr.VERBOSE:
+                        self.log(output)
 
-                if self.props.is_windows():
-                    remote_out_path = remote_out_path.replace("/", "\\")
-                    remote_in_path = remote_in_path.replace("/", "\\")
-                    if get_local_os_type() == "linux":
-                        remote_out_path = remote_out_path.replace(r"\\", "\\")
-                        remote_in_path = remote_in_path.replace(r"\\", "\\")
-                    self.run_process([*ssh_cmd, f'del "{remote_out_path}"'])
-                else:
-                    self.run_process([*ssh_cmd, f'"rm {remote_out_path}"'])
-
-            except Exception:
+                self.remove_remote(ssh_cmd, remote_out_path)
+
+            except Exception as ex:
+                self.job_failed(job, str(ex))
                 print(traceback.format_exc())
             finally:
-                self.queue.task_done()
+                self.job_done(job)
@@ -0,0 +1,85 @@
+"""
+    Learned encode throughput per host, kept across runs
+"""
+import sqlite3
+import time
+from threading import Lock
+from typing import Dict, Optional, Tuple
+
+from wandarr.media import MediaInfo
+
+
+def resolution_bucket(media_info: MediaInfo) -> str:
+    height = media_info.res_height or 0
+    for limit, name in [(576, "sd"), (720, "720p"), (1080, "1080p"), (1440, "1440p")]:
+        if height <= limit:
+            return name
+    return "2160p"
+
+
+class ThroughputModel:
+    """Encode speed (media seconds per wall second, as reported by ffmpeg) averaged per
+       host, engine, quality, source codec and resolution bucket.
+    """
+
+    # weight given to the newest sample in the moving average
+    ALPHA = 0.3
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._lock = Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS throughput (
+                                host TEXT NOT NULL,
+                                engine TEXT NOT NULL,
+                                quality TEXT NOT NULL,
+                                vcodec TEXT NOT NULL,
+                                bucket TEXT NOT NULL,
+                                speed REAL NOT NULL,
+                                samples INTEGER NOT NULL,
+                                updated REAL NOT NULL,
+                                PRIMARY KEY (host, engine, quality, vcodec, bucket))""")
+        self._db.commit()
+        self._speeds: Dict[Tuple, Tuple[float, int]] = {}
+        for row in self._db.execute("SELECT host, engine, quality, vcodec, bucket, speed, samples FROM throughput"):
+            self._speeds[tuple(row[0:5])] = (row[5], row[6])
+
+    @staticmethod
+    def _key(host: str, engine: str, quality: str, media_info: MediaInfo) -> Tuple:
+        return host, engine, quality, media_info.vcodec, resolution_bucket(media_info)
+
+    def speed(self, host: str, engine: str, quality: str, media_info: MediaInfo) -> Optional[float]:
+        """Expected speed for this kind of job, None if there is no history for it"""
+        key = self._key(host, engine, quality, media_info)
+        with self._lock:
+            if key in self._speeds:
+                return self._speeds[key][0]
+            # no history for this source codec, so use anything at the same resolution
+            similar = [speed for k, (speed, _) in self._speeds.items() if k[0:3] == key[0:3] and k[4] == key[4]]
+        if similar:
+            return sum(similar) / len(similar)
+        return None
+
+    def estimate(self, host: str, engine: str, quality: str, media_info: MediaInfo) -> Optional[float]:
+        """Expected wall clock seconds to encode, None if unknown"""
+        speed = self.speed(host, engine, quality, media_info)
+        if not speed or not media_info.runtime:
+            return None
+        return media_info.runtime / speed
+
+    def record(self, host: str, engine: str, quality: str, media_info: MediaInfo, speed: float):
+        if speed <= 0:
+            return
+        key = self._key(host, engine, quality, media_info)
+        with self._lock:
+            old, samples = self._speeds.get(key, (speed, 0))
+            new = speed if samples == 0 else (self.ALPHA * speed) + ((1 - self.ALPHA) * old)
+            self._speeds[key] = (new, samples + 1)
+            self._db.execute("INSERT OR REPLACE INTO throughput "
+                             "(host, engine, quality, vcodec, bucket, speed, samples, updated) "
+                             "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (*key, new, samples + 1, time.time()))
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -10,10 +10,13 @@ import wandarr
 
 from wandarr import __version__
 from wandarr.agent import Agent
+from wandarr.agenthost import query_agent_status
 from wandarr.cluster import manage_cluster
 from wandarr.config import ConfigFile
-from wandarr.ffmpeg import FFmpeg
+from wandarr.journal import Journal, FINISHED_STATES
 from wandarr.media import MediaInfo
+from wandarr.probe import Prober
+from wandarr.scheduler import ORDER_POLICIES
 from wandarr.utils import files_from_file, dump_stats, VersionFetcher
 
 DEFAULT_CONFIG = os.path.expanduser('~/.wandarr.yml')
@@ -46,6 +49,16 @@ def init_argparse() -> argparse.ArgumentParser:
     parser.add_argument('--agent', dest='agent_mode',
                         action='store_true',
                         help="Start in agent mode on a host and listen for transcode requests from other wandarr.")
+    parser.add_argument('--agent-status', dest='agent_status', metavar='HOST',
+                        action='store', help='Show what an agent host is running and can do, then stop')
+    parser.add_argument('--agent-slots', dest='agent_slots', type=int, default=2,
+                        action='store', help='Agent mode - maximum concurrent transcodes (default 2)')
+    parser.add_argument('--agent-queue', dest='agent_queue', type=int, default=4,
+                        action='store', help='Agent mode - jobs that may wait for a free slot before others are turned away (default 4)')
+    parser.add_argument('--agent-keep-partial', dest='agent_keep_partial', type=int, default=600, metavar='SECS',
+                        action='store', help='Agent mode - seconds to keep interrupted transfers for the controller to resume (default 600)')
+    parser.add_argument('--agent-cache', dest='agent_cache', type=int, default=0, metavar='GB',
+                        action='store', help='Agent mode - GB of received sources to keep so re-runs skip the upload (default 0, off)')
     parser.add_argument('-t', dest='template', required=False,
                         action='store', help="Template name to use for transcode jobs")
     parser.add_argument('--hosts', dest='host_override',
@@ -54,6 +67,14 @@ def init_argparse() -> argparse.ArgumentParser:
                         action='store', help="Video quality (override for default in template)", default=None, required=False)
     parser.add_argument('--from-file', dest='from_file',
                         action='store', help='Filename that contains list of full paths of files to transcode')
+    parser.add_argument('--probe-workers', dest='probe_workers', type=int, default=None,
+                        action='store', help='Number of files to probe concurrently (default 4)')
+    parser.add_argument('--no-probe-cache', dest='no_probe_cache',
+                        action='store_true', help='Do not use or update the cache of media probe results')
+    parser.add_argument('--order', dest='dispatch_order', choices=ORDER_POLICIES, default=None,
+                        action='store', help='Dispatch order: fifo (as given), lpt (biggest jobs first), smallest first')
+    parser.add_argument('--resume', dest='resume',
+                        action='store_true', help='Resume an interrupted run from the job journal, skipping finished files')
     parser.add_argument("--console", dest="console", action="store_true", required=False, help="Use ugly console mode") # help=argparse.SUPPRESS)
     return parser
 
@@ -81,6 +102,29 @@ def finalize_files(files: list, from_file: str):
     return files
 
 
+def resume_files(files: list, template: str, configfile: ConfigFile):
+    """Apply the job journal of the last run. With no files given, the unfinished files from the journal are
+       used, otherwise the given files are filtered to those not yet finished.
+    """
+    journal_path = configfile.journal_path
+    if not journal_path or not os.path.exists(journal_path):
+        print("No job journal found - nothing to resume")
+        sys.exit(1)
+
+    entries = Journal.replay(journal_path)
+    if len(files) == 0:
+        files = Journal.unfinished(entries)
+        template = template or Journal.last_template(entries)
+    else:
+        files = [f for f in files if entries.get(os.path.abspath(f), {}).get('state') not in FINISHED_STATES]
+
+    finished = len([e for e in entries.values() if e['state'] in FINISHED_STATES])
+    print(f"Resuming: {finished} files already finished, {len(files)} to go")
+    if len(files) == 0:
+        sys.exit(0)
+    return files, template
+
+
 def setup_host_override(host_override: str, local_only: bool, configfile: ConfigFile):
     if local_only:
         for config in configfile.hosts.values():
@@ -96,6 +140,32 @@ def setup_host_override(host_override: str, local_only: bool, configfile: Config
                 this_config['status'] = 'disabled'
 
 
+def show_agent_status(configfile: ConfigFile, name: str) -> int:
+    """Print an agent's STATUS. The name is a host from the config, or an address."""
+    props = configfile.hosts.get(name, {'ip': name})
+    status = query_agent_status(props['ip'], props.get('ffmpeg'), props.get('working_dir'))
+    if status is None:
+        print(f"No status from agent at {props['ip']} - not running, or an older version")
+        return 1
+    print(f"Agent {name} ({props['ip']}) version {status['version']}, protocol {status['protocol']}")
+    print(f"Slots    : {status['free_slots']} of {status['slots']} free, room for {status['accepting']} more jobs")
+    if status.get('load_average'):
+        print("Load     : " + " ".join(f"{load:.2f}" for load in status['load_average']))
+    if status.get('temp_free') is not None:
+        print(f"Temp     : {int(status['temp_free'] / (1024 * 1024))}mb free in {status['temp_dir']}")
+    if status.get('partial_transfers'):
+        print(f"Kept     : {status['partial_transfers']} interrupted transfers waiting to be resumed")
+    cache = status.get('cache')
+    if cache and cache['capacity']:
+        print(f"Cache    : {int(cache['used'] / (1024 * 1024))}mb of {int(cache['capacity'] / (1024 * 1024))}mb in {cache['files']} files, "
+              f"{cache['hits']} hits, {cache['misses']} misses, {cache['evictions']} evicted ({int(cache['evicted_bytes'] / (1024 * 1024))}mb)")
+    print(f"Encoders : {' '.join(status['encoders']) or 'unknown'}")
+    for job in status['jobs']:
+        progress = f" at {job['time']}s, {job['fps']} fps, {job['speed']}" if job.get('time') is not None else ""
+        print(f"Job {job['id']:4}: {job['file']} from {job['client']} - {job['state']}{progress}")
+    return 0
+
+
 def load_config(path: str = DEFAULT_CONFIG):
     return ConfigFile(path)
 
@@ -120,20 +190,41 @@ def start():
         args.agent_mode = False
 
     if args.agent_mode:
-        agent = Agent()
+        agent = Agent(slots=args.agent_slots, queue_size=args.agent_queue, keep_partial=args.agent_keep_partial,
+                      cache_size=args.agent_cache * 1024 * 1024 * 1024)
         agent.serve()
         sys.exit(0)
 
     configfile = load_config(args.configfile_name)
 
+    if args.agent_status:
+        sys.exit(show_agent_status(configfile, args.agent_status))
+
     if args.console:
         configfile.rich = False
 
-    files = finalize_files(files, args.from_file)
+    if args.probe_workers:
+        configfile.probe_workers = args.probe_workers
+
+    if args.no_probe_cache:
+        configfile.probe_cache_path = None
+
+    if args.dispatch_order:
+        configfile.dispatch_order = args.dispatch_order
+
+    if args.resume and not files and not args.from_file:
+        # journal paths are already expanded, so don't glob them again
+        files, args.template = resume_files([], args.template, configfile)
+    else:
+        files = finalize_files(files, args.from_file)
+        if args.resume:
+            files, args.template = resume_files(files, args.template, configfile)
     setup_host_override(args.host_override, args.local_only, configfile)
 
     if wandarr.SHOW_INFO:
-        MediaInfo.show_info(configfile.rich, files, FFmpeg(configfile.ffmpeg_path))
+        prober = Prober.from_config(configfile)
+        MediaInfo.show_info(configfile.rich, files, prober)
+        prober.close()
         sys.exit(0)
 
     if not args.template:
@@ -143,7 +234,7 @@ def start():
     vfetch = VersionFetcher()
     vfetch.start()
 
-    completed: List = manage_cluster(files, configfile, args.template, args.video_quality_override)
+    completed: List = manage_cluster(files, configfile, args.template, args.video_quality_override, resume=args.resume)
     if len(completed) > 0:
         dump_stats(completed)
 
@@ -0,0 +1,131 @@
+"""
+    Bulk file transfer over sockets between controller and agent
+"""
+import hashlib
+import os
+import socket
+
+from wandarr import protocol
+
+# receive buffer, and send chunk size where zero-copy isn't available
+BUFFER_SIZE = 4 * 1024 * 1024
+# checksum of checked transfers, computed as the bytes go through rather than in a second pass
+CHECKSUM = "sha256"
+# a source fingerprint hashes this many blocks sampled through the file
+FINGERPRINT_BLOCKS = 16
+FINGERPRINT_BLOCK_SIZE = 64 * 1024
+
+
+def transfer_key(path: str) -> str:
+    """Identifies a source file across connections, so an interrupted upload is only resumed from the same file"""
+    st = os.stat(path)
+    return hashlib.sha1(f"{os.path.abspath(path)}|{st.st_size}|{st.st_mtime_ns}".encode()).hexdigest()
+
+
+def fingerprint(path: str) -> str:
+    """Content fingerprint of a file - its size and a hash of evenly spaced blocks including the first and last.
+       Reads a megabyte at most, however big the file.
+    """
+    size = os.path.getsize(path)
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        if size <= FINGERPRINT_BLOCKS * FINGERPRINT_BLOCK_SIZE:
+            digest.update(f.read())
+        else:
+            for i in range(FINGERPRINT_BLOCKS):
+                f.seek(i * (size - FINGERPRINT_BLOCK_SIZE) // (FINGERPRINT_BLOCKS - 1))
+                digest.update(f.read(FINGERPRINT_BLOCK_SIZE))
+    return f"{size}-{digest.hexdigest()}"
+
+
+def hash_file(path: str, length: int, digest):
+    """Add the first length bytes of a file to a checksum - the part that was sent before a transfer was interrupted"""
+    buf = bytearray(min(BUFFER_SIZE, max(length, 1)))
+    view = memoryview(buf)
+    remaining = length
+    with open(path, "rb") as f:
+        while remaining > 0:
+            n = f.readinto(view[:min(len(buf), remaining)])
+            if not n:
+                raise ValueError(f"{path} is shorter than {length} bytes")
+            digest.update(view[:n])
+            remaining -= n
+
+
+def send_file(sock: socket.socket, path: str, offset: int = 0, count: int = None, digest=None) -> int:
+    """Send count bytes of a file (default all of it from offset) and return the number sent.
+       Uses the kernel sendfile where the platform has it, otherwise large buffered reads. The bytes sent
+       are added to digest if given, which needs them in user space so sendfile is not used.
+    """
+    with open(path, "rb") as f:
+        if hasattr(os, "sendfile") and digest is None:
+            return sock.sendfile(f, offset, count)
+        # socket.sendfile would fall back to 8K sends here, which is far too slow for multi-GB media
+        return _send_buffered(sock, f, offset, count, digest)
+
+
+def _send_buffered(sock: socket.socket, f, offset: int, count: int = None, digest=None) -> int:
+    f.seek(offset)
+    buf = bytearray(BUFFER_SIZE)
+    view = memoryview(buf)
+    sent = 0
+    while count is None or sent < count:
+        want = BUFFER_SIZE if count is None else min(BUFFER_SIZE, count - sent)
+        n = f.readinto(view[:want])
+        if not n:
+            break
+        if digest is not None:
+            digest.update(view[:n])
+        sock.sendall(view[:n])
+        sent += n
+    return sent
+
+
+def recv_file(sock: socket.socket, path: str, filesize: int, offset: int = 0, digest=None) -> int:
+    """Receive a file of filesize bytes into path, the first offset of which are already there from an
+       interrupted transfer. The bytes received are added to digest if given.
+       Raises ConnectionError if the peer closes early, leaving what did arrive in place.
+    """
+    remaining = filesize - offset
+    buf = bytearray(min(BUFFER_SIZE, max(remaining, 1)))
+    view = memoryview(buf)
+    with open(path, "r+b" if offset else "wb") as out:
+        if offset:
+            out.truncate(offset)
+            out.seek(offset)
+        while remaining > 0:
+            n = sock.recv_into(view, min(len(buf), remaining))
+            if n == 0:
+                raise ConnectionError(f"connection closed with {remaining} of {filesize} bytes still to receive")
+            out.write(view[:n])
+            if digest is not None:
+                digest.update(view[:n])
+            remaining -= n
+    return filesize
+
+
+def send_checked(sock: socket.socket, path: str, offset: int = 0) -> int:
+    """Send a file from offset followed by a CHECKSUM message for the whole of it (protocol 5)"""
+    digest = hashlib.new(CHECKSUM)
+    if offset:
+        hash_file(path, offset, digest)
+    sent = send_file(sock, path, offset, digest=digest)
+    protocol.send_frame(sock, protocol.MSG_CHECKSUM, digest.hexdigest())
+    return sent
+
+
+def recv_checked(sock: socket.socket, path: str, filesize: int, offset: int = 0) -> int:
+    """Receive a file sent by send_checked and verify its checksum. A dropped connection raises ConnectionError
+       and leaves the part received in place to resume from. A corrupt file is removed and raises ValueError.
+    """
+    digest = hashlib.new(CHECKSUM)
+    if offset:
+        hash_file(path, offset, digest)
+    recv_file(sock, path, filesize, offset, digest)
+    mtype, payload = protocol.recv_frame(sock)
+    if mtype != protocol.MSG_CHECKSUM:
+        raise ConnectionError(f"expected a checksum after {os.path.basename(path)}, got message type {mtype}")
+    if payload.decode() != digest.hexdigest():
+        os.remove(path)
+        raise ValueError(f"checksum mismatch on {os.path.basename(path)}")
+    return filesize
@@ -6,7 +6,7 @@ import platform
 import subprocess
 import urllib.request
 from threading import Thread
-from typing import Dict
+from typing import Dict, Optional
 
 import wandarr
 from wandarr.media import MediaInfo
@@ -91,6 +91,16 @@ def calculate_progress(info: MediaInfo, stats: Dict) -> (int, int):
     return pct_done, pct_comp
 
 
+def parse_speed(speed) -> Optional[float]:
+    """Convert an ffmpeg speed stat such as '2.15x' to a number, None if not available"""
+    if not speed or speed == "N/A":
+        return None
+    try:
+        return float(str(speed).strip().rstrip('x'))
+    except ValueError:
+        return None
+
+
 def run(cmd):
     with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=False) as p:
         output = p.communicate()[0].decode('utf-8')